@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+from osgeo import gdal
+from utilities import N_CLASSES, bbox_to_window, run_jobs
+from cache import CACHE_DIR, cache_key
+
+# Disk-backed summed-area tables over a grid of tile_size x tile_size pixel tiles.
+# For every raster the index holds the cumulative class counts, and for every model raster
+# also the cumulative (historical, future) transition counts, so the counts for any box
+# aligned to the tile grid come from four lookups without reading the GeoTIFFs again.
+INDEX_DIR = os.path.join(CACHE_DIR, 'index')
+INDEX_TILE_SIZE = 64
+
+
+# Function to find the index directory of a raster (and of its historical baseline for transitions)
+def index_path(path, historical_path=None, tile_size=INDEX_TILE_SIZE, index_dir=INDEX_DIR):
+    paths = [path] if historical_path is None else [historical_path, path]
+    return os.path.join(index_dir, cache_key(paths, (), kind='bbox_index', tile_size=tile_size))
+
+
+# Function to add one band of tile counts to the running summed-area table row
+def _sat_row(previous_row, band_counts):
+    row = np.zeros_like(previous_row)
+    row[1:] = previous_row[1:] + np.cumsum(band_counts, axis=0)
+    return row
+
+
+# Function to build the summed-area tables of a raster, streaming tile_size rows at a time.
+# With historical_path the transition counts against the historical map are indexed as well.
+def build_index(path, historical_path=None, tile_size=INDEX_TILE_SIZE, index_dir=INDEX_DIR):
+    out_dir = index_path(path, historical_path, tile_size=tile_size, index_dir=index_dir)
+    if os.path.exists(os.path.join(out_dir, 'meta.json')):
+        return out_dir
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    dataset = gdal.Open(path)
+    historical_dataset = gdal.Open(historical_path) if historical_path is not None else None
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    n_tiles_x = -(-width // tile_size)
+    n_tiles_y = -(-height // tile_size)
+    tile_column = np.arange(width) // tile_size
+
+    class_sat = np.lib.format.open_memmap(os.path.join(tmp_dir, 'class_sat.npy'), mode='w+', dtype=np.int32,
+                                          shape=(n_tiles_y + 1, n_tiles_x + 1, N_CLASSES))
+    class_sat[0] = 0
+    if historical_dataset is not None:
+        full_sat = np.lib.format.open_memmap(os.path.join(tmp_dir, 'full_transition_sat.npy'), mode='w+', dtype=np.int32,
+                                             shape=(n_tiles_y + 1, n_tiles_x + 1, N_CLASSES * N_CLASSES))
+        full_sat[0] = 0
+
+    for tile_row in range(n_tiles_y):
+        yoff = tile_row * tile_size
+        ysize = min(tile_size, height - yoff)
+        future = dataset.GetRasterBand(1).ReadAsArray(0, yoff, width, ysize).astype(np.intp)
+        columns = np.broadcast_to(tile_column, future.shape)
+        valid = (future > 0) & (future < N_CLASSES)
+        codes = np.where(valid, columns * N_CLASSES + future, n_tiles_x * N_CLASSES)
+        band_counts = np.bincount(codes.ravel(), minlength=n_tiles_x * N_CLASSES + 1)[:-1]
+        class_sat[tile_row + 1] = _sat_row(class_sat[tile_row], band_counts.reshape(n_tiles_x, N_CLASSES))
+        if historical_dataset is not None:
+            historical = historical_dataset.GetRasterBand(1).ReadAsArray(0, yoff, width, ysize).astype(np.intp)
+            valid &= (historical > 0) & (historical < N_CLASSES)
+            n_codes = N_CLASSES * N_CLASSES
+            codes = np.where(valid, columns * n_codes + historical * N_CLASSES + future, n_tiles_x * n_codes)
+            band_counts = np.bincount(codes.ravel(), minlength=n_tiles_x * n_codes + 1)[:-1]
+            full_sat[tile_row + 1] = _sat_row(full_sat[tile_row], band_counts.reshape(n_tiles_x, n_codes))
+
+    # Keep only the transition codes that occur anywhere in the raster
+    if historical_dataset is not None:
+        codes = np.flatnonzero(full_sat[-1, -1])
+        transition_sat = np.lib.format.open_memmap(os.path.join(tmp_dir, 'transition_sat.npy'), mode='w+', dtype=np.int32,
+                                                   shape=(n_tiles_y + 1, n_tiles_x + 1, len(codes)))
+        for tile_row in range(n_tiles_y + 1):
+            transition_sat[tile_row] = full_sat[tile_row][:, codes]
+        transition_sat.flush()
+        np.save(os.path.join(tmp_dir, 'transition_codes.npy'), codes)
+        del full_sat
+        os.remove(os.path.join(tmp_dir, 'full_transition_sat.npy'))
+    class_sat.flush()
+
+    meta = {'path': path, 'historical_path': historical_path, 'tile_size': tile_size,
+            'geo_transform': list(dataset.GetGeoTransform()), 'shape': [height, width]}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+# Function to build the index of one (path, historical_path, tile_size) job in a worker process
+def build_job(job):
+    path, historical_path, tile_size = job
+    return build_index(path, historical_path, tile_size=tile_size)
+
+
+# Function to snap a pixel offset to the nearest tile edge. The last tile of a raster can be
+# partial, so its far edge is the edge of the raster and not a multiple of tile_size.
+def _snap_edge(offset, tile_size, size):
+    edges = np.minimum(np.arange(-(-size // tile_size) + 1) * tile_size, size)
+    return int(np.argmin(np.abs(edges - offset)))
+
+
+# Function to snap a bbox to the tile grid of an index.
+# Returns the tile range (ty0, tx0, ty1, tx1) and the snapped (min_lon, min_lat, max_lon, max_lat).
+def _snap(meta, bbox):
+    geo_transform = meta['geo_transform']
+    tile_size = meta['tile_size']
+    height, width = meta['shape']
+    minx, miny, maxx, maxy = bbox_to_window(geo_transform, bbox)
+    tx0, tx1 = [_snap_edge(x, tile_size, width) for x in (minx, maxx)]
+    ty0, ty1 = [_snap_edge(y, tile_size, height) for y in (miny, maxy)]
+    min_lon = geo_transform[0] + tx0 * tile_size * geo_transform[1]
+    max_lon = geo_transform[0] + min(tx1 * tile_size, width) * geo_transform[1]
+    max_lat = geo_transform[3] + ty0 * tile_size * geo_transform[5]
+    min_lat = geo_transform[3] + min(ty1 * tile_size, height) * geo_transform[5]
+    return (ty0, tx0, ty1, tx1), (min_lon, min_lat, max_lon, max_lat)
+
+
+# Function to sum a summed-area table over a tile range with four lookups
+def _box_sum(sat, tiles):
+    ty0, tx0, ty1, tx1 = tiles
+    return (sat[ty1, tx1].astype(np.int64) - sat[ty0, tx1] - sat[ty1, tx0] + sat[ty0, tx0])
+
+
+# Function to load an index built by build_index
+def load_index(path, historical_path=None, tile_size=INDEX_TILE_SIZE, index_dir=INDEX_DIR):
+    index_dir = index_path(path, historical_path, tile_size=tile_size, index_dir=index_dir)
+    if not os.path.exists(os.path.join(index_dir, 'meta.json')):
+        raise FileNotFoundError(f"No bbox index for {path}; run `python bbox_index.py build` first")
+    with open(os.path.join(index_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    return index_dir, meta
+
+
+# Function to query the class counts inside a bbox (snapped to the tile grid)
+def query_class_counts(path, bbox, tile_size=INDEX_TILE_SIZE, index_dir=INDEX_DIR):
+    index_dir, meta = load_index(path, tile_size=tile_size, index_dir=index_dir)
+    tiles, snapped_bbox = _snap(meta, bbox)
+    class_sat = np.load(os.path.join(index_dir, 'class_sat.npy'), mmap_mode='r')
+    return _box_sum(class_sat, tiles), snapped_bbox
+
+
+# Function to query the transition matrix of a model against the historical map inside a bbox
+def query_transitions(model_path, historical_path, bbox, tile_size=INDEX_TILE_SIZE, index_dir=INDEX_DIR):
+    index_dir, meta = load_index(model_path, historical_path, tile_size=tile_size, index_dir=index_dir)
+    tiles, snapped_bbox = _snap(meta, bbox)
+    transition_sat = np.load(os.path.join(index_dir, 'transition_sat.npy'), mmap_mode='r')
+    codes = np.load(os.path.join(index_dir, 'transition_codes.npy'))
+    matrix = np.zeros(N_CLASSES * N_CLASSES, dtype=np.int64)
+    matrix[codes] = _box_sum(transition_sat, tiles)
+    return matrix.reshape(N_CLASSES, N_CLASSES), snapped_bbox
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query the bounding-box index of kg2 rasters.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Index the historical map and the given model rasters')
+    build_parser.add_argument('historical', help='Historical kg2 raster')
+    build_parser.add_argument('models', nargs='*', help='Model kg2 rasters')
+    build_parser.add_argument('--tile_size', type=int, default=INDEX_TILE_SIZE, help='Tile size of the index in pixels')
+    build_parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    query_parser = subparsers.add_parser('query', help='Class counts (and transitions) inside a bounding box')
+    query_parser.add_argument('historical', help='Historical kg2 raster')
+    query_parser.add_argument('model', nargs='?', help='Model kg2 raster')
+    query_parser.add_argument('--bbox', type=float, nargs=4, required=True, help='Bounding box (min_lon, min_lat, max_lon, max_lat)')
+    query_parser.add_argument('--tile_size', type=int, default=INDEX_TILE_SIZE, help='Tile size of the index in pixels')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        jobs = [(args.historical, None, args.tile_size)] + [(model, args.historical, args.tile_size) for model in args.models]
+        for index_dir in run_jobs(build_job, jobs, args.workers):
+            print(f"Index written to {index_dir}")
+    else:
+        path = args.historical if args.model is None else args.model
+        counts, snapped_bbox = query_class_counts(path, args.bbox, tile_size=args.tile_size)
+        print(f"Snapped bbox: {snapped_bbox}")
+        for cat in np.flatnonzero(counts):
+            print(f"{cat}\t{counts[cat]}")
+        if args.model is not None:
+            matrix, _ = query_transitions(args.model, args.historical, args.bbox, tile_size=args.tile_size)
+            for src, dst in zip(*np.nonzero(matrix)):
+                print(f"{src} -> {dst}\t{matrix[src, dst]}")
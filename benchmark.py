@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+from osgeo import gdal
+from utilities import (MODELS, N_CLASSES, changes_dict, process_model, run_jobs, tiled_agreement, tiled_class_histogram,
+                       transition_job)
+
+# Benchmark of the analysis hot paths on synthetic kg2-style GeoTIFFs, so performance can be
+# measured without the CHELSA files. Results are appended as one JSON line per run, tagged with
+# the current commit, to compare optimizations across commits.
+# Sizes in pixels (width, height) of the 30 arcsec grid, from one bbox up to continental scale
+SIZES = {
+    'alps': (1380, 780),
+    'central_asia': (5400, 2640),
+    'asia': (5040, 3720),
+    'continental': (14400, 7200),
+}
+# Share of land pixels per class in the synthetic historical map, roughly following the global kg2 map
+CLASS_WEIGHTS = np.array([0, 3, 2, 1, 6, 12, 2, 6, 3, 3, 4, 1, 2, 1, 0.2, 2, 1, 0.2, 1, 5, 12, 2,
+                          0.5, 1, 0.5, 0.2, 1, 2, 3, 0.5, 8, 4], dtype=float)
+
+
+# Function to build a smooth random field by upsampling coarse noise
+def _smooth_field(rng, shape, scale):
+    coarse = rng.random((shape[0] // scale + 2, shape[1] // scale + 2))
+    return np.kron(coarse, np.ones((scale, scale)))[:shape[0], :shape[1]]
+
+
+# Function to generate a synthetic historical class map: contiguous zones following a latitude
+# gradient, class shares from CLASS_WEIGHTS and about 30% nodata (ocean)
+def synthetic_historical(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    field = 0.7 * np.linspace(0, 1, shape[0])[:, None] + 0.3 * _smooth_field(rng, shape, 64)
+    field += 0.02 * rng.random(shape)
+    cumulative = np.cumsum(CLASS_WEIGHTS[1:]) / CLASS_WEIGHTS[1:].sum()
+    thresholds = np.quantile(field.ravel()[::97], cumulative[:-1])
+    classes = (np.searchsorted(thresholds, field) + 1).astype(np.uint8)
+    ocean = _smooth_field(rng, shape, 128) < 0.3
+    classes[ocean] = 0
+    return classes
+
+
+# Function to derive a synthetic future map: patches of pixels shift to a neighbouring class
+def synthetic_future(historical, seed, change_fraction=0.2):
+    rng = np.random.default_rng(seed)
+    shift = rng.choice([-2, -1, 1, 2], size=N_CLASSES)
+    changed = _smooth_field(rng, historical.shape, 16) < change_fraction
+    future = np.where(changed & (historical > 0), historical.astype(np.int16) + shift[historical], historical)
+    return np.where(historical > 0, future.clip(1, N_CLASSES - 1), 0).astype(np.uint8)
+
+
+# Function to write a class map as a tiled, compressed GeoTIFF on a 30 arcsec grid with nodata 0
+def write_kg2(path, array, origin=(45.0, 56.0)):
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(path, array.shape[1], array.shape[0], 1, gdal.GDT_Byte,
+                            options=['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE'])
+    dataset.SetGeoTransform((origin[0], 1 / 120, 0.0, origin[1], 0.0, -1 / 120))
+    dataset.SetProjection('EPSG:4326')
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(array)
+    dataset.FlushCache()
+
+
+# Function to generate the historical map and one future map per model for a size
+def generate(out_dir, size, n_models=len(MODELS)):
+    width, height = SIZES[size]
+    historical_path = os.path.join(out_dir, f'CHELSA_kg2_{size}_historical.tif')
+    historical = synthetic_historical((height, width))
+    write_kg2(historical_path, historical)
+    model_paths = []
+    for k in range(n_models):
+        model_path = os.path.join(out_dir, f'CHELSA_kg2_{size}_model{k}.tif')
+        write_kg2(model_path, synthetic_future(historical, seed=k + 1))
+        model_paths.append(model_path)
+    return historical_path, model_paths
+
+
+# Function to time func and return (result, seconds)
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+# Function to run the hot paths on one size and return their timings and throughput
+def run_size(out_dir, size, workers=1):
+    historical_path, model_paths = generate(out_dir, size)
+    width, height = SIZES[size]
+    window = (0, 0, width, height)
+    pixels = width * height
+    results = {}
+
+    # Transition counting for a single model (process_model)
+    _, seconds = _timed(lambda: process_model(model_paths[0], gdal.Open(historical_path), window))
+    results['process_model'] = {'seconds': seconds, 'pixels_per_sec': pixels / seconds}
+
+    # Agreement map building for one category over all models (main.py)
+    _, seconds = _timed(lambda: tiled_agreement(historical_path, model_paths, window, 30, workers=workers))
+    results['agreement'] = {'seconds': seconds, 'pixels_per_sec': pixels * (len(model_paths) + 1) / seconds}
+
+    # Ensemble aggregation of the ET transitions over all models (plot_migrations_all.py)
+    def aggregate():
+        jobs = [(historical_path, model_path, window, [30], gdal.Open, None) for model_path in model_paths]
+        summed = sum(run_jobs(transition_job, jobs, workers))
+        historical_count = tiled_class_histogram(gdal.Open(historical_path), window)[30]
+        return {change: count / len(model_paths) for change, count in changes_dict(summed).items()}, historical_count
+    _, seconds = _timed(aggregate)
+    results['ensemble_aggregation'] = {'seconds': seconds, 'pixels_per_sec': pixels * len(model_paths) / seconds}
+    return results
+
+
+# Function to get the current commit so results can be compared across commits
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the analysis hot paths on synthetic kg2 rasters.')
+    parser.add_argument('--sizes', type=str, nargs='+', choices=list(SIZES), default=['alps', 'central_asia'],
+                        help='Raster sizes to benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--output', type=str, default='bench_output.txt', help='File the JSON results are appended to')
+    parser.add_argument('--data_dir', type=str, default=None, help='Keep the synthetic rasters in this directory')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_dir = args.data_dir or tmp_dir
+        os.makedirs(out_dir, exist_ok=True)
+        for size in args.sizes:
+            results = run_size(out_dir, size, workers=args.workers)
+            for name, result in results.items():
+                print(f"{size:>14} {name:>22}: {result['seconds']:8.3f} s, {result['pixels_per_sec'] / 1e6:8.1f} Mpx/s")
+            with open(args.output, 'a') as f:
+                f.write(json.dumps({'commit': _commit(), 'size': size, 'workers': args.workers,
+                                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}) + '\n')
@@ -0,0 +1,268 @@
+import functools
+import hashlib
+import json
+import os
+import numpy as np
+from osgeo import gdal, gdal_array
+from tile_index import block_classes
+from utilities import N_CLASSES, TILE_PIXELS, block_windows, read_block, run_jobs, skip_blocks, transition_job, tiled_agreement, tiled_agreement_cube, tiled_class_histogram
+
+# On-disk cache of cropped rasters (.npy, memory-mapped on read) and analysis results (.npz).
+# Entries are keyed by the input files (path, mtime, size), the pixel window and the analysis
+# parameters, so editing or replacing an input file invalidates everything derived from it.
+CACHE_DIR = os.environ.get('KOPPEN_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'koppen'))
+CACHE_MAX_BYTES = int(os.environ.get('KOPPEN_CACHE_MAX_BYTES', 20 * 2 ** 30))
+
+
+# Function to build the cache key for a set of input files, a window and analysis parameters
+def cache_key(paths, window, **params):
+    files = []
+    for path in paths:
+        stat = os.stat(path)
+        files.append([os.path.abspath(path), stat.st_mtime_ns, stat.st_size])
+    description = json.dumps({'files': files, 'window': list(window), 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+# Function to mark an entry as recently used (the eviction order is least recently used first)
+def _touch(path):
+    os.utime(path, None)
+
+
+# Function to drop the least recently used entries until the cache fits in max_bytes. Files still
+# being written (*.tmp*) are left alone, and entries another process removes first are skipped.
+def evict(max_bytes=CACHE_MAX_BYTES, cache_dir=CACHE_DIR):
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or '.tmp' in name:
+            continue
+        try:
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        except FileNotFoundError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# Function to memory-map a cached .npy entry, or None on a miss (also when a concurrent eviction
+# removes it between the lookup and the load)
+def _load_entry(cache_path):
+    try:
+        _touch(cache_path)
+        return np.load(cache_path, mmap_mode='r')
+    except FileNotFoundError:
+        return None
+
+
+# Function to return the cropped window of a raster as a read-only memory-mapped array.
+# On a miss the window is streamed tile by tile into a .npy file, so it never sits in memory.
+def cached_window(path, window, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, cache_key([path], window, kind='window') + '.npy')
+    array = _load_entry(cache_path)
+    if array is not None:
+        return array
+    minx, miny, maxx, maxy = window
+    dataset = gdal.Open(path)
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dataset.GetRasterBand(1).DataType)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(maxy - miny, maxx - minx))
+    # Tiles without land according to the tile-validity index keep the zeros of the new file
+    for block in skip_blocks(block_windows(dataset, window), lambda block: block_classes(path, block)):
+        xoff, yoff, xsize, ysize = block
+        array[yoff - miny:yoff - miny + ysize, xoff - minx:xoff - minx + xsize] = read_block(dataset, block)
+    array.flush()
+    del array
+    os.replace(tmp_path, cache_path)
+    # Map the entry before evicting: the mapping stays valid even if the file is removed afterwards
+    array = np.load(cache_path, mmap_mode='r')
+    evict(cache_dir=cache_dir)
+    return array
+
+
+# Minimal stand-in for a GDAL dataset backed by a cached window, so the tiled readers in
+# utilities work on it unchanged. Offsets passed to ReadAsArray are absolute file pixels.
+class WindowRaster:
+    def __init__(self, array, window, path=None):
+        self.array = array
+        self.window = window
+        self.path = path
+
+    def GetDescription(self):
+        return self.path
+
+    def GetRasterBand(self, band):
+        return self
+
+    def GetBlockSize(self):
+        return (self.array.shape[1], 1)
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        minx, miny = self.window[0], self.window[1]
+        return np.asarray(self.array[yoff - miny:yoff - miny + ysize, xoff - minx:xoff - minx + xsize])
+
+    # Memory-mapped windows are pickled as their file name, so worker processes attach to the
+    # same pages instead of receiving a copy
+    def __reduce__(self):
+        if isinstance(self.array, np.memmap) and self.array.filename:
+            return _attach_window, (self.array.filename, self.window, self.path)
+        return WindowRaster, (np.asarray(self.array), self.window, self.path)
+
+
+# Function to re-open a pickled memory-mapped WindowRaster in a worker process
+def _attach_window(filename, window, path):
+    return WindowRaster(np.load(filename, mmap_mode='r'), window, path)
+
+
+# Function to open a raster through the window cache; pass functools.partial(open_cached, window=...)
+# wherever an open_dataset function is expected
+def open_cached(path, window, cache_dir=CACHE_DIR):
+    return WindowRaster(cached_window(path, window, cache_dir=cache_dir), window, path)
+
+
+# Function to return the mask of one class in the cropped window of a raster as a read-only
+# memory-mapped bool array, built tile by tile from the window cache on a miss
+def cached_class_mask(path, window, cat, cache_dir=CACHE_DIR):
+    cache_path = os.path.join(cache_dir, cache_key([path], window, kind='class_mask', cat=int(cat)) + '.npy')
+    mask = _load_entry(cache_path)
+    if mask is not None:
+        return mask
+    classes = cached_window(path, window, cache_dir=cache_dir)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    mask = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=bool, shape=classes.shape)
+    step = max(1, TILE_PIXELS // max(1, classes.shape[1]))
+    for row in range(0, classes.shape[0], step):
+        mask[row:row + step] = classes[row:row + step] == cat
+    mask.flush()
+    del mask
+    os.replace(tmp_path, cache_path)
+    mask = np.load(cache_path, mmap_mode='r')
+    evict(cache_dir=cache_dir)
+    return mask
+
+
+# Function to load the historical baseline of a window once for a whole run: the class window and
+# the masks of the given classes, all memory-mapped from the cache. Every scenario, time slice and
+# worker process attaches to the same pages (the OS page cache holds them once), so running many
+# comparisons at the same time does not multiply the memory taken by the baseline.
+def shared_baseline(path, window, classes=(), cache_dir=CACHE_DIR):
+    historical = WindowRaster(cached_window(path, window, cache_dir=cache_dir), window, path)
+    masks = {int(cat): cached_class_mask(path, window, cat, cache_dir=cache_dir) for cat in classes}
+    return historical, masks
+
+
+# Function to fill the window cache for one (path, window, cache_dir) job
+def _warm_job(job):
+    path, window, cache_dir = job
+    cached_window(path, window, cache_dir=cache_dir)
+
+
+# Function to load a cached result, or None on a miss (also when a concurrent eviction removes it)
+def load_result(key, cache_dir=CACHE_DIR):
+    cache_path = os.path.join(cache_dir, key + '.npz')
+    try:
+        _touch(cache_path)
+        with np.load(cache_path) as stored:
+            return {name: stored[name] for name in stored.files}
+    except FileNotFoundError:
+        return None
+
+
+# Function to store a dict of arrays as a compressed result
+def store_result(key, result, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, key + '.npz')
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmp_path, **result)
+    os.replace(tmp_path, cache_path)
+    evict(cache_dir=cache_dir)
+
+
+# Function to compute the transition matrices of several models, reusing cached results.
+# Only models without a cached result touch the rasters, and those read through the window cache.
+def cached_transition_matrices(historical_path, model_paths, window, source_classes=None, workers=1, row_area=None,
+                               cache_dir=CACHE_DIR):
+    keys = [cache_key([historical_path, model_path], window, kind='transitions', source_classes=source_classes,
+                      area_weighted=row_area is not None)
+            for model_path in model_paths]
+    results = [load_result(key, cache_dir=cache_dir) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        paths = [historical_path] + [model_paths[i] for i in missing]
+        list(run_jobs(_warm_job, [(path, window, cache_dir) for path in paths], workers))
+        open_dataset = functools.partial(open_cached, window=window, cache_dir=cache_dir)
+        jobs = [(historical_path, model_paths[i], window, source_classes, open_dataset, row_area) for i in missing]
+        for i, matrix in zip(missing, run_jobs(transition_job, jobs, workers)):
+            results[i] = {'matrix': matrix}
+            store_result(keys[i], results[i], cache_dir=cache_dir)
+    return [result['matrix'] for result in results]
+
+
+# Function to compute the class histogram of a window, reusing a cached result
+def cached_class_histogram(path, window, row_area=None, cache_dir=CACHE_DIR):
+    key = cache_key([path], window, kind='histogram', area_weighted=row_area is not None)
+    result = load_result(key, cache_dir=cache_dir)
+    if result is None:
+        result = {'histogram': tiled_class_histogram(open_cached(path, window, cache_dir=cache_dir), window, row_area=row_area)}
+        store_result(key, result, cache_dir=cache_dir)
+    return result['histogram']
+
+
+# Function to compute the agreement map for one category, reusing a cached result.
+# Returns the same (agreement_array, historical_mask, counts) tuple as utilities.tiled_agreement.
+def cached_agreement(historical_path, model_paths, window, target_cat, workers=1, row_area=None, cache_dir=CACHE_DIR):
+    key = cache_key([historical_path] + list(model_paths), window, kind='agreement', target_cat=target_cat,
+                    area_weighted=row_area is not None)
+    result = load_result(key, cache_dir=cache_dir)
+    # The historical mask is the shared baseline mask, so it is neither rebuilt nor stored per ensemble
+    _, masks = shared_baseline(historical_path, window, [target_cat], cache_dir=cache_dir)
+    if result is None:
+        paths = [historical_path] + list(model_paths)
+        list(run_jobs(_warm_job, [(path, window, cache_dir) for path in paths], workers))
+        open_dataset = functools.partial(open_cached, window=window, cache_dir=cache_dir)
+        agreement_array, _, counts = tiled_agreement(historical_path, model_paths, window, target_cat, workers=workers,
+                                                     open_dataset=open_dataset, row_area=row_area, historical_mask=masks[target_cat])
+        result = {'agreement': agreement_array, 'counts': counts}
+        store_result(key, result, cache_dir=cache_dir)
+    return result['agreement'], masks[target_cat], result['counts']
+
+
+# Function to compute the all-class agreement cube, reusing a cached result.
+# The cube is kept as a memory-mapped .npy; the modal layers and counts go to a compressed .npz.
+def cached_agreement_cube(historical_path, model_paths, window, workers=1, row_area=None, cache_dir=CACHE_DIR):
+    key = cache_key([historical_path] + list(model_paths), window, kind='agreement_cube', area_weighted=row_area is not None)
+    cube_path = os.path.join(cache_dir, key + '.cube.npy')
+    result = load_result(key, cache_dir=cache_dir)
+    # The historical map is the shared baseline window, so it is neither copied nor stored per ensemble
+    historical, _ = shared_baseline(historical_path, window, cache_dir=cache_dir)
+    cube = _load_entry(cube_path) if result is not None else None
+    if cube is not None:
+        result['cube'] = cube
+        result['historical'] = historical.array
+        return result
+    paths = [historical_path] + list(model_paths)
+    list(run_jobs(_warm_job, [(path, window, cache_dir) for path in paths], workers))
+    open_dataset = functools.partial(open_cached, window=window, cache_dir=cache_dir)
+    minx, miny, maxx, maxy = window
+    tmp_path = f'{cube_path}.{os.getpid()}.tmp'
+    cube = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(N_CLASSES, maxy - miny, maxx - minx))
+    result = tiled_agreement_cube(historical_path, model_paths, window, workers=workers, open_dataset=open_dataset, cube=cube,
+                                  row_area=row_area, historical=historical.array)
+    cube.flush()
+    del cube, result['cube'], result['historical']
+    os.replace(tmp_path, cube_path)
+    cube = np.load(cube_path, mmap_mode='r')
+    store_result(key, result, cache_dir=cache_dir)
+    result['cube'] = cube
+    result['historical'] = historical.array
+    return result
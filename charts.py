@@ -0,0 +1,28 @@
+import matplotlib.pyplot as plt
+import koppen_mappings
+
+# Figures without a map (bar charts). They only need matplotlib, so scripts that draw no maps, such
+# as plot_migrations.py on the compute nodes, do not import cartopy through plots.py.
+
+
+# Function to plot the ensemble mean migrations out of source_class with their standard deviation.
+# means and std_devs are {(src, dst): value} dicts (see utilities.changes_dict); top_n keeps only the largest.
+def plot_migrations_bar(means, std_devs, out_path, source_class=30, top_n=None, x_max_lim=400000, area_weighted=False):
+    sorted_means = sorted(means.items(), key=lambda x: x[1], reverse=True)  # Sort all migrations
+    sorted_means = [(change, mean) for change, mean in sorted_means if change[0] == source_class][:top_n]
+    migrations = [f"{koppen_mappings.koppen_mapping_short.get(src)} -> {koppen_mappings.koppen_mapping_short.get(dst)}" for (src, dst), _ in sorted_means]
+    mean_counts = [mean for _, mean in sorted_means]
+    error = [std_devs[change] for change, _ in sorted_means]
+
+    plt.figure(figsize=(10, 8))
+    plt.barh(migrations, mean_counts, xerr=error, color='skyblue')
+    plt.xlabel('Mean Area of Migrations (km$^2$)' if area_weighted else 'Mean Count of Migrations (grid points)', fontsize= 15)
+    plt.ylabel('Migration Type', fontsize= 15)
+    plt.xticks(fontsize= 12)
+    plt.yticks(fontsize= 15)
+    plt.gca().invert_yaxis()
+    plt.xlim(0, x_max_lim)
+    plt.ylim(0,12)
+    plt.tight_layout()
+    plt.savefig(out_path)
+    plt.close()
@@ -0,0 +1,153 @@
+import argparse
+import os
+import numpy as np
+from osgeo import gdal
+from utilities import BASE_DIR, block_windows, kg2_historical_path, kg2_model_path, read_block, run_jobs
+
+# Köppen-Geiger classifier for monthly temperature and precipitation climatologies, so class maps
+# can be rebuilt for other thresholds, other bias-corrected inputs or models without a kg2 product.
+# It follows the criteria of Peel et al. (2007) / Beck et al. (2018): B has precedence, the C/D
+# boundary is a coldest month of 0 degC, and summer is the warmer half year of AMJJAS and ONDJFM.
+# The output uses the class codes of koppen_mappings.koppen_mapping_short (1 = Af ... 31 = EF,
+# 0 = nodata) and is written as a tiled uint8 GeoTIFF like the CHELSA kg2 maps.
+SUMMER_MONTHS = np.array([3, 4, 5, 6, 7, 8])  # AMJJAS (0-based month indices)
+WINTER_MONTHS = np.array([9, 10, 11, 0, 1, 2])  # ONDJFM
+# Pixels per tile; every tile holds 24 float32 layers, so tiles are smaller than utilities.TILE_PIXELS
+CLASSIFY_TILE_PIXELS = 2 ** 19
+# CHELSA V2.1 stores tas in 0.1 K and pr in 0.1 kg m-2 month-1; rasters that carry their own
+# scale/offset metadata use that instead
+TAS_SCALE, TAS_OFFSET = 0.1, -273.15
+PR_SCALE, PR_OFFSET = 0.1, 0.0
+
+
+# Function to build the paths of the 12 monthly CHELSA climatologies of one variable (tas or pr),
+# historical when model is None
+def climatology_paths(variable, time_slice='1981-2010', model=None, scenario=None, base_dir=BASE_DIR):
+    if model is None:
+        return [f'{base_dir}/{time_slice}/{variable}/CHELSA_{variable}_{month:02d}_{time_slice}_V.2.1.tif' for month in range(1, 13)]
+    years = time_slice.replace('-', '_')
+    return [f'{base_dir}/{time_slice}/{model}/{scenario}/{variable}/CHELSA_{model.lower()}_r1i1p1f1_w5e5_{scenario}_{variable}_{month:02d}_{years}_norm.tif'
+            for month in range(1, 13)]
+
+
+# Function to classify monthly climatologies. tas (degC) and pr (mm/month) have shape (12, ...);
+# returns the uint8 class codes with the shape of one month (0 where any month is NaN).
+def classify(tas, pr):
+    tas = np.asarray(tas, dtype=np.float32)
+    pr = np.asarray(pr, dtype=np.float32)
+    mat = tas.mean(axis=0)
+    map_ = pr.sum(axis=0)
+    t_hot = tas.max(axis=0)
+    t_cold = tas.min(axis=0)
+    t_mon10 = np.count_nonzero(tas > 10, axis=0)
+    p_dry = pr.min(axis=0)
+
+    # Summer is the warmer of the two half years
+    north = tas[SUMMER_MONTHS].mean(axis=0) >= tas[WINTER_MONTHS].mean(axis=0)
+    pr_summer = np.where(north, pr[SUMMER_MONTHS], pr[WINTER_MONTHS])
+    pr_winter = np.where(north, pr[WINTER_MONTHS], pr[SUMMER_MONTHS])
+    p_summer, p_winter = pr_summer.sum(axis=0), pr_winter.sum(axis=0)
+    p_sdry, p_swet = pr_summer.min(axis=0), pr_summer.max(axis=0)
+    p_wdry, p_wwet = pr_winter.min(axis=0), pr_winter.max(axis=0)
+
+    # Aridity threshold (mm) depending on the precipitation seasonality
+    p_threshold = np.where(p_winter >= 0.7 * map_, 2 * mat, np.where(p_summer >= 0.7 * map_, 2 * mat + 28, 2 * mat + 14))
+
+    # Second letter of C and D climates: 0 f, 1 s (dry summer), 2 w (dry winter). Where both the
+    # s and the w criterion hold, the half year with less precipitation is the dry season.
+    dry_summer = (p_sdry < 40) & (p_sdry < p_wwet / 3)
+    dry_winter = p_wdry < p_swet / 10
+    seasonality = np.where(dry_summer & dry_winter, np.where(p_winter < p_summer, 2, 1),
+                           np.where(dry_summer, 1, np.where(dry_winter, 2, 0)))
+    # Third letter: 0 a (hot summer), 1 b (warm), 2 c (cold), 3 d (very cold winter, D only)
+    warmth = np.where(t_hot >= 22, 0, np.where(t_mon10 >= 4, 1, 2))
+
+    tropical = np.where(p_dry >= 60, 1, np.where(p_dry >= 100 - map_ / 25, 2, np.where(p_sdry < p_wdry, 3, 4)))
+    arid = np.where(map_ < 5 * p_threshold, 5, 7) + (mat >= 18)
+    temperate = 9 + 3 * seasonality + warmth
+    cold = 18 + 4 * seasonality + np.where((warmth == 2) & (t_cold < -38), 3, warmth)
+    polar = np.where(t_hot > 0, 30, 31)
+
+    classes = np.select([map_ < 10 * p_threshold, t_hot <= 10, t_cold >= 18, t_cold > 0],
+                        [arid, polar, tropical, temperate], default=cold)
+    valid = np.isfinite(tas).all(axis=0) & np.isfinite(pr).all(axis=0)
+    return np.where(valid, classes, 0).astype(np.uint8)
+
+
+# Function to read one tile of a climatology as float32 in physical units (NaN for nodata). The
+# scale and offset of the band are used when it has them, the given defaults otherwise.
+def read_scaled(dataset, block, scale, offset):
+    band = dataset.GetRasterBand(1)
+    raw = read_block(dataset, block)
+    array = raw.astype(np.float32)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        array[raw == nodata] = np.nan
+    band_scale, band_offset = band.GetScale(), band.GetOffset()
+    if band_scale not in (None, 1.0) or band_offset not in (None, 0.0):
+        scale, offset = band_scale or 1.0, band_offset or 0.0
+    return array * scale + offset
+
+
+# Function to classify a single tile from the 12 tas and 12 pr datasets
+def classify_block(tas_datasets, pr_datasets, block, scales):
+    tas_scale, tas_offset, pr_scale, pr_offset = scales
+    tas = np.stack([read_scaled(dataset, block, tas_scale, tas_offset) for dataset in tas_datasets])
+    pr = np.stack([read_scaled(dataset, block, pr_scale, pr_offset) for dataset in pr_datasets])
+    return classify(tas, pr)
+
+
+# Function to run one (tas_paths, pr_paths, block, scales) tile in a worker process
+def classify_job(job):
+    tas_paths, pr_paths, block, scales = job
+    return classify_block([gdal.Open(path) for path in tas_paths], [gdal.Open(path) for path in pr_paths], block, scales)
+
+
+# Function to classify the full grid of the climatologies tile by tile (spread over workers
+# processes) and write it as a tiled, compressed uint8 GeoTIFF with nodata 0 to out_path
+def tiled_classify(tas_paths, pr_paths, out_path, workers=1, scales=(TAS_SCALE, TAS_OFFSET, PR_SCALE, PR_OFFSET)):
+    template = gdal.Open(tas_paths[0])
+    width, height = template.RasterXSize, template.RasterYSize
+    blocks = list(block_windows(template, (0, 0, width, height), CLASSIFY_TILE_PIXELS))
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    tmp_path = f'{out_path}.{os.getpid()}.tmp.tif'
+    output = gdal.GetDriverByName('GTiff').Create(tmp_path, width, height, 1, gdal.GDT_Byte,
+                                                   options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    output.SetGeoTransform(template.GetGeoTransform())
+    output.SetProjection(template.GetProjection())
+    band = output.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    jobs = [(tas_paths, pr_paths, block, scales) for block in blocks]
+    for (xoff, yoff, _, _), classes in zip(blocks, run_jobs(classify_job, jobs, workers)):
+        band.WriteArray(classes, xoff, yoff)
+    output.FlushCache()
+    output = None
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify monthly tas/pr climatologies into kg2-compatible Koppen-Geiger maps.')
+    parser.add_argument('--time_slice', type=str, help='Time slice of the climatologies', default='1981-2010')
+    parser.add_argument('--model', type=str, help='Model (omit for the historical climatologies)', default=None)
+    parser.add_argument('--scenario', type=str, help='Scenario of the model climatologies', default=None)
+    parser.add_argument('--base_dir', type=str, help='Root of the CHELSA climatologies', default=BASE_DIR)
+    parser.add_argument('--tas', type=str, nargs=12, help='The 12 monthly temperature rasters (overrides the CHELSA paths)', default=None)
+    parser.add_argument('--pr', type=str, nargs=12, help='The 12 monthly precipitation rasters (overrides the CHELSA paths)', default=None)
+    parser.add_argument('--out_dir', type=str, help='Root of the output tree, laid out like the CHELSA kg2 maps', default='kg2')
+    parser.add_argument('--workers', type=int, help='Number of worker processes for the tiles', default=1)
+    parser.add_argument('--tas_scale', type=float, help='Scale of raw tas values without scale metadata', default=TAS_SCALE)
+    parser.add_argument('--tas_offset', type=float, help='Offset (to degC) of raw tas values without offset metadata', default=TAS_OFFSET)
+    parser.add_argument('--pr_scale', type=float, help='Scale (to mm/month) of raw pr values without scale metadata', default=PR_SCALE)
+    parser.add_argument('--pr_offset', type=float, help='Offset of raw pr values without offset metadata', default=PR_OFFSET)
+    args = parser.parse_args()
+
+    tas_paths = args.tas or climatology_paths('tas', args.time_slice, args.model, args.scenario, args.base_dir)
+    pr_paths = args.pr or climatology_paths('pr', args.time_slice, args.model, args.scenario, args.base_dir)
+    if args.model is None:
+        out_path = kg2_historical_path(args.out_dir)
+    else:
+        out_path = kg2_model_path(args.time_slice, args.model, args.scenario, args.out_dir)
+    tiled_classify(tas_paths, pr_paths, out_path, workers=args.workers,
+                   scales=(args.tas_scale, args.tas_offset, args.pr_scale, args.pr_offset))
+    print(f"Classes written to {out_path}")
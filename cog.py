@@ -0,0 +1,55 @@
+import os
+import numpy as np
+from osgeo import gdal, gdal_array
+
+# Writer for uint8 Cloud-Optimized GeoTIFFs: internally tiled, compressed (DEFLATE or ZSTD) and with
+# overviews built by mode resampling, so class and agreement maps stay categorical at every zoom
+# level. GIS tools and later pipeline stages can read any window or zoom level of them cheaply.
+COG_BLOCK_SIZE = 512
+COG_COMPRESS = 'DEFLATE'
+
+
+# Function to pick the overview factors (2, 4, 8, ...) until the smallest level fits in one block
+def overview_factors(width, height, block_size=COG_BLOCK_SIZE):
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+# Function to write a 2-D array as a COG (uint8 by default) with the given geotransform and projection.
+# Uses the COG driver (GDAL >= 3.1) and falls back to a tiled GeoTIFF with copied overviews.
+# Continuous maps (e.g. distances) pass data_type=gdal.GDT_Float32 and resampling='AVERAGE'.
+def write_cog(path, array, geo_transform, projection, nodata=None, compress=COG_COMPRESS, description=None,
+              data_type=gdal.GDT_Byte, resampling='MODE'):
+    array = np.asarray(array, dtype=gdal_array.GDALTypeCodeToNumericTypeCode(data_type))
+    height, width = array.shape
+    memory = gdal.GetDriverByName('MEM').Create('', width, height, 1, data_type)
+    memory.SetGeoTransform(geo_transform)
+    memory.SetProjection(projection)
+    band = memory.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    if description:
+        band.SetDescription(description)
+    band.WriteArray(array)
+
+    if gdal.GetDriverByName('COG') is not None:
+        driver = gdal.GetDriverByName('COG')
+        options = [f'COMPRESS={compress}', f'BLOCKSIZE={COG_BLOCK_SIZE}', 'OVERVIEWS=IGNORE_EXISTING', f'RESAMPLING={resampling}',
+                   'BIGTIFF=IF_SAFER']
+    else:
+        memory.BuildOverviews(resampling, overview_factors(width, height))
+        driver = gdal.GetDriverByName('GTiff')
+        options = [f'COMPRESS={compress}', 'TILED=YES', f'BLOCKXSIZE={COG_BLOCK_SIZE}', f'BLOCKYSIZE={COG_BLOCK_SIZE}',
+                   'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER']
+    tmp_path = f'{path}.{os.getpid()}.tmp.tif'
+    output = driver.CreateCopy(tmp_path, memory, options=options)
+    if output is None:
+        raise RuntimeError(f"Could not write {path}: {gdal.GetLastErrorMsg()}")
+    output.FlushCache()
+    output = None
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,187 @@
+import argparse
+import math
+import numpy as np
+from osgeo import gdal
+from scipy import ndimage
+from koppen_mappings import koppen_mapping_short
+from tile_index import block_classes, class_bits
+from utilities import (EARTH_RADIUS_KM, N_CLASSES, SCENARIOS, TIME_SLICES, bbox_to_window, block_row_area, block_windows,
+                       dataset_path, discover_models, kg2_historical_path, pixel_area_rows, prefetch, read_block, run_jobs,
+                       skip_blocks, window_geo_transform, write_table)
+
+# Displacement of climate zones: for every future pixel of class c the distance in km to the nearest
+# historical pixel of class c (0 where the class stays, e.g. the distance ET retreats upslope or
+# poleward). Computed tile by tile with a Euclidean distance transform over the tile plus a halo of
+# max_km on every side, so the search is not cut off at tile seams; pixels farther from their class
+# than max_km are reported as beyond range. The distances are approximate: the distance transform
+# runs on the pixel grid with one pixel width, the one at the centre of the tile, although the tile
+# and its halo span several degrees of latitude. The pixel it picks is a pixel of the class, but
+# where pixel widths vary across the tile (high latitudes) it need not be the nearest one, and
+# distances can be off by tens of percent there. The distance to the picked pixel is measured with
+# the mean pixel width of the rows in between.
+DISPLACEMENT_MAX_KM = 300.0
+DISPLACEMENT_BIN_KM = 10.0
+# Value written to the maps for pixels whose class is farther than max_km (nodata is NaN)
+BEYOND_RANGE = -1.0
+
+
+# Function to get the north-south size of a pixel in km and its east-west size in each of the given rows
+def pixel_size_km(geo_transform, rows):
+    lat = geo_transform[3] + (np.asarray(rows) + 0.5) * geo_transform[5]
+    dy = EARTH_RADIUS_KM * math.radians(abs(geo_transform[5]))
+    dx = EARTH_RADIUS_KM * math.radians(abs(geo_transform[1])) * np.cos(np.radians(lat))
+    return dy, np.maximum(dx, 1e-6)
+
+
+# Function to get the part of the raster (x0, y0, x1, y1) that holds every pixel within max_km of a tile.
+# The column halo follows the narrowest pixels the halo reaches, so it widens towards the poles.
+def halo_window(geo_transform, block, max_km, width, height):
+    xoff, yoff, xsize, ysize = block
+    dy, _ = pixel_size_km(geo_transform, [yoff])
+    halo_rows = math.ceil(max_km / dy)
+    y0, y1 = max(0, yoff - halo_rows), min(height, yoff + ysize + halo_rows)
+    _, dx = pixel_size_km(geo_transform, np.arange(y0, y1))
+    halo_cols = min(width, math.ceil(max_km / dx.min()))
+    return max(0, xoff - halo_cols), y0, min(width, xoff + xsize + halo_cols), y1
+
+
+# Function to compute the displacement of every future pixel of a tile. historical holds the tile
+# plus its halo starting at pixel origin (x0, y0) of the raster; only classes whose bit is set in
+# class_mask are measured. Returns float32 distances in km (NaN for nodata and other classes,
+# inf beyond max_km).
+def block_displacement(historical, origin, future, block, geo_transform, max_km, class_mask):
+    xoff, yoff, xsize, ysize = block
+    x0, y0 = origin
+    distance = np.full(future.shape, np.nan, dtype=np.float32)
+    dy, dx_rows = pixel_size_km(geo_transform, np.arange(y0, y0 + historical.shape[0]))
+    sampling = (dy, dx_rows[yoff + ysize // 2 - y0])
+    for cat in np.unique(future):
+        if cat <= 0 or cat >= N_CLASSES or not class_mask >> int(cat) & 1:
+            continue
+        rows, cols = np.nonzero(future == cat)
+        source = historical == cat
+        if not source.any():
+            distance[rows, cols] = np.inf
+            continue
+        # Nearest historical pixel of the class for every pixel of the padded tile
+        nearest_rows, nearest_cols = ndimage.distance_transform_edt(~source, sampling=sampling, return_distances=False,
+                                                                    return_indices=True)
+        rows_padded, cols_padded = rows + yoff - y0, cols + xoff - x0
+        target_rows = nearest_rows[rows_padded, cols_padded]
+        target_cols = nearest_cols[rows_padded, cols_padded]
+        north_south = (target_rows - rows_padded) * dy
+        east_west = (target_cols - cols_padded) * dx_rows[(target_rows + rows_padded) // 2]
+        km = np.hypot(north_south, east_west)
+        distance[rows, cols] = np.where(km <= max_km, km, np.inf)
+    return distance
+
+
+# Function to compute the displacement map and the per-class displacement histograms of one model
+# over a window. histogram[c, k] counts the pixels of class c displaced by [k * bin_km, (k + 1) * bin_km),
+# the last column those beyond max_km; with row_area it holds km^2. mean_km[c] is the mean distance
+# of the pixels within max_km. classes limits the classes measured (default: all).
+def tiled_displacement(historical_path, model_path, window, classes=None, max_km=DISPLACEMENT_MAX_KM,
+                       bin_km=DISPLACEMENT_BIN_KM, row_area=None):
+    minx, miny, maxx, maxy = window
+    historical_dataset = gdal.Open(historical_path)
+    future_dataset = gdal.Open(model_path)
+    geo_transform = historical_dataset.GetGeoTransform()
+    width, height = historical_dataset.RasterXSize, historical_dataset.RasterYSize
+    class_mask = class_bits(range(1, N_CLASSES) if classes is None else classes)
+    n_bins = math.ceil(max_km / bin_km)
+    distance_map = np.full((maxy - miny, maxx - minx), np.nan, dtype=np.float32)
+    histogram = np.zeros((N_CLASSES, n_bins + 1))
+    sums = np.zeros(N_CLASSES)
+
+    # Only tiles where the future map holds a measured class are read
+    blocks = skip_blocks(block_windows(historical_dataset, window),
+                         lambda block: block_classes(dataset_path(future_dataset), block) & class_mask)
+
+    def fetch(block):
+        x0, y0, x1, y1 = halo_window(geo_transform, block, max_km, width, height)
+        return read_block(historical_dataset, (x0, y0, x1 - x0, y1 - y0)), (x0, y0), read_block(future_dataset, block)
+
+    for block, (historical, origin, future) in zip(blocks, prefetch(fetch, blocks)):
+        xoff, yoff, xsize, ysize = block
+        distance = block_displacement(historical, origin, future, block, geo_transform, max_km, class_mask)
+        distance_map[yoff - miny:yoff - miny + ysize, xoff - minx:xoff - minx + xsize] = distance
+        measured = ~np.isnan(distance)
+        area = block_row_area(row_area, block, window)
+        weights = None if area is None else np.broadcast_to(area[:, None], distance.shape)[measured]
+        values = distance[measured]
+        finite = ~np.isinf(values)
+        bins = np.full(values.shape, n_bins, dtype=np.intp)
+        bins[finite] = np.minimum(values[finite] // bin_km, n_bins - 1)
+        cats = future[measured].astype(np.intp)
+        histogram += np.bincount(cats * (n_bins + 1) + bins, weights=weights,
+                                 minlength=N_CLASSES * (n_bins + 1)).reshape(N_CLASSES, n_bins + 1)
+        sums += np.bincount(cats[finite], weights=values[finite] if weights is None else values[finite] * weights[finite],
+                            minlength=N_CLASSES)
+    within = histogram[:, :n_bins].sum(axis=1)
+    mean_km = np.divide(sums, within, out=np.full(N_CLASSES, np.nan), where=within > 0)
+    return {'distance': distance_map, 'histogram': histogram, 'mean_km': mean_km}
+
+
+# Function to run one (historical_path, model_path, window, classes, max_km, bin_km, row_area) job in a worker process
+def displacement_job(job):
+    historical_path, model_path, window, classes, max_km, bin_km, row_area = job
+    return tiled_displacement(historical_path, model_path, window, classes=classes, max_km=max_km, bin_km=bin_km,
+                              row_area=row_area)
+
+
+# Function to turn the histograms of several runs into table rows
+# (model, scenario, time_slice, class, bin_start_km, bin_end_km, value); the beyond-range bin has no end
+def histogram_rows(results, bin_km):
+    rows = []
+    for (model, scenario, time_slice), result in results:
+        histogram = result['histogram']
+        n_bins = histogram.shape[1] - 1
+        for cat, k in zip(*np.nonzero(histogram)):
+            end = (k + 1) * bin_km if k < n_bins else ''
+            rows.append((model, scenario, time_slice, koppen_mapping_short[int(cat)].strip(), k * bin_km, end,
+                         histogram[cat, k].item()))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distance each climate zone moves between the historical and the future maps.')
+    parser.add_argument('--scenario', type=str, help='Climate scenario (default: all)', default=None)
+    parser.add_argument('--time_slice', type=str, help='Time slice (default: all)', default=None)
+    parser.add_argument('--bbox', type=float, nargs=4, help='Bounding box (min_lon, min_lat, max_lon, max_lat)', default=[63, 25, 105, 56])
+    parser.add_argument('--classes', type=int, nargs='+', help='Classes to measure (default: all)', default=None)
+    parser.add_argument('--max_km', type=float, help='Largest distance measured; farther pixels are counted as beyond range', default=DISPLACEMENT_MAX_KM)
+    parser.add_argument('--bin_km', type=float, help='Width of the histogram bins in km', default=DISPLACEMENT_BIN_KM)
+    parser.add_argument('--workers', type=int, help='Number of worker processes for the models', default=1)
+    parser.add_argument('--area_weighted', action='store_true', help='Report areas (km^2) instead of grid points')
+    parser.add_argument('--maps', action='store_true', help='Also write the displacement map of every model as a float32 COG')
+    parser.add_argument('--out', type=str, help='Histogram table (.csv or .parquet)', default='displacement_histograms.csv')
+    args = parser.parse_args()
+
+    historical_path = kg2_historical_path()
+    historical_dataset = gdal.Open(historical_path)
+    geo_transform = historical_dataset.GetGeoTransform()
+    window = bbox_to_window(geo_transform, args.bbox)
+    row_area = pixel_area_rows(geo_transform, window[1], window[3] - window[1]) if args.area_weighted else None
+
+    keys, jobs = [], []
+    for scenario in ([args.scenario] if args.scenario else SCENARIOS):
+        for time_slice in ([args.time_slice] if args.time_slice else TIME_SLICES):
+            for model, model_path in discover_models(time_slice, scenario):
+                keys.append((model, scenario, time_slice))
+                jobs.append((historical_path, model_path, window, args.classes, args.max_km, args.bin_km, row_area))
+    results = []
+    for key, result in zip(keys, run_jobs(displacement_job, jobs, args.workers)):
+        model, scenario, time_slice = key
+        if args.maps:
+            from cog import write_cog
+            distance = np.where(np.isinf(result['distance']), BEYOND_RANGE, result['distance'])
+            write_cog(f'displacement_{model}_{time_slice}_{scenario}.tif', distance, window_geo_transform(geo_transform, window),
+                      historical_dataset.GetProjection(), nodata=float('nan'), data_type=gdal.GDT_Float32, resampling='AVERAGE',
+                      description=f'Distance (km) to the nearest historical pixel of the same class, {BEYOND_RANGE:g} beyond {args.max_km:g} km')
+        for cat in np.flatnonzero(np.isfinite(result['mean_km'])):
+            print(f"{model} {scenario} {time_slice} {koppen_mapping_short[cat].strip()}: mean displacement {result['mean_km'][cat]:.1f} km")
+        del result['distance']
+        results.append((key, result))
+    write_table(args.out, ['model', 'scenario', 'time_slice', 'class', 'bin_start_km', 'bin_end_km', 'count'],
+                histogram_rows(results, args.bin_km))
+    print(f"Displacement histograms written to {args.out}")
@@ -0,0 +1,134 @@
+import argparse
+import json
+import math
+import os
+import sys
+import numpy as np
+from osgeo import gdal
+from utilities import (bbox_to_window, block_windows, discover_models, ensemble_transition_stats, kg2_historical_path,
+                       pixel_area_rows, read_block, run_jobs)
+from cache import cache_key
+from zones import (ZONES_DIR, tiled_zonal_agreement, write_zonal_agreement_csv, write_zonal_transitions_csv,
+                   zonal_transition_job)
+
+# Elevation-band (and optionally latitude-band) zones from a local DEM, for the statistics of zones.py.
+# The DEM is resampled once to the kg2 grid (mean of the DEM cells in each pixel) and cached; the
+# bands are then written as a zone raster like the polygon zones, so every model still takes one
+# pass with one bincount per tile over (band, historical, future) codes. Zone 0 holds the pixels
+# without DEM data, and the zones of a model add up to the bbox-wide totals.
+ELEVATION_BANDS_M = [0, 500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000]
+
+
+# Function to resample a DEM (any projection and resolution GDAL reads) to the grid of a raster,
+# cached per DEM and grid. Returns the path of the float32 DEM on the grid (NaN without data).
+def resample_dem(dem_path, grid_path, zones_dir=ZONES_DIR):
+    grid = gdal.Open(grid_path)
+    geo_transform = grid.GetGeoTransform()
+    width, height = grid.RasterXSize, grid.RasterYSize
+    key = cache_key([dem_path], (), kind='dem', geo_transform=list(geo_transform), shape=[height, width])
+    dem_grid_path = os.path.join(zones_dir, f'{key}.dem.tif')
+    if os.path.exists(dem_grid_path):
+        return dem_grid_path
+    os.makedirs(zones_dir, exist_ok=True)
+    bounds = (geo_transform[0], geo_transform[3] + height * geo_transform[5],
+              geo_transform[0] + width * geo_transform[1], geo_transform[3])
+    tmp_path = f'{dem_grid_path}.{os.getpid()}.tmp.tif'
+    gdal.Warp(tmp_path, dem_path, format='GTiff', outputBounds=bounds, width=width, height=height,
+              dstSRS=grid.GetProjection(), resampleAlg='average', outputType=gdal.GDT_Float32, dstNodata=float('nan'),
+              creationOptions=['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER'])
+    os.replace(tmp_path, dem_grid_path)
+    return dem_grid_path
+
+
+# Function to name the zones of the elevation bands (below, between and above band_edges), each
+# split into latitude bands of lat_band_deg degrees when given. Index = zone id.
+def band_names(band_edges, lat_band_deg=None):
+    elevations = [f'<{band_edges[0]:g} m'] + [f'{low:g}-{high:g} m' for low, high in zip(band_edges[:-1], band_edges[1:])] \
+        + [f'>={band_edges[-1]:g} m']
+    if lat_band_deg is None:
+        return ['no DEM'] + elevations
+    hemisphere = lambda lat: f'{abs(lat):g}{"S" if lat < 0 else "N" if lat > 0 else ""}'
+    latitudes = [f'{hemisphere(lat)}-{hemisphere(min(90, lat + lat_band_deg))}'
+                 for lat in np.arange(-90, 90, lat_band_deg).tolist()]
+    return ['no DEM'] + [f'{elevation}, {latitude}' for elevation in elevations for latitude in latitudes]
+
+
+# Function to compute the zone ids of one tile of the resampled DEM whose first row is yoff:
+# 1 + elevation_band * n_latitude_bands + latitude_band, 0 without DEM data
+def block_bands(dem, yoff, geo_transform, band_edges, lat_band_deg=None):
+    bands = np.digitize(dem, band_edges)
+    if lat_band_deg is not None:
+        n_lat = math.ceil(180 / lat_band_deg)
+        lat = geo_transform[3] + (yoff + np.arange(dem.shape[0]) + 0.5) * geo_transform[5]
+        lat_bands = np.clip(np.floor((lat + 90) / lat_band_deg), 0, n_lat - 1).astype(np.intp)
+        bands = bands * n_lat + lat_bands[:, None]
+    return np.where(np.isnan(dem), 0, bands + 1).astype(np.uint16)
+
+
+# Function to build the elevation-band zone raster of a DEM on the grid of a raster, cached per DEM,
+# grid and bands. Returns the path of the uint16 zone raster and the list of zone names, like
+# zones.rasterize_zones.
+def elevation_zones(dem_path, grid_path, band_edges=ELEVATION_BANDS_M, lat_band_deg=None, zones_dir=ZONES_DIR):
+    band_edges = sorted(band_edges)
+    names = band_names(band_edges, lat_band_deg)
+    if len(names) > np.iinfo(np.uint16).max:
+        raise ValueError(f"{len(names) - 1} elevation/latitude bands, at most {np.iinfo(np.uint16).max - 1} are supported")
+    dem_grid_path = resample_dem(dem_path, grid_path, zones_dir)
+    key = cache_key([dem_grid_path], (), kind='elevation_zones', band_edges=band_edges, lat_band_deg=lat_band_deg)
+    zones_path = os.path.join(zones_dir, f'{key}.tif')
+    names_path = os.path.join(zones_dir, f'{key}.json')
+    if os.path.exists(zones_path) and os.path.exists(names_path):
+        return zones_path, names
+
+    dem_dataset = gdal.Open(dem_grid_path)
+    geo_transform = dem_dataset.GetGeoTransform()
+    width, height = dem_dataset.RasterXSize, dem_dataset.RasterYSize
+    tmp_path = f'{zones_path}.{os.getpid()}.tmp.tif'
+    zones = gdal.GetDriverByName('GTiff').Create(tmp_path, width, height, 1, gdal.GDT_UInt16,
+                                                 options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    zones.SetGeoTransform(geo_transform)
+    zones.SetProjection(dem_dataset.GetProjection())
+    band = zones.GetRasterBand(1)
+    for xoff, yoff, xsize, ysize in block_windows(dem_dataset, (0, 0, width, height)):
+        dem = read_block(dem_dataset, (xoff, yoff, xsize, ysize))
+        band.WriteArray(block_bands(dem, yoff, geo_transform, band_edges, lat_band_deg), xoff, yoff)
+    zones.FlushCache()
+    zones = None
+    os.replace(tmp_path, zones_path)
+    with open(names_path, 'w') as f:
+        json.dump(names, f)
+    return zones_path, names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transition and agreement statistics stratified by elevation (and latitude) band.')
+    parser.add_argument('dem', type=str, help='Local DEM (any projection and resolution GDAL can read), in m')
+    parser.add_argument('--bands', type=float, nargs='+', help='Edges of the elevation bands in m', default=ELEVATION_BANDS_M)
+    parser.add_argument('--lat_band', type=float, help='Also split the elevation bands into latitude bands of this many degrees', default=None)
+    parser.add_argument('--scenario', type=str, help='Climate scenario', default='ssp585')
+    parser.add_argument('--time_slice', type=str, help='Time slice', default='2071-2100')
+    parser.add_argument('--target_cat', type=int, help='Category of the migrations and the agreement', default=30)
+    parser.add_argument('--bbox', type=float, nargs=4, help='Bounding box (min_lon, min_lat, max_lon, max_lat)', default=[63, 25, 105, 56])
+    parser.add_argument('--workers', type=int, help='Number of worker processes for the models', default=1)
+    parser.add_argument('--area_weighted', action='store_true', help='Report areas (km^2) instead of grid points')
+    args = parser.parse_args()
+
+    historical_path = kg2_historical_path()
+    models = discover_models(args.time_slice, args.scenario)
+    if not models:
+        sys.exit(f"No models found for {args.scenario} {args.time_slice}")
+    model_paths = [path for _, path in models]
+    zones_path, names = elevation_zones(args.dem, historical_path, args.bands, args.lat_band)
+    geo_transform = gdal.Open(historical_path).GetGeoTransform()
+    window = bbox_to_window(geo_transform, args.bbox)
+    row_area = pixel_area_rows(geo_transform, window[1], window[3] - window[1]) if args.area_weighted else None
+    n_zones = len(names)
+
+    jobs = [(zones_path, historical_path, model_path, window, n_zones, [args.target_cat], gdal.Open, row_area)
+            for model_path in model_paths]
+    mean_matrices, std_matrices = ensemble_transition_stats(run_jobs(zonal_transition_job, jobs, args.workers))
+    tag = f'{args.target_cat}_{args.time_slice}_{args.scenario}'
+    write_zonal_transitions_csv(mean_matrices, std_matrices, names, f'elevation_migrations_{tag}.csv')
+    result = tiled_zonal_agreement(zones_path, historical_path, model_paths, window, n_zones, args.target_cat, row_area=row_area)
+    write_zonal_agreement_csv(result, names, [model for model, _ in models], f'elevation_agreement_{tag}.csv')
+    print(f"Statistics for {n_zones - 1} bands written to elevation_migrations_{tag}.csv and elevation_agreement_{tag}.csv")
@@ -0,0 +1,122 @@
+import math
+import numpy as np
+
+# Streaming ensemble statistics. Members (models) are added one at a time and folded into running
+# accumulators, so memory depends on the shape of one member (a transition matrix, a map) and not on
+# the number of members: 5 or 50 CMIP6 models cost the same. RunningStats keeps the count, the
+# Welford mean/variance and the min/max per element; QuantileSketch keeps a log-bucket histogram
+# per element (relative error SKETCH_ACCURACY) for medians and percentiles.
+SKETCH_ACCURACY = 0.01
+# Values at or below SKETCH_MIN_VALUE (including zero) fall into the first bucket and read back as 0;
+# values above SKETCH_MAX_VALUE are clipped into the last bucket
+SKETCH_MIN_VALUE = 1e-3
+SKETCH_MAX_VALUE = 1e12
+
+
+# Per-element quantile sketch of non-negative values (transition counts, areas). Bucket i holds
+# the values in (gamma**(i-1), gamma**i], so every quantile is within SKETCH_ACCURACY of a member value.
+class QuantileSketch:
+    def __init__(self, shape, accuracy=SKETCH_ACCURACY, min_value=SKETCH_MIN_VALUE, max_value=SKETCH_MAX_VALUE):
+        self.shape = tuple(shape)
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.offset = math.floor(math.log(min_value) / self.log_gamma)
+        n_buckets = math.ceil(math.log(max_value) / self.log_gamma) - self.offset + 1
+        self.counts = np.zeros((int(np.prod(self.shape)), n_buckets), dtype=np.uint32)
+
+    # Function to add one member to the sketch
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        buckets = np.ceil(np.log(np.maximum(values, self.min_value)) / self.log_gamma) - self.offset
+        buckets = np.where(values > self.min_value, np.clip(buckets, 1, self.counts.shape[1] - 1), 0).astype(np.intp)
+        self.counts[np.arange(values.size), buckets] += 1
+
+    # Function to fold another sketch of the same shape into this one (e.g. from a worker process)
+    def merge(self, other):
+        self.counts += other.counts
+
+    # Function to get the q-quantile (0 <= q <= 1) of every element
+    def quantile(self, q):
+        cumulative = np.cumsum(self.counts, axis=1)
+        rank = q * (cumulative[:, -1] - 1)
+        buckets = np.argmax(cumulative > rank[:, None], axis=1)
+        values = 2 * self.gamma ** (buckets + self.offset) / (self.gamma + 1)
+        return np.where(buckets == 0, 0.0, values).reshape(self.shape)
+
+
+# Running count, mean, variance (Welford), min and max of the members added so far, per element.
+# With quantiles=True a QuantileSketch is kept as well (it costs one bucket row per element, so it
+# is meant for transition matrices rather than full-resolution maps).
+class RunningStats:
+    def __init__(self, quantiles=False):
+        self.quantiles = quantiles
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.sketch = None
+
+    # Function to add one member
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.count == 0:
+            self.mean = np.zeros(values.shape)
+            self.m2 = np.zeros(values.shape)
+            self.min = values.copy()
+            self.max = values.copy()
+            if self.quantiles:
+                self.sketch = QuantileSketch(values.shape)
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+        np.minimum(self.min, values, out=self.min)
+        np.maximum(self.max, values, out=self.max)
+        if self.sketch is not None:
+            self.sketch.add(values)
+        return self
+
+    # Function to fold the statistics of another accumulator into this one (Chan et al. pairwise update)
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            self.min, self.max = other.min.copy(), other.max.copy()
+            self.sketch = other.sketch
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        return self
+
+    # Function to get the variance; ddof=0 matches np.var/np.std over the stacked members
+    def variance(self, ddof=0):
+        return self.m2 / max(self.count - ddof, 1)
+
+    # Function to get the standard deviation
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+    # Function to get the q-quantile of every element (needs quantiles=True)
+    def quantile(self, q):
+        if self.sketch is None:
+            raise ValueError("RunningStats was created without quantiles=True")
+        return self.sketch.quantile(q)
+
+
+# Function to reduce an iterable of members (e.g. a generator of per-model transition matrices)
+# to a RunningStats without holding more than one member at a time
+def stream_stats(members, quantiles=False):
+    stats = RunningStats(quantiles=quantiles)
+    for member in members:
+        stats.add(member)
+    return stats
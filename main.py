@@ -1,13 +1,12 @@
 import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 from osgeo import gdal
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import koppen_mappings
-from matplotlib.colors import ListedColormap
-from utilities import world_to_pixel  # Ensure this function is defined in your utilities module
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+import utilities
+import profiling
+from utilities import (changed_layer, discover_models, kg2_historical_path, pixel_area_rows, prefetch_report, tiled_agreement,
+                       tiled_agreement_cube, window_geo_transform, world_to_pixel, write_table)
+from cache import cached_agreement, cached_agreement_cube, shared_baseline
+from cog import write_cog
 
 # Setup command line arguments
 parser = argparse.ArgumentParser(description='Process climate data.')
@@ -15,84 +14,143 @@ parser.add_argument('--scenario', type=str, help='Climate scenario', default=Non
 parser.add_argument('--time_slice', type=str, help='Time slice', default=None)
 parser.add_argument('--target_cat', type=int, help='Target category', default=30)
 parser.add_argument('--bbox', type=float, nargs=4, help='Bounding box (min_lon, min_lat, max_lon, max_lat)', default=[63, 25, 105, 56])
+parser.add_argument('--workers', type=int, help='Number of worker processes for the tiles', default=1)
+parser.add_argument('--no_cache', action='store_true', help='Do not read from or write to the on-disk cache')
+parser.add_argument('--all_classes', action='store_true', help='Plot the agreement for every class and the modal class from a single pass')
+parser.add_argument('--prefetch', type=int, help='Number of tiles read ahead in the background (0 disables prefetching)', default=2)
+parser.add_argument('--report', type=str, help='Write the stage timings to this .json or .csv file', default=None)
+parser.add_argument('--profile', action='store_true', help='Run under cProfile and write main.prof')
+parser.add_argument('--area_weighted', action='store_true', help='Report the agreement counts as area (km^2) instead of grid points')
+parser.add_argument('--no_plot', action='store_true', help='Only compute the statistics and write them to stats_* files (no cartopy/matplotlib needed)')
+parser.add_argument('--from_stats', action='store_true', help='Render the figures from the stats_* files of an earlier --no_plot run')
+parser.add_argument('--cog', action='store_true', help='Also write the agreement (and with --all_classes the modal class and change) maps as Cloud-Optimized GeoTIFFs')
+parser.add_argument('--compress', type=str, choices=['DEFLATE', 'ZSTD'], help='Compression of the GeoTIFFs written with --cog', default='DEFLATE')
+parser.add_argument('--render_workers', type=int, help='Number of worker processes drawing the figures while the next statistics are computed', default=1)
+parser.add_argument('--stats_format', type=str, choices=['csv', 'parquet'], help='Format of the stats tables written with --no_plot', default='csv')
 args = parser.parse_args()
+utilities.PREFETCH_DEPTH = args.prefetch
+
+# Function to write the statistics of one scenario and time slice: the arrays to stats_name.npz (read
+# back by --from_stats) and the counts to a stats_name.csv or .parquet table
+def write_stats(stats_name, result, model_names, stats_format='csv'):
+    np.savez_compressed(f'{stats_name}.npz', model_names=np.array(model_names), **result)
+    counts = result['counts']
+    if counts.ndim == 1:
+        rows = [(name, count) for name, count in zip(model_names, counts.tolist())]
+        write_table(f'{stats_name}.{stats_format}', ['model', 'count'], rows)
+    else:
+        rows = [(model_names[k], cat, counts[k, cat].item()) for k, cat in zip(*np.nonzero(counts))]
+        write_table(f'{stats_name}.{stats_format}', ['model', 'class', 'count'], rows)
+
+
+# Function to load the arrays written by write_stats
+def load_stats(stats_name):
+    with np.load(f'{stats_name}.npz') as stored:
+        return {name: stored[name] for name in stored.files}
+
 
 # If arguments are not provided, use these default lists
 scenarios = ['ssp126', 'ssp370', 'ssp585'] if args.scenario is None else [args.scenario]
 time_slices = ['2011-2040', '2041-2070', '2071-2100'] if args.time_slice is None else [args.time_slice]
 
-# Loop over scenarios and time slices
-for scenario in scenarios:
-    for time_slice in time_slices:
-        print(f"Processing {scenario} for {time_slice}...")
-
-        historical_dataset_path = '/p/projects/gvca/data/chelsa_cmip6/envicloud/chelsa/chelsa_V2/GLOBAL/climatologies/1981-2010/bio/CHELSA_kg2_1981-2010_V.2.1.tif'  # Update this path
+profiling.start_profile(args.profile)
+if not args.no_plot:
+    # Plotting libraries are only imported when figures are drawn; the base map of the bbox is
+    # loaded once here and shared by the render workers
+    from plots import agreement_for_display, modal_for_display
+    from render import RenderFarm
+    farm = RenderFarm(args.render_workers)
+    farm.warm(args.bbox)
+# Open the historical baseline once for all scenarios and time slices
+if not args.from_stats:
+    with profiling.stage('open', model='historical'):
+        historical_dataset_path = kg2_historical_path()
         historical_dataset = gdal.Open(historical_dataset_path)
         geo_transform = historical_dataset.GetGeoTransform()
         minx, maxy = world_to_pixel(geo_transform, args.bbox[0], args.bbox[1])
         maxx, miny = world_to_pixel(geo_transform, args.bbox[2], args.bbox[3])
-        historical_array = historical_dataset.ReadAsArray(minx, miny, maxx - minx, maxy - miny)
-        historical_ET_mask = (historical_array == args.target_cat)
-
-        agreement_array = np.zeros(historical_array.shape)
-        model_agreements = [np.sum(historical_ET_mask)]  # Store the agreement counts here
-        model_names = ['historical','GFDL-ESM4', 'IPSL-CM6A-LR', 'MPI-ESM1-2-HR', 'MRI-ESM2-0', 'UKESM1-0-LL']
-        
-        # List of model paths for the time-slice
-        dir_models = f'/p/projects/gvca/data/chelsa_cmip6/envicloud/chelsa/chelsa_V2/GLOBAL/climatologies/{time_slice}/'
-        model_paths = [
-            f'{dir_models}GFDL-ESM4/{scenario}/bio/CHELSA_kg2_{time_slice}_gfdl-esm4_{scenario}_V.2.1.tif',
-            f'{dir_models}IPSL-CM6A-LR/{scenario}/bio/CHELSA_kg2_{time_slice}_ipsl-cm6a-lr_{scenario}_V.2.1.tif',
-            f'{dir_models}MPI-ESM1-2-HR/{scenario}/bio/CHELSA_kg2_{time_slice}_mpi-esm1-2-hr_{scenario}_V.2.1.tif',
-            f'{dir_models}MRI-ESM2-0/{scenario}/bio/CHELSA_kg2_{time_slice}_mri-esm2-0_{scenario}_V.2.1.tif',
-            f'{dir_models}UKESM1-0-LL/{scenario}/bio/CHELSA_kg2_{time_slice}_ukesm1-0-ll_{scenario}_V.2.1.tif'
-        ]
-        # Process each model
-        for model_path in model_paths:
-            dataset = gdal.Open(model_path)
-            model_array = dataset.ReadAsArray(minx, miny, maxx - minx, maxy - miny)
-            is_cat = model_array == args.target_cat
+        window = (minx, miny, maxx, maxy)
+        # Pixel area per row of the window, computed once from the geotransform
+        row_area = pixel_area_rows(geo_transform, miny, maxy - miny) if args.area_weighted else None
+        if not args.no_cache:
+            # Memory-map the baseline window (and the target class mask) once; every scenario,
+            # time slice and worker process attaches to the same pages
+            shared_baseline(historical_dataset_path, window, [] if args.all_classes else [args.target_cat])
 
-            # Update the agreement counter
-            agreement_array += is_cat
-            model_agreements.append(np.sum(is_cat))
-
-        # Plotting
-        fig, ax = plt.subplots(figsize=(10, 10), subplot_kw={'projection': ccrs.PlateCarree()})
-        extent = [args.bbox[0], args.bbox[2], args.bbox[1], args.bbox[3]]
-        cmap = ListedColormap(['#FFFFFF00', '#5555FF', '#AAAAFF', '#FFAAAA', '#FF5555', '#FF0000'])
-
-        # Plot historical "ET" category
-        ax.imshow(historical_ET_mask.astype(int), cmap=ListedColormap(['#FFFFFF', '#98FB98']), interpolation='nearest', extent=extent, aspect='equal')
-        cax = ax.imshow(agreement_array, cmap=cmap, interpolation='nearest', extent=extent, vmin=0, vmax=len(model_paths), aspect='equal')
-
-        # Add map features
-        ax.coastlines(linewidth=.5)
-        ax.add_feature(cfeature.BORDERS, linewidth=.5)
-
-        plt.xlabel('Longitude Index')
-        plt.ylabel('Latitude Index')
-
-        # Colorbar
-        cbar_ax = fig.add_axes([0.93, 0.3, 0.03, 0.39])
-        cbar = fig.colorbar(cax, cax=cbar_ax)
-        cbar.set_label(f'Number of Models Agreeing on the {koppen_mappings.koppen_mapping_short[args.target_cat]}')
-
-        # Gridlines
-        gl = ax.gridlines(draw_labels=True, linewidth=1, color='gray', alpha=0.1, linestyle='--')
-        gl.top_labels = False
-        gl.right_labels = False
+# Loop over scenarios and time slices
+for scenario in scenarios:
+    for time_slice in time_slices:
+        print(f"Processing {scenario} for {time_slice}...")
 
-        # Inset for the bar chart
-        axins = inset_axes(ax, width="30%", height="20%", loc='upper left', bbox_to_anchor=(0.15, 0.12, 1, .8), bbox_transform=ax.transAxes)
-        # Define colors for each bar: one for historical and one for each model 
-        colors = ['#98FB98']  # Color for the historical bar
-        model_colors = ['skyblue'] * len(model_paths)  # Same color for all model bars
-        all_colors = colors + model_colors  # Combine the colors
-        axins.barh(model_names, model_agreements, color=all_colors)
-        axins.set_xlabel('Grid Points')
-#        axins.set_title('Köppen Category Agreement')
+        stats_name = f'stats_all_{time_slice}_{scenario}' if args.all_classes else f'stats_{args.target_cat}_{time_slice}_{scenario}'
 
-        plt.savefig(f'figure_{args.target_cat}_{time_slice}_{scenario}.png', format='png', dpi=300, bbox_inches='tight')
-        plt.close()
+        if args.from_stats:
+            with profiling.stage('open', scenario, time_slice):
+                result = load_stats(stats_name)
+                model_names = [str(name) for name in result.pop('model_names')]
+        else:
+            # Every model with a kg2 map for the time slice and scenario
+            models = discover_models(time_slice, scenario)
+            if not models:
+                print(f"No models found for {scenario} {time_slice}")
+                continue
+            model_names = ['historical'] + [model for model, _ in models]
+            model_paths = [path for _, path in models]
+            model_keys = [(scenario, time_slice, model, path) for model, path in models]
+            if args.all_classes:
+                # Read every model once and build the agreement for all classes
+                with profiling.stage('count', scenario, time_slice, 'ensemble', model_keys):
+                    if args.no_cache:
+                        result = tiled_agreement_cube(historical_dataset_path, model_paths, window, workers=args.workers, row_area=row_area)
+                    else:
+                        result = cached_agreement_cube(historical_dataset_path, model_paths, window, workers=args.workers, row_area=row_area)
+            else:
+                # Stream the historical map and every model tile by tile and count the agreement
+                with profiling.stage('count', scenario, time_slice, 'ensemble', model_keys):
+                    if args.no_cache:
+                        agreement_array, historical_ET_mask, model_agreements = tiled_agreement(historical_dataset_path, model_paths, window, args.target_cat, workers=args.workers, row_area=row_area)
+                    else:
+                        agreement_array, historical_ET_mask, model_agreements = cached_agreement(historical_dataset_path, model_paths, window, args.target_cat, workers=args.workers, row_area=row_area)
+                result = {'agreement': agreement_array, 'historical_mask': historical_ET_mask, 'counts': model_agreements}
+            if args.cog:
+                # Keep the maps as uint8 COGs on the grid of the window
+                with profiling.stage('write', scenario, time_slice):
+                    cog_transform = window_geo_transform(geo_transform, window)
+                    projection = historical_dataset.GetProjection()
+                    if args.all_classes:
+                        write_cog(f'modal_class_{time_slice}_{scenario}.tif', result['modal_class'], cog_transform, projection,
+                                  nodata=0, compress=args.compress, description='Modal future Koppen class')
+                        write_cog(f'modal_agreement_{time_slice}_{scenario}.tif', result['modal_agreement'], cog_transform, projection,
+                                  compress=args.compress, description='Number of models agreeing on the modal class')
+                        write_cog(f'changed_{time_slice}_{scenario}.tif', changed_layer(result['historical'], result['modal_class']),
+                                  cog_transform, projection, nodata=0, compress=args.compress,
+                                  description='1 unchanged, 2 changed (historical vs modal future class)')
+                    else:
+                        write_cog(f'agreement_{args.target_cat}_{time_slice}_{scenario}.tif', result['agreement'], cog_transform, projection,
+                                  compress=args.compress, description=f'Number of models in class {args.target_cat}')
+            if args.no_plot:
+                with profiling.stage('write', scenario, time_slice):
+                    write_stats(stats_name, result, model_names, args.stats_format)
 
+        if not args.no_plot:
+            # Queue the figures; the render workers draw them while the next scenario is counted. The
+            # maps are reduced to the display resolution here, so only those are sent to the workers.
+            with profiling.stage('render', scenario, time_slice):
+                if args.all_classes:
+                    counts = result['counts']
+                    for cat in np.flatnonzero(counts.sum(axis=0)):
+                        agreement, mask = agreement_for_display(result['cube'][cat], result['historical'] == cat)
+                        farm.submit('plot_agreement', agreement, mask, counts[:, cat], model_names, cat,
+                                    args.bbox, f'figure_{cat}_{time_slice}_{scenario}.png', area_weighted=args.area_weighted)
+                    farm.submit('plot_modal', *modal_for_display(result['modal_class'], result['modal_agreement']),
+                                len(model_names) - 1, args.bbox, f'figure_modal_{time_slice}_{scenario}.png')
+                else:
+                    agreement, mask = agreement_for_display(result['agreement'], result['historical_mask'])
+                    farm.submit('plot_agreement', agreement, mask, result['counts'], model_names,
+                                args.target_cat, args.bbox, f'figure_{args.target_cat}_{time_slice}_{scenario}.png',
+                                area_weighted=args.area_weighted)
+        print(f"Reading {scenario} {time_slice}: {prefetch_report()}")
+if not args.no_plot:
+    with profiling.stage('render'):
+        print(f"{farm.close()} figures drawn")
+profiling.finish(args.report, 'main.prof' if args.profile else None)
@@ -0,0 +1,235 @@
+import argparse
+import numpy as np
+from osgeo import gdal
+from scipy import ndimage
+from koppen_mappings import koppen_mapping_short
+from tile_index import block_classes, class_bits
+from utilities import (N_CLASSES, SCENARIOS, TIME_SLICES, bbox_to_window, block_row_area, block_windows, dataset_path,
+                       discover_models, kg2_historical_path, pixel_area_rows, prefetch, read_block, run_jobs, skip_blocks,
+                       transition_matrix, write_table)
+
+# Patch (connected region) analysis of kg2 maps, to see whether a zone such as ET breaks up into
+# isolated patches and not only how much area it loses. Every tile is labelled per class with
+# scipy.ndimage.label and only the label areas and the four edges of the tile are kept; after
+# the pass the labels that touch across tile seams are merged with a union-find, so patches
+# spanning any number of tiles (up to global rasters) come out whole from one streaming pass.
+PATCH_CONNECTIVITY = 8
+
+
+# Union-find over integer labels with path halving and union by size
+class UnionFind:
+    def __init__(self, n):
+        self.parent = np.arange(n)
+        self.size = np.ones(n, dtype=np.int64)
+
+    # Function to find the root of a label
+    def find(self, a):
+        parent = self.parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    # Function to merge the sets of two labels
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    # Function to get the root of every label (pointer jumping over the whole forest)
+    def roots(self):
+        parent = self.parent.copy()
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent
+            parent = grandparent
+
+
+# Streaming patch labeller for one raster. Feed it every tile of a window with add(); tiles that
+# are never added count as empty. patch_stats() merges the labels across the seams and returns
+# the statistics per class.
+class PatchAccumulator:
+    def __init__(self, window, classes=None, connectivity=PATCH_CONNECTIVITY):
+        self.window = window
+        self.class_mask = class_bits(range(1, N_CLASSES) if classes is None else classes)
+        self.structure = np.ones((3, 3), dtype=bool) if connectivity == 8 else None
+        self.connectivity = connectivity
+        self.areas = [np.zeros(1)]  # label 0 is background
+        self.label_classes = [np.zeros(1, dtype=np.intp)]
+        self.n_labels = 1
+        self.edges = {}
+
+    # Function to label the classes of one tile (xoff, yoff, xsize, ysize); row_area weights by pixel area
+    def add(self, block, classes, row_area=None):
+        labels = np.zeros(classes.shape, dtype=np.int64)
+        weights = None if row_area is None else np.broadcast_to(np.asarray(row_area)[:, None], classes.shape)
+        for cat in np.unique(classes):
+            if cat <= 0 or cat >= N_CLASSES or not self.class_mask >> int(cat) & 1:
+                continue
+            tile_labels, n = ndimage.label(classes == cat, structure=self.structure)
+            in_class = tile_labels > 0
+            labels[in_class] = tile_labels[in_class] + (self.n_labels - 1)
+            area = np.bincount(tile_labels.ravel(), weights=None if weights is None else weights.ravel(), minlength=n + 1)
+            self.areas.append(area[1:].astype(np.float64))
+            self.label_classes.append(np.full(n, cat, dtype=np.intp))
+            self.n_labels += n
+        self.edges[block] = (labels[0].copy(), labels[-1].copy(), labels[:, 0].copy(), labels[:, -1].copy())
+
+    # Function to assemble the lines on both sides of every seam at the given offsets (rows for
+    # horizontal seams, columns for vertical ones) as full-length arrays of global labels
+    def _seam_lines(self, vertical):
+        minx, miny, maxx, maxy = self.window
+        start, length = (minx, maxy - miny) if vertical else (miny, maxx - minx)
+        before, after = {}, {}
+        for (xoff, yoff, xsize, ysize), (top, bottom, left, right) in self.edges.items():
+            offset, size, along, first, last = ((xoff, xsize, yoff - miny, left, right) if vertical
+                                                else (yoff, ysize, xoff - minx, top, bottom))
+            if offset > start:
+                after.setdefault(offset, np.zeros(length, dtype=np.int64))[along:along + len(first)] = first
+            before.setdefault(offset + size, np.zeros(length, dtype=np.int64))[along:along + len(last)] = last
+        return [(before[seam], after[seam]) for seam in after if seam in before]
+
+    # Function to collect the pairs of labels of the same class that touch across the seams
+    def _seam_pairs(self):
+        label_classes = np.concatenate(self.label_classes)
+        shifts = [-1, 0, 1] if self.connectivity == 8 else [0]
+        pairs = []
+        for vertical in (False, True):
+            for before, after in self._seam_lines(vertical):
+                for shift in shifts:
+                    a = before[max(0, -shift):len(before) - max(0, shift)]
+                    b = after[max(0, shift):len(after) - max(0, -shift)]
+                    touching = (a > 0) & (b > 0)
+                    touching[touching] = label_classes[a[touching]] == label_classes[b[touching]]
+                    pairs.append(np.stack([a[touching], b[touching]], axis=1))
+        return np.unique(np.concatenate(pairs), axis=0) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+    # Function to merge the labels across the seams and summarise the patches of every class:
+    # {class: {'patches', 'area', 'largest', 'largest_share', 'mean_size', 'sizes'}} where sizes
+    # are the areas of all patches of the class, largest first
+    def patch_stats(self):
+        union_find = UnionFind(self.n_labels)
+        for a, b in self._seam_pairs():
+            union_find.union(a, b)
+        roots = union_find.roots()
+        areas = np.bincount(roots, weights=np.concatenate(self.areas), minlength=self.n_labels)
+        label_classes = np.concatenate(self.label_classes)
+        is_root = (roots == np.arange(self.n_labels)) & (label_classes > 0)
+        stats = {}
+        for cat in np.unique(label_classes[is_root]):
+            sizes = np.sort(areas[is_root & (label_classes == cat)])[::-1]
+            total = sizes.sum()
+            stats[int(cat)] = {'patches': len(sizes), 'area': total, 'largest': sizes[0],
+                               'largest_share': sizes[0] / total if total > 0 else 0.0,
+                               'mean_size': total / len(sizes), 'sizes': sizes}
+        return stats
+
+
+# Function to label the patches of one raster over a window in a single tiled pass
+def tiled_patches(path, window, classes=None, connectivity=PATCH_CONNECTIVITY, row_area=None, open_dataset=gdal.Open):
+    dataset = open_dataset(path)
+    patches = PatchAccumulator(window, classes=classes, connectivity=connectivity)
+    blocks = skip_blocks(block_windows(dataset, window), lambda block: block_classes(path, block) & patches.class_mask)
+    for block, classes_block in zip(blocks, prefetch(lambda block: read_block(dataset, block), blocks)):
+        patches.add(block, classes_block, row_area=block_row_area(row_area, block, window))
+    return patches.patch_stats()
+
+
+# Function to run one (path, window, classes, connectivity, row_area) raster in a worker process
+def patches_job(job):
+    path, window, classes, connectivity, row_area = job
+    return tiled_patches(path, window, classes=classes, connectivity=connectivity, row_area=row_area)
+
+
+# Function to count the transitions between two datasets and label the patches of both in the same
+# tiled pass (see utilities.tiled_transition_matrix). Returns the matrix and the patch statistics of
+# the future map, and of the historical map when historical_patches is set (else None).
+def tiled_transitions_patches(historical_dataset, future_dataset, window, source_classes=None, patch_classes=None,
+                              connectivity=PATCH_CONNECTIVITY, row_area=None, historical_patches=True):
+    matrix = np.zeros((N_CLASSES, N_CLASSES), dtype=np.int64 if row_area is None else np.float64)
+    future_patches = PatchAccumulator(window, classes=patch_classes, connectivity=connectivity)
+    past_patches = PatchAccumulator(window, classes=patch_classes, connectivity=connectivity) if historical_patches else None
+    historical_path, future_path = dataset_path(historical_dataset), dataset_path(future_dataset)
+    source_bits = class_bits(range(1, N_CLASSES) if source_classes is None else source_classes)
+    patch_bits = future_patches.class_mask
+    # Tiles are read for the transitions (as in tiled_transition_matrix) or for the patches
+    blocks = skip_blocks(block_windows(historical_dataset, window),
+                         lambda block: (block_classes(historical_path, block) & source_bits and block_classes(future_path, block))
+                         or (block_classes(future_path, block) & patch_bits)
+                         or (historical_patches and block_classes(historical_path, block) & patch_bits))
+    fetch = lambda block: (read_block(historical_dataset, block), read_block(future_dataset, block))
+    for block, (historical, future) in zip(blocks, prefetch(fetch, blocks)):
+        area = block_row_area(row_area, block, window)
+        matrix += transition_matrix(historical, future, source_classes=source_classes, row_area=area)
+        future_patches.add(block, future, row_area=area)
+        if past_patches is not None:
+            past_patches.add(block, historical, row_area=area)
+    return matrix, future_patches.patch_stats(), None if past_patches is None else past_patches.patch_stats()
+
+
+# Function to run one (historical_path, model_path, window, source_classes, patch_classes, open_dataset,
+# row_area, historical_patches) job in a worker process
+def transition_patches_job(job):
+    historical_path, model_path, window, source_classes, patch_classes, open_dataset, row_area, historical_patches = job
+    return tiled_transitions_patches(open_dataset(historical_path), open_dataset(model_path), window, source_classes=source_classes,
+                                     patch_classes=patch_classes, row_area=row_area, historical_patches=historical_patches)
+
+
+# Function to turn patch statistics into summary rows (name, class, patches, area, largest, largest_share,
+# mean_size) and size distribution rows (name, class, size_min, size_max, patches) with power-of-two size bins
+def patch_rows(named_stats):
+    summary, distribution = [], []
+    for name, stats in named_stats:
+        for cat, patch in sorted(stats.items()):
+            label = koppen_mapping_short[cat].strip()
+            summary.append((name, label, patch['patches'], float(patch['area']), float(patch['largest']),
+                            float(patch['largest_share']), float(patch['mean_size'])))
+            bins = np.floor(np.log2(np.maximum(patch['sizes'], 1))).astype(np.intp)
+            for k, n in enumerate(np.bincount(bins)):
+                if n:
+                    distribution.append((name, label, 2 ** k, 2 ** (k + 1), int(n)))
+    return summary, distribution
+
+
+# Function to write the tables of patch_rows next to each other (<out>_summary.csv, <out>_sizes.csv)
+def write_patch_tables(named_stats, out, stats_format='csv'):
+    summary, distribution = patch_rows(named_stats)
+    write_table(f'{out}_summary.{stats_format}', ['name', 'class', 'patches', 'area', 'largest', 'largest_share', 'mean_size'], summary)
+    write_table(f'{out}_sizes.{stats_format}', ['name', 'class', 'size_min', 'size_max', 'patches'], distribution)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Patch counts, size distributions and largest-patch shares per Koppen class.')
+    parser.add_argument('--scenario', type=str, help='Climate scenario (default: all)', default=None)
+    parser.add_argument('--time_slice', type=str, help='Time slice (default: all)', default=None)
+    parser.add_argument('--bbox', type=float, nargs=4, help='Bounding box (min_lon, min_lat, max_lon, max_lat)', default=[4.5, 43.5, 16, 50])
+    parser.add_argument('--classes', type=int, nargs='+', help='Classes to label (default: all)', default=None)
+    parser.add_argument('--connectivity', type=int, choices=[4, 8], help='Pixel connectivity of a patch', default=PATCH_CONNECTIVITY)
+    parser.add_argument('--workers', type=int, help='Number of worker processes for the models', default=1)
+    parser.add_argument('--area_weighted', action='store_true', help='Patch sizes in km^2 instead of grid points')
+    parser.add_argument('--out', type=str, help='Prefix of the output tables', default='patches')
+    args = parser.parse_args()
+
+    historical_path = kg2_historical_path()
+    geo_transform = gdal.Open(historical_path).GetGeoTransform()
+    window = bbox_to_window(geo_transform, args.bbox)
+    row_area = pixel_area_rows(geo_transform, window[1], window[3] - window[1]) if args.area_weighted else None
+
+    named_stats = [('historical', tiled_patches(historical_path, window, classes=args.classes, connectivity=args.connectivity,
+                                                row_area=row_area))]
+    keys, jobs = [], []
+    for scenario in ([args.scenario] if args.scenario else SCENARIOS):
+        for time_slice in ([args.time_slice] if args.time_slice else TIME_SLICES):
+            for model, model_path in discover_models(time_slice, scenario):
+                keys.append(f'{model}_{scenario}_{time_slice}')
+                jobs.append((model_path, window, args.classes, args.connectivity, row_area))
+    named_stats += zip(keys, run_jobs(patches_job, jobs, args.workers))
+    write_patch_tables(named_stats, args.out)
+    for name, stats in named_stats:
+        for cat, patch in sorted(stats.items()):
+            print(f"{name} {koppen_mapping_short[cat].strip()}: {patch['patches']} patches, largest {patch['largest_share']:.0%}")
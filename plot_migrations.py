@@ -1,9 +1,13 @@
-import numpy as np
-import matplotlib.pyplot as plt
 from osgeo import gdal
-import matplotlib.patches as mpatches
-import pickle
 import os 
+import sys
+from utilities import changes_dict, discover_models, ensemble_transition_stats, transition_job, run_jobs, pixel_area_rows
+from ensemble import RunningStats
+from cache import cached_transition_matrices
+from results_store import bbox_region, count_unit, has_transitions, read_transitions, transitions_signature, write_each
+from bbox_index import query_transitions
+from charts import plot_migrations_bar
+import profiling
 #      -----------------------------------
 #              N A M E  L I S T
 # Number of top migrations to display
@@ -18,6 +22,16 @@ time_slice='2071-2100'
 #time_slice='2011-2040'
 #time_slice='2041-2070'
 bbox = [45, 34, 90, 56] #Central Asia
+workers = int(os.environ.get('SLURM_NTASKS', 1))  # Number of worker processes for the models
+use_cache = True  # Reuse cropped rasters and transition counts from the on-disk cache (see cache.py)
+area_weighted = True  # Count migrations in km^2 using the latitude-dependent pixel area
+use_index = False  # Answer from a prebuilt bbox index (python bbox_index.py build ...); the bbox snaps to its tile grid, pixel counts only
+dem_path = None  # Local DEM (m): also write the migrations per elevation band from the same pass (see elevation.py)
+elevation_bands = [0, 500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000]  # Band edges in m
+lat_band_deg = None  # Also split the elevation bands into latitude bands of this many degrees
+use_store = True  # Reuse the transition counts of the results store (see results_store.py) and add new ones to it
+report = None  # Write the stage timings to this file (.json or .csv, see profiling.py)
+profile = False  # Also run under cProfile and write plot_migrations.prof
 #          E N D  OF N A M E L I S T
 #      -------------------------------------
 
@@ -70,83 +84,81 @@ def world_to_pixel(geo_matrix, x, y):
 
 
 
-# Load the historical and future climate classification TIFF files
-historical_dataset = gdal.Open('/p/projects/gvca/data/chelsa_cmip6/envicloud/chelsa/chelsa_V2/GLOBAL/climatologies/1981-2010/bio/CHELSA_kg2_1981-2010_V.2.1.tif')
-
-dir_models = '/p/projects/gvca/data/chelsa_cmip6/envicloud/chelsa/chelsa_V2/GLOBAL/climatologies/'+time_slice+'/'
-models = [dir_models+'GFDL-ESM4/'+scenario+'/bio/CHELSA_kg2_'+time_slice+'_gfdl-esm4_'+scenario+'_V.2.1.tif',
-dir_models+'IPSL-CM6A-LR/'+scenario+'/bio/CHELSA_kg2_'+time_slice+'_ipsl-cm6a-lr_'+scenario+'_V.2.1.tif',
-dir_models+'MPI-ESM1-2-HR/'+scenario+'/bio/CHELSA_kg2_'+time_slice+'_mpi-esm1-2-hr_'+scenario+'_V.2.1.tif',
-dir_models+'MRI-ESM2-0/'+scenario+'/bio/CHELSA_kg2_'+time_slice+'_mri-esm2-0_'+scenario+'_V.2.1.tif',
-dir_models+'UKESM1-0-LL/'+scenario+'/bio/CHELSA_kg2_'+time_slice+'_ukesm1-0-ll_'+scenario+'_V.2.1.tif']
-
+profiling.start_profile(profile)
 
+# Load the historical and future climate classification TIFF files
+record = profiling.begin_stage('open', scenario, time_slice)
+historical_dataset_path = '/p/projects/gvca/data/chelsa_cmip6/envicloud/chelsa/chelsa_V2/GLOBAL/climatologies/1981-2010/bio/CHELSA_kg2_1981-2010_V.2.1.tif'
+historical_dataset = gdal.Open(historical_dataset_path)
 
+# Every model with a kg2 map for the time slice and scenario
+found = discover_models(time_slice, scenario)
+model_names = [model for model, _ in found]
+models = [path for _, path in found]
+print(f"{len(models)} models found for {scenario} {time_slice}")
+if not models:
+    sys.exit(f"No models found for {scenario} {time_slice}")
 
 
 geo_transform = historical_dataset.GetGeoTransform()
 minx, maxy = world_to_pixel(geo_transform, bbox[0], bbox[1])
 maxx, miny = world_to_pixel(geo_transform, bbox[2], bbox[3])
-# Read the raster data as numpy arrays for the specified region
-historical_array  = historical_dataset.ReadAsArray(minx, miny, maxx - minx, maxy - miny)
-
-
-
-
-
-
-# Adjusted Function to process each model and calculate changes focusing on ET migrations
-def process_model(model_path):
-    future_dataset = gdal.Open(model_path)
-    future_array = future_dataset.ReadAsArray(minx, miny, maxx - minx, maxy - miny)
-
-    changes_dict_model = {}
-    for i in range(historical_array.shape[0]):
-        for j in range(historical_array.shape[1]):
-            historical_class = historical_array[i, j]
-            future_class = future_array[i, j]
-            if historical_class == 30 and historical_class != future_class:  # Check if historical class is ET
-                change_pair = (historical_class, future_class)
-                if change_pair not in changes_dict_model:
-                    changes_dict_model[change_pair] = 1
-                else:
-                    changes_dict_model[change_pair] += 1
-    return changes_dict_model
-
-
-
-# Process each model and store the results
-all_changes = [process_model(model) for model in models]
-
-# Aggregate changes to calculate mean and standard deviation
-aggregated_changes = {}
-for changes in all_changes:
-    for change, count in changes.items():
-        if change not in aggregated_changes:
-            aggregated_changes[change] = []
-        aggregated_changes[change].append(count)
-
-means = {change: np.mean(counts) for change, counts in aggregated_changes.items()}
-std_devs = {change: np.std(counts) for change, counts in aggregated_changes.items()}
+# The rasters are streamed tile by tile over this pixel window
+window = (minx, miny, maxx, maxy)
+# Pixel area (km^2) per row of the window, computed once from the geotransform
+row_area = pixel_area_rows(geo_transform, miny, maxy - miny) if area_weighted else None
+profiling.end_stage(record)
+
+
+
+
+
+
+# Process each model and store the ET transition matrices
+# The matrices are computed as they are taken, so the count stage runs up to the ensemble statistics
+record = profiling.begin_stage('count', scenario, time_slice, 'ensemble',
+                               [(scenario, time_slice, model, path) for model, path in found])
+region, unit = bbox_region(bbox), count_unit(area_weighted)
+store = use_store and not use_index
+# The stored counts are only reused while the rasters, the window and the source classes are unchanged
+signatures = [transitions_signature([historical_dataset_path, model], window, [30]) for model in models] if store else None
+if store and dem_path is None and models and all(has_transitions(scenario, time_slice, region, model, unit, signature=signature)
+                                                 for model, signature in zip(model_names, signatures)):
+    # Every model is in the results store, so no raster is read
+    all_matrices = [read_transitions(scenario, time_slice, region, model, unit) for model in model_names]
+    store = False
+elif dem_path is not None:
+    from elevation import elevation_zones
+    from zones import write_zonal_transitions_csv, zonal_transition_job
+    # One pass per model counts the migrations of every elevation band; the bands add up to the bbox totals
+    zones_path, band_names = elevation_zones(dem_path, historical_dataset_path, elevation_bands, lat_band_deg)
+    band_stats = RunningStats()
+    all_matrices = []
+    for band_matrices in run_jobs(zonal_transition_job, [(zones_path, historical_dataset_path, model, window, len(band_names), [30],
+                                                          gdal.Open, row_area) for model in models], workers):
+        band_stats.add(band_matrices)
+        all_matrices.append(band_matrices.sum(axis=0))
+    write_zonal_transitions_csv(band_stats.mean, band_stats.std(), band_names,
+                                'ET_elevation_band_migrations_'+time_slice+'_'+scenario+'.csv')
+elif use_index:
+    all_matrices = [query_transitions(model, historical_dataset_path, bbox)[0] for model in models]
+elif use_cache:
+    all_matrices = cached_transition_matrices(historical_dataset_path, models, window, source_classes=[30], workers=workers, row_area=row_area)
+else:
+    all_matrices = run_jobs(transition_job, [(historical_dataset_path, model, window, [30], gdal.Open, row_area) for model in models], workers)
+
+# Aggregate changes to calculate mean and standard deviation, one model matrix at a time
+if store:
+    all_matrices = write_each(all_matrices, scenario, time_slice, model_names, region, unit, signatures=signatures, source_classes=[30])
+mean_matrix, std_matrix = ensemble_transition_stats(all_matrices)
+profiling.end_stage(record)
+means = changes_dict(mean_matrix)
+std_devs = {change: std_matrix[change] for change in means}
 
 
 # Directly proceed to plotting without filtering for top N
-sorted_means = sorted(means.items(), key=lambda x: x[1], reverse=True)  # Sort all ET migrations
-migrations = [f"{koppen_mapping_short.get(src)} -> {koppen_mapping_short.get(dst)}" for (src, dst), _ in sorted_means if src == 30]
-mean_counts = [mean for _, mean in sorted_means if _[0] == 30]
-error = [std_devs[change] for change, _ in sorted_means if change[0] == 30]
-
-# Adjusted plot code to reflect ET specific migrations
-plt.figure(figsize=(10, 8))
-plt.barh(migrations, mean_counts, xerr=error, color='skyblue')
-plt.xlabel('Mean Count of Migrations (km$^2$)', fontsize= 15)
-plt.ylabel('Migration Type', fontsize= 15)
-plt.xticks(fontsize= 12)
-plt.yticks(fontsize= 15)
-plt.gca().invert_yaxis()
-plt.xlim(0, x_max_lim)
-plt.ylim(0,12)
-plt.tight_layout()
-
-# Save the plot
-plt.savefig('ET_classification_aggregated_migrations_'+time_slice+'_'+scenario+'.png')
+record = profiling.begin_stage('render', scenario, time_slice)
+plot_migrations_bar(means, std_devs, 'ET_classification_aggregated_migrations_'+time_slice+'_'+scenario+'.png', source_class=30,
+                    x_max_lim=x_max_lim, area_weighted=area_weighted and not use_index)
+profiling.end_stage(record)
+profiling.finish(report, 'plot_migrations.prof' if profile else None)
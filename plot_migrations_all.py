@@ -1,21 +1,37 @@
+import argparse
+import contextlib
 import numpy as np
-import matplotlib.pyplot as plt
 from osgeo import gdal
 import os
-from tqdm import tqdm
-import csv
-from matplotlib.patches import Patch
-
-
-# Assuming `aggregated_changes_per_slice` is your dictionary with the data
-csv_file_path = 'aggregated_changes.csv'
-
-
+import sys
+import utilities
+import profiling
+from utilities import changes_dict, discover_models, tiled_class_histogram, transition_job, run_jobs, pixel_area_rows, prefetch_report
+from cache import cached_class_histogram, cached_transition_matrices
+from ensemble import RunningStats
+from results_store import (STORE_DIR, bbox_region, count_unit, read_class_counts, read_transitions, stored_models, transitions_signature,
+                           write_class_counts, write_transitions)
+
+
+# Setup command line arguments
+parser = argparse.ArgumentParser(description='Plot the ensemble mean ET migrations for all scenarios and time slices.')
+parser.add_argument('--workers', type=int, help='Number of worker processes for the model comparisons', default=1)
+parser.add_argument('--no_cache', action='store_true', help='Do not read from or write to the on-disk cache')
+parser.add_argument('--prefetch', type=int, help='Number of tiles read ahead in the background (0 disables prefetching)', default=2)
+parser.add_argument('--report', type=str, help='Write the stage timings to this .json or .csv file', default=None)
+parser.add_argument('--profile', action='store_true', help='Run under cProfile and write plot_migrations_all.prof')
+parser.add_argument('--area_weighted', action='store_true', help='Weight the migrations by pixel area (km^2) instead of counting grid points')
+parser.add_argument('--no_plot', action='store_true', help='Only compute the migrations and add them to the results store (no matplotlib needed)')
+parser.add_argument('--from_stats', action='store_true', help='Render the figure from the transition counts in the results store instead of reading the rasters')
+parser.add_argument('--store', type=str, help='Directory of the results store (see results_store.py)', default=STORE_DIR)
+parser.add_argument('--patches', action='store_true', help='Also label the ET patches of the historical and every model map in the same pass (patches_summary.csv, patches_sizes.csv)')
+parser.add_argument('--stats_format', type=str, choices=['csv', 'parquet'], help='Format of the patch tables', default='csv')
+args = parser.parse_args()
+utilities.PREFETCH_DEPTH = args.prefetch
 
 # Configuration
 scenarios = ['ssp126', 'ssp370', 'ssp585']
 time_slices = ['2011-2040', '2041-2070', '2071-2100']
-models = ['GFDL-ESM4', 'IPSL-CM6A-LR', 'MPI-ESM1-2-HR', 'MRI-ESM2-0', 'UKESM1-0-LL']
 base_dir = '/p/projects/gvca/data/chelsa_cmip6/envicloud/chelsa/chelsa_V2/GLOBAL/climatologies'
 colors = ['blue', 'green', 'red']  # Colors for the time slices
 
@@ -77,28 +93,6 @@ def autopct_generator(limit):
         return ('%.1f%%' % pct) if pct > limit else ''
     return inner_autopct
 
-# Function to process a single model file
-def process_model(model_path, historical_array, minx, miny, maxx, maxy):
-    future_dataset = gdal.Open(model_path)
-    future_array = future_dataset.ReadAsArray(minx, miny, maxx - minx, maxy - miny)
-    changes_dict_model = {}
-
-    # Calculate total iterations for the progress bar
-    total_iterations = future_array.shape[0] * future_array.shape[1]
-
-    with tqdm(total=total_iterations, desc="Processing Model") as pbar:
-        for i in range(future_array.shape[0]):
-            for j in range(future_array.shape[1]):
-                historical_class = historical_array[i, j]
-                future_class = future_array[i, j]
-                if historical_class == 30:
-                    if future_class != historical_class:  # Check if there's a change
-                        change_pair = (historical_class, future_class)
-                        changes_dict_model[change_pair] = changes_dict_model.get(change_pair, 0) + 1
-                # Update progress bar after each inner loop iteration
-                pbar.update(1)
-    return changes_dict_model
-
 # Function to calculate label positions with a line pointing to small slices
 def label_position(wedge, text, ax):
     ang = (wedge.theta2 - wedge.theta1) / 2. + wedge.theta1
@@ -114,16 +108,10 @@ def label_position(wedge, text, ax):
     )
     text.set_visible(False)
 
-# Load the historical climate classification TIFF
-historical_dataset_path = os.path.join(base_dir, '1981-2010', 'bio', 'CHELSA_kg2_1981-2010_V.2.1.tif')
-historical_dataset = gdal.Open(historical_dataset_path)
-geo_transform = historical_dataset.GetGeoTransform()
-minx, maxy = world_to_pixel(geo_transform, bbox[0], bbox[1])
-maxx, miny = world_to_pixel(geo_transform, bbox[2], bbox[3])
-historical_array = historical_dataset.ReadAsArray(minx, miny, maxx - minx, maxy - miny)
-historical_ET_count = np.sum(historical_array == 30)
-
-
+profiling.start_profile(args.profile)
+# The counts of every model are kept in the results store under the bbox and their unit
+region = bbox_region(bbox)
+unit = count_unit(args.area_weighted)
 
 # Placeholder for the ensemble mean changes per class for each time slice and scenario
 ensemble_mean_changes = {scenario: {time_slice: {} for time_slice in time_slices} for scenario in scenarios}
@@ -131,34 +119,113 @@ ensemble_mean_changes = {scenario: {time_slice: {} for time_slice in time_slices
 # Create a set to collect unique categories that are present in the pie charts
 unique_categories = set()
 
-# Process the models and calculate the ensemble mean changes
+if args.from_stats:
+    # Fold the stored matrices of every model into one streaming accumulator per scenario and time slice
+    record = profiling.begin_stage('read', model='stats')
+    historical_ET_count = read_class_counts(region, unit, args.store)[30]
+    ensemble_stats = {}
+    for scenario in scenarios:
+        for time_slice in time_slices:
+            for model in stored_models(scenario, time_slice, region, unit, args.store):
+                ensemble_stats.setdefault((scenario, time_slice), RunningStats()).add(
+                    read_transitions(scenario, time_slice, region, model, unit, args.store))
+    profiling.end_stage(record)
+else:
+    # Load the historical climate classification TIFF
+    record = profiling.begin_stage('read', model='historical')
+    historical_dataset_path = os.path.join(base_dir, '1981-2010', 'bio', 'CHELSA_kg2_1981-2010_V.2.1.tif')
+    historical_dataset = gdal.Open(historical_dataset_path)
+    geo_transform = historical_dataset.GetGeoTransform()
+    minx, maxy = world_to_pixel(geo_transform, bbox[0], bbox[1])
+    maxx, miny = world_to_pixel(geo_transform, bbox[2], bbox[3])
+    window = (minx, miny, maxx, maxy)
+    # Pixel area (km^2) per row of the window, computed once from the geotransform
+    row_area = pixel_area_rows(geo_transform, miny, maxy - miny) if args.area_weighted else None
+    if args.no_cache:
+        class_counts = tiled_class_histogram(historical_dataset, window, row_area=row_area)
+    else:
+        class_counts = cached_class_histogram(historical_dataset_path, window, row_area=row_area)
+    historical_ET_count = class_counts[30]
+    write_class_counts(class_counts, region, unit, args.store, transitions_signature([historical_dataset_path], window))
+    profiling.end_stage(record)
+
+
+    # Collect one job per (scenario, time_slice, model) comparison
+    jobs = []
+    job_keys = []
+    for scenario in scenarios:
+        for time_slice in time_slices:
+            # Every model with a kg2 map for the scenario and time slice
+            models = discover_models(time_slice, scenario, base_dir)
+            if not models:
+                print(f"No models found for {scenario} {time_slice}")
+            for model, model_path in models:
+                jobs.append((historical_dataset_path, model_path, window, [30], gdal.Open, row_area))
+                job_keys.append((scenario, time_slice, model))
+
+    # Run the comparisons (in parallel with --workers) and reduce the matrices per scenario and time slice
+    if args.patches:
+        # The ET patches are labelled in the same pass as the transitions (the historical map with the first model)
+        from patches import transition_patches_job, write_patch_tables
+        patch_jobs = [(historical_dataset_path, job[1], window, [30], [30], gdal.Open, row_area, k == 0) for k, job in enumerate(jobs)]
+        matrices = run_jobs(transition_patches_job, patch_jobs, args.workers)
+        patch_stats = []
+    elif args.no_cache:
+        from tqdm import tqdm
+        matrices = tqdm(run_jobs(transition_job, jobs, args.workers), total=len(jobs), desc='Processing models')
+    else:
+        # The cache computes (or loads) every matrix at once, so it is timed as one stage with a
+        # record of the reads of every model
+        model_keys = [(scenario, time_slice, model, job[1]) for (scenario, time_slice, model), job in zip(job_keys, jobs)]
+        with profiling.stage('count', models=model_keys):
+            matrices = cached_transition_matrices(historical_dataset_path, [job[1] for job in jobs], window, source_classes=[30], workers=args.workers, row_area=row_area)
+    # Fold the matrices into one streaming accumulator per scenario and time slice
+    ensemble_stats = {}
+    per_model = args.patches or args.no_cache
+    matrices = iter(matrices)
+    for (scenario, time_slice, model), job in zip(job_keys, jobs):
+        # The jobs run as the matrices are taken, so every model is timed as its own stage
+        with profiling.stage('count', scenario, time_slice, model) if per_model else contextlib.nullcontext():
+            matrix = next(matrices)
+        if args.patches:
+            matrix, future_patches, historical_patches = matrix
+            if historical_patches is not None:
+                patch_stats.append(('historical', historical_patches))
+            patch_stats.append((f'{model}_{scenario}_{time_slice}', future_patches))
+        write_transitions(matrix, scenario, time_slice, model, region, unit, args.store,
+                          transitions_signature([historical_dataset_path, job[1]], window, [30]), [30])
+        ensemble_stats.setdefault((scenario, time_slice), RunningStats()).add(matrix)
+    print(f"Reading models: {prefetch_report()}")
+    if args.patches:
+        write_patch_tables(patch_stats, 'patches', args.stats_format)
+
+if args.no_plot:
+    print(f"Transition counts written to the results store {args.store} (region {region})")
+    profiling.finish(args.report, 'plot_migrations_all.prof' if args.profile else None)
+    sys.exit()
+
+# Calculate the ensemble mean changes
+record = profiling.begin_stage('aggregate')
 for scenario in scenarios:
     for time_slice in time_slices:
-        model_changes = []
-        for model in models:
-            dir_path = os.path.join(base_dir, time_slice, model, scenario, 'bio')
-            if os.path.exists(dir_path):
-                model_paths = [os.path.join(dir_path, f) for f in os.listdir(dir_path) if "_kg2_" in f and f.endswith('.tif')]
-                for model_path in tqdm(model_paths, desc=f'Processing {model} {time_slice} {scenario}'):
-                    changes = process_model(model_path, historical_array, minx, miny, maxx, maxy)
-                    model_changes.append(changes)
-            else:
-                print(f"Directory does not exist: {dir_path}")
-
-        # Aggregate changes across all models and calculate the ensemble mean
-        aggregated_changes = {}
-        for changes in model_changes:
-            for change, count in changes.items():
-                if change[0] == 30:  # Ensure we're only looking at changes from ET class
-                    aggregated_changes[change] = aggregated_changes.get(change, 0) + count
+        # Ensemble mean of the changes from the ET class over the models found for this scenario and time slice
+        stats = ensemble_stats.get((scenario, time_slice))
+        aggregated_changes = changes_dict(stats.mean) if stats is not None else {}
         mean_changes = ensemble_mean_changes[scenario][time_slice]
         for change, count in mean_changes.items():
             print("count", str(count), change)
             if count > 0:
                 unique_categories.add(change[1])  # Add the category index to the set
-                
+
         # Calculate the mean changes for this scenario and time slice
-        ensemble_mean_changes[scenario][time_slice] = {change: count / len(models) for change, count in aggregated_changes.items()}
+        ensemble_mean_changes[scenario][time_slice] = aggregated_changes
+
+
+profiling.end_stage(record)
+
+# Plotting libraries are only imported when the figure is drawn
+import matplotlib.pyplot as plt
+from matplotlib.patches import Patch
 
 
 # Now create legend patches for only the unique categories that were used
@@ -179,6 +246,7 @@ def create_legend_patches(unique_categories, koppen_colors, koppen_mapping_short
 
 
 # Configuration for plot size and font
+record = profiling.begin_stage('render')
 plt.rcParams['font.size'] = 30  # Adjust font size as needed
 
 # Setup the figure layout
@@ -302,6 +370,8 @@ fig.legend(handles=legend_patches, loc='upper center', ncol=len(legend_patches),
 # Place the legend on the figure
 plt.savefig('aggregated_migrations_by_scenario_adjusted_ALPS.png',bbox_inches='tight', dpi=300)
 #plt.savefig('aggregated_migrations_by_scenario_adjusted_ASIA.png',bbox_inches='tight', dpi=300)
+profiling.end_stage(record)
+profiling.finish(args.report, 'plot_migrations_all.prof' if args.profile else None)
 
 
 
@@ -0,0 +1,126 @@
+import functools
+import numpy as np
+import matplotlib.pyplot as plt
+import cartopy
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import shapely.wkb
+from matplotlib.colors import ListedColormap
+from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+import koppen_mappings
+from koeppen_colors import koppen_colors
+from cache import cache_key, load_result, store_result
+from pyramid import for_display
+
+# Longest side of one map panel in output pixels (10 inches at 300 dpi). Larger maps are drawn from
+# the matching level of their pyramid (see pyramid.py) instead of at full resolution.
+MAP_PIXELS = 3000
+# Base-map layers drawn on every map (the coastlines and borders of ax.coastlines() and cfeature.BORDERS)
+BASE_LAYERS = {'coastlines': cfeature.COASTLINE, 'borders': cfeature.BORDERS}
+
+
+# Function to get the coastline and border lines of a bbox at the Natural Earth scale cartopy picks
+# for its extent (the lines cartopy itself would draw). They are cached on disk per bbox (as WKB) and
+# in memory per process, so the shapefiles are read and searched once instead of for every figure.
+@functools.lru_cache(maxsize=None)
+def base_layers(bbox):
+    extent = [bbox[0], bbox[2], bbox[1], bbox[3]]
+    key = 'basemap_' + cache_key([], (), bbox=list(bbox), layers=sorted(BASE_LAYERS), cartopy=cartopy.__version__)
+    stored = load_result(key)
+    if stored is None:
+        stored = {}
+        for name, feature in BASE_LAYERS.items():
+            blobs = [line.wkb for line in feature.intersecting_geometries(extent)]
+            stored[f'{name}_wkb'] = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+            stored[f'{name}_offsets'] = np.cumsum([0] + [len(blob) for blob in blobs])
+        store_result(key, stored)
+    layers = {}
+    for name in BASE_LAYERS:
+        wkb, offsets = stored[f'{name}_wkb'].tobytes(), stored[f'{name}_offsets']
+        layers[name] = [shapely.wkb.loads(wkb[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+    return layers
+
+
+# Function to draw the cached coastlines and borders of a bbox on a map
+def add_base_map(ax, bbox):
+    for lines in base_layers(tuple(bbox)).values():
+        ax.add_geometries(lines, ccrs.PlateCarree(), facecolor='none', edgecolor='black', linewidth=.5)
+
+
+# Function to reduce the maps of plot_agreement to display size (maps already that small come back unchanged)
+def agreement_for_display(agreement_array, historical_mask):
+    return (for_display(agreement_array, 'mean', MAP_PIXELS),
+            for_display(historical_mask.astype(np.uint8), 'majority', MAP_PIXELS, n_classes=2, nodata=None))
+
+
+# Function to reduce the maps of plot_modal to display size
+def modal_for_display(modal_class, modal_agreement):
+    return for_display(modal_class, 'majority', MAP_PIXELS), for_display(modal_agreement, 'mean', MAP_PIXELS)
+
+
+# Function to plot the model agreement on one category with the historical extent and the per-model bar chart
+def plot_agreement(agreement_array, historical_mask, model_agreements, model_names, target_cat, bbox, out_path, area_weighted=False):
+    n_models = len(model_names) - 1
+    fig, ax = plt.subplots(figsize=(10, 10), subplot_kw={'projection': ccrs.PlateCarree()})
+    extent = [bbox[0], bbox[2], bbox[1], bbox[3]]
+    cmap = ListedColormap(['#FFFFFF00', '#5555FF', '#AAAAFF', '#FFAAAA', '#FF5555', '#FF0000'])
+
+    # Draw the coarsest pyramid level that still fills the output resolution
+    agreement_array, historical_mask = agreement_for_display(agreement_array, historical_mask)
+
+    # Plot historical "ET" category
+    ax.imshow(historical_mask.astype(int), cmap=ListedColormap(['#FFFFFF', '#98FB98']), interpolation='nearest', extent=extent, aspect='equal')
+    cax = ax.imshow(agreement_array, cmap=cmap, interpolation='nearest', extent=extent, vmin=0, vmax=n_models, aspect='equal')
+
+    # Add map features
+    add_base_map(ax, bbox)
+
+    plt.xlabel('Longitude Index')
+    plt.ylabel('Latitude Index')
+
+    # Colorbar
+    cbar_ax = fig.add_axes([0.93, 0.3, 0.03, 0.39])
+    cbar = fig.colorbar(cax, cax=cbar_ax)
+    cbar.set_label(f'Number of Models Agreeing on the {koppen_mappings.koppen_mapping_short[target_cat]}')
+
+    # Gridlines
+    gl = ax.gridlines(draw_labels=True, linewidth=1, color='gray', alpha=0.1, linestyle='--')
+    gl.top_labels = False
+    gl.right_labels = False
+
+    # Inset for the bar chart
+    axins = inset_axes(ax, width="30%", height="20%", loc='upper left', bbox_to_anchor=(0.15, 0.12, 1, .8), bbox_transform=ax.transAxes)
+    # Define colors for each bar: one for historical and one for each model
+    colors = ['#98FB98']  # Color for the historical bar
+    model_colors = ['skyblue'] * n_models  # Same color for all model bars
+    all_colors = colors + model_colors  # Combine the colors
+    axins.barh(model_names, model_agreements, color=all_colors)
+    axins.set_xlabel('Area (km$^2$)' if area_weighted else 'Grid Points')
+#    axins.set_title('Köppen Category Agreement')
+
+    plt.savefig(out_path, format='png', dpi=300, bbox_inches='tight')
+    plt.close()
+
+
+# Function to plot the modal future class and the number of models agreeing on it
+def plot_modal(modal_class, modal_agreement, n_models, bbox, out_path):
+    fig, axs = plt.subplots(1, 2, figsize=(20, 10), subplot_kw={'projection': ccrs.PlateCarree()})
+    extent = [bbox[0], bbox[2], bbox[1], bbox[3]]
+    class_cmap = ListedColormap(['#FFFFFF00'] + [koppen_colors[cat] for cat in range(1, 32)])
+    agreement_cmap = ListedColormap(['#FFFFFF00', '#5555FF', '#AAAAFF', '#FFAAAA', '#FF5555', '#FF0000'])
+    modal_class, modal_agreement = modal_for_display(modal_class, modal_agreement)
+    cax_class = axs[0].imshow(modal_class, cmap=class_cmap, interpolation='nearest', extent=extent, vmin=-0.5, vmax=31.5, aspect='equal')
+    cax_agreement = axs[1].imshow(modal_agreement, cmap=agreement_cmap, interpolation='nearest', extent=extent, vmin=0, vmax=n_models, aspect='equal')
+    for ax in axs:
+        add_base_map(ax, bbox)
+        gl = ax.gridlines(draw_labels=True, linewidth=1, color='gray', alpha=0.1, linestyle='--')
+        gl.top_labels = False
+        gl.right_labels = False
+    present = [cat for cat in range(1, 32) if np.any(modal_class == cat)]
+    cbar = fig.colorbar(cax_class, ax=axs[0], shrink=0.5, ticks=present)
+    cbar.ax.set_yticklabels([koppen_mappings.koppen_mapping_short[cat] for cat in present])
+    cbar.set_label('Modal Future Köppen Class')
+    cbar = fig.colorbar(cax_agreement, ax=axs[1], shrink=0.5)
+    cbar.set_label('Number of Models Agreeing on the Modal Class')
+    plt.savefig(out_path, format='png', dpi=300, bbox_inches='tight')
+    plt.close()
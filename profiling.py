@@ -0,0 +1,103 @@
+import cProfile
+import csv
+import json
+import resource
+import time
+from contextlib import contextmanager
+import utilities
+
+# Stage timings of the current run, one dict per stage and (scenario, time_slice, model)
+STAGE_RECORDS = []
+_profiler = None
+REPORT_FIELDS = ['stage', 'scenario', 'time_slice', 'model', 'wall_time', 'read_time', 'bytes_read', 'pixels', 'skipped_pixels',
+                 'pixels_per_sec', 'rss_high_water_mb']
+
+
+# Function to get the running high-water mark of the resident set size in MB of this process and
+# its finished children (ru_maxrss): the largest RSS so far in the run, not the peak of one stage
+def rss_high_water_mb():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+# Function to start timing one pipeline stage. Bytes and pixels read through utilities.read_block,
+# in this process and in the worker jobs of utilities.run_jobs, and the background reader time (see
+# utilities.prefetch) are recorded as deltas. models lists the (scenario, time_slice, model, path)
+# inputs the stage reads; end_stage adds one record per model with the reads of its raster. Pass the
+# record to end_stage.
+def begin_stage(name, scenario=None, time_slice=None, model=None, models=None):
+    return {'stage': name, 'scenario': scenario, 'time_slice': time_slice, 'model': model,
+            '_start': time.perf_counter(), '_bytes': utilities.READ_STATS['bytes'],
+            '_pixels': utilities.READ_STATS['pixels'], '_skipped': utilities.READ_STATS['skipped_pixels'],
+            '_fetch': utilities.PREFETCH_TIMINGS['fetch'], '_models': list(models or []),
+            '_paths': {path: dict(stats) for path, stats in utilities.PATH_READ_STATS.items()}}
+
+
+# Function to finish a stage started with begin_stage and store its record, followed by the
+# records of its models. A model record holds the reads of that model's raster during the stage
+# (read_time is the time spent in read_block, pixels_per_sec the read rate); its wall_time is the
+# one of the whole stage, as the models of a stage are processed together.
+def end_stage(record):
+    record['wall_time'] = time.perf_counter() - record.pop('_start')
+    record['read_time'] = utilities.PREFETCH_TIMINGS['fetch'] - record.pop('_fetch')
+    record['bytes_read'] = utilities.READ_STATS['bytes'] - record.pop('_bytes')
+    record['pixels'] = utilities.READ_STATS['pixels'] - record.pop('_pixels')
+    record['skipped_pixels'] = utilities.READ_STATS['skipped_pixels'] - record.pop('_skipped')
+    record['pixels_per_sec'] = record['pixels'] / record['wall_time'] if record['wall_time'] > 0 else 0.0
+    record['rss_high_water_mb'] = rss_high_water_mb()
+    models, paths = record.pop('_models'), record.pop('_paths')
+    STAGE_RECORDS.append(record)
+    for scenario, time_slice, model, path in models:
+        stats = utilities.PATH_READ_STATS.get(path, {})
+        before = paths.get(path, {})
+        delta = {name: stats.get(name, 0) - before.get(name, 0) for name in ['bytes', 'pixels', 'read_time']}
+        STAGE_RECORDS.append({'stage': record['stage'], 'scenario': scenario, 'time_slice': time_slice, 'model': model,
+                              'wall_time': record['wall_time'], 'read_time': delta['read_time'], 'bytes_read': delta['bytes'],
+                              'pixels': delta['pixels'], 'skipped_pixels': None,
+                              'pixels_per_sec': delta['pixels'] / delta['read_time'] if delta['read_time'] > 0 else 0.0,
+                              'rss_high_water_mb': record['rss_high_water_mb']})
+    return record
+
+
+# Context manager to time one pipeline stage (see begin_stage)
+@contextmanager
+def stage(name, scenario=None, time_slice=None, model=None, models=None):
+    record = begin_stage(name, scenario, time_slice, model, models)
+    try:
+        yield record
+    finally:
+        end_stage(record)
+
+
+# Function to start cProfile for the whole run when enabled
+def start_profile(enabled):
+    global _profiler
+    if enabled:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+# Function to write the stage report (.json or .csv) and, if profiling, the cProfile stats
+def finish(report_path=None, profile_path=None):
+    if _profiler is not None:
+        _profiler.disable()
+        if profile_path:
+            _profiler.dump_stats(profile_path)
+            print(f"cProfile stats written to {profile_path} (inspect with python -m pstats)")
+    if report_path:
+        write_report(report_path)
+        print(f"Stage timings written to {report_path}")
+
+
+# Function to write the stage records to a JSON or CSV file, chosen by extension
+def write_report(path, records=None):
+    records = STAGE_RECORDS if records is None else records
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path, 'w') as f:
+            json.dump(records, f, indent=1)
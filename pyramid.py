@@ -0,0 +1,121 @@
+import hashlib
+import numpy as np
+from utilities import N_CLASSES
+from cache import CACHE_DIR, load_result, store_result
+
+# Multi-resolution pyramids for drawing large maps. Level k is the map downsampled by 2**k:
+# categorical maps (kg2 classes, masks) keep the most common valid value of each block, count maps
+# (model agreement) keep the block mean. The plots draw the coarsest level that still has at least
+# one pixel per output pixel, instead of handing the full-resolution array to imshow. The levels are
+# cached by the content of the map, so re-plotting the same map skips the downsampling.
+PYRAMID_MIN_SIZE = 256
+# Upper bound for the number of counters of one bincount in majority_downsample and for the input
+# pixels of one chunk (majority_downsample holds about 26 bytes of temporaries per input pixel)
+MAJORITY_CHUNK = 2 ** 22
+
+
+# Function to pad an array to a multiple of factor and view it as (rows, factor, cols, factor) blocks
+def _blocks(array, factor, fill):
+    height, width = array.shape
+    padded = np.pad(array, ((0, -height % factor), (0, -width % factor)), constant_values=fill)
+    return padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+
+
+# Function to get the number of output rows processed at once so a chunk holds at most
+# MAJORITY_CHUNK input pixels and counters
+def _chunk_rows(out_cols, factor, n_counters=1):
+    return max(1, MAJORITY_CHUNK // (out_cols * max(n_counters, factor * factor)))
+
+
+# Function to downsample a categorical map by taking the most common value of every factor x factor
+# block. Values equal to nodata (or outside 0..n_classes-1) are ignored; all-nodata blocks get nodata.
+# Ties go to the lower class. Counted with one bincount per chunk of block rows.
+def majority_downsample(array, factor, n_classes=N_CLASSES, nodata=0):
+    array = np.asarray(array)
+    fill = n_classes if nodata is None else nodata
+    out_rows, out_cols = -(-array.shape[0] // factor), -(-array.shape[1] // factor)
+    result = np.empty((out_rows, out_cols), dtype=array.dtype)
+    chunk_rows = _chunk_rows(out_cols, factor, n_classes + 1)
+    for row in range(0, out_rows, chunk_rows):
+        chunk = _blocks(array[row * factor:(row + chunk_rows) * factor], factor, fill).astype(np.intp)
+        rows = chunk.shape[0]
+        values = np.where((chunk >= 0) & (chunk < n_classes), chunk, n_classes)
+        block_index = np.arange(rows)[:, None, None, None] * out_cols + np.arange(out_cols)[None, None, :, None]
+        codes = block_index * (n_classes + 1) + values
+        counts = np.bincount(codes.ravel(), minlength=rows * out_cols * (n_classes + 1)).reshape(rows, out_cols, n_classes + 1)
+        counts = counts[:, :, :n_classes]
+        if nodata is not None:
+            counts[:, :, nodata] = 0
+        mode = counts.argmax(axis=2)
+        if nodata is not None:
+            mode = np.where(counts.max(axis=2) > 0, mode, nodata)
+        result[row:row + rows] = mode
+    return result
+
+
+# Function to downsample a count map (e.g. number of agreeing models) by the mean of every block.
+# Pixels of the padding at the right and bottom edges do not count.
+def mean_downsample(array, factor):
+    array = np.asarray(array)
+    height, width = array.shape
+    out_rows, out_cols = -(-height // factor), -(-width // factor)
+    # Valid pixels per block: full blocks hold factor**2, the last row and column of blocks fewer
+    block_heights = np.minimum(factor, height - factor * np.arange(out_rows)).astype(np.float32)
+    block_widths = np.minimum(factor, width - factor * np.arange(out_cols)).astype(np.float32)
+    result = np.empty((out_rows, out_cols), dtype=np.float32)
+    chunk_rows = _chunk_rows(out_cols, factor)
+    for row in range(0, out_rows, chunk_rows):
+        chunk = array[row * factor:(row + chunk_rows) * factor].astype(np.float32)
+        sums = _blocks(chunk, factor, 0).sum(axis=(1, 3))
+        result[row:row + len(sums)] = sums / (block_heights[row:row + len(sums), None] * block_widths[None, :])
+    return result
+
+
+# Function to downsample a map by factor; kind is 'majority' (categorical) or 'mean' (counts)
+def downsample(array, kind, factor, n_classes=N_CLASSES, nodata=0):
+    if kind == 'majority':
+        return majority_downsample(array, factor, n_classes=n_classes, nodata=nodata)
+    return mean_downsample(array, factor)
+
+
+# Function to build the pyramid of a map: level k is downsampled by 2**k, down to PYRAMID_MIN_SIZE.
+# kind is 'majority' (categorical) or 'mean' (counts). Every level is computed from the full map.
+def build_pyramid(array, kind, n_classes=N_CLASSES, nodata=0):
+    levels = [np.asarray(array)]
+    factor = 2
+    while max(levels[0].shape) // factor >= PYRAMID_MIN_SIZE:
+        levels.append(downsample(levels[0], kind, factor, n_classes=n_classes, nodata=nodata))
+        factor *= 2
+    return levels
+
+
+# Function to pick the pyramid level for an output of max_pixels along the longer side: the coarsest
+# level that still has at least one map pixel per output pixel
+def pick_level(shape, max_pixels):
+    level = 0
+    while max(shape) // 2 ** (level + 1) >= max(max_pixels, PYRAMID_MIN_SIZE):
+        level += 1
+    return level
+
+
+# Function to build the cache key of a pyramid from the content of the map
+def pyramid_key(array, kind, n_classes=N_CLASSES, nodata=0):
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(array.view(np.uint8).ravel(), digest_size=20)
+    digest.update(f'{kind}|{array.dtype}|{array.shape}|{n_classes}|{nodata}'.encode())
+    return 'pyramid_' + digest.hexdigest()
+
+
+# Function to get the level of a map to draw at max_pixels along the longer side. Only that level
+# is computed (from the full map, like build_pyramid) and cached on the first call. Small maps are
+# returned unchanged.
+def for_display(array, kind, max_pixels, n_classes=N_CLASSES, nodata=0, cache_dir=CACHE_DIR):
+    level = pick_level(np.shape(array), max_pixels)
+    if level == 0:
+        return array
+    key = f'{pyramid_key(array, kind, n_classes=n_classes, nodata=nodata)}_level_{level}'
+    stored = load_result(key, cache_dir=cache_dir)
+    if stored is None:
+        stored = {'level': downsample(array, kind, 2 ** level, n_classes=n_classes, nodata=nodata)}
+        store_result(key, stored, cache_dir=cache_dir)
+    return stored['level']
@@ -0,0 +1,62 @@
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg')
+from utilities import pool_context
+
+# Rendering stage: figures are queued as (function of plots.py, arguments) jobs and drawn by worker
+# processes while the caller goes on with the next statistics. Workers draw with the Agg backend and
+# keep the base-map layers of every bbox in memory (see plots.base_layers), so coastlines and borders
+# are read once per worker instead of once per figure. With one worker the figures are drawn in the
+# calling process as they are queued.
+
+
+# Function to draw one (function name, args, kwargs) figure job
+def render_job(job):
+    name, args, kwargs = job
+    import plots
+    getattr(plots, name)(*args, **kwargs)
+
+
+# Queue of figures drawn by a pool of worker processes. At most max_pending figures (default two
+# per worker) wait for a worker, so the arrays of only a few figures are held at a time.
+class RenderFarm:
+    def __init__(self, workers=1, max_pending=None):
+        self.workers = workers
+        self.max_pending = max_pending or 2 * workers
+        self.executor = None
+        self.pending = []
+        self.rendered = 0
+
+    # Function to load the base-map layers of a bbox before the workers start, so they share them
+    def warm(self, bbox):
+        from plots import base_layers
+        base_layers(tuple(bbox))
+
+    # Function to queue one figure: name is a plotting function of plots.py called with args and kwargs
+    def submit(self, name, *args, **kwargs):
+        job = (name, args, kwargs)
+        if self.workers <= 1:
+            render_job(job)
+            self.rendered += 1
+            return
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context())
+        self.pending.append(self.executor.submit(render_job, job))
+        while len(self.pending) > self.max_pending:
+            self._wait_oldest()
+
+    # Function to wait for the oldest queued figure (errors of the worker are raised here)
+    def _wait_oldest(self):
+        self.pending.pop(0).result()
+        self.rendered += 1
+
+    # Function to wait for every queued figure and stop the workers. Returns the number of figures drawn.
+    def close(self):
+        try:
+            while self.pending:
+                self._wait_oldest()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        return self.rendered
@@ -0,0 +1,195 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import numpy as np
+from koppen_mappings import koppen_mapping_short
+from utilities import N_CLASSES, write_table
+
+# Columnar store of transition counts (Parquet, needs pandas with pyarrow). Every matrix is kept as
+# its non-zero (src, dst, count) entries in one file per model under
+# scenario=<scenario>/time_slice=<time_slice>/region=<region>/, so re-running a model replaces its
+# file and queries read only the directories they ask for. The historical class counts are stored
+# as the diagonal of scenario=historical/time_slice=1981-2010, model 'historical'. count is in grid
+# points or km^2, as recorded in unit. Each file records in its Parquet metadata the signature of
+# the inputs it was counted from (see cache.cache_key: raster paths, mtimes and sizes, the window,
+# the source classes) and the source classes that were counted (null: all), so stale counts are
+# not reused after the rasters change and a class that was not counted is not taken for zero.
+STORE_DIR = os.environ.get('KOPPEN_STORE_DIR', 'results_store')
+METADATA_KEY = b'koppen_store'
+COLUMNS = ['scenario', 'time_slice', 'model', 'region', 'src', 'dst', 'count', 'unit']
+HISTORICAL_SCENARIO, HISTORICAL_SLICE = 'historical', '1981-2010'
+CLASS_IDS = {name.strip(): cat for cat, name in koppen_mapping_short.items()}
+
+
+# Function to name the region of a (min_lon, min_lat, max_lon, max_lat) bounding box
+def bbox_region(bbox):
+    return 'bbox_' + '_'.join(f'{value:g}' for value in bbox)
+
+
+# Function to get the unit of the counts of a run
+def count_unit(area_weighted):
+    return 'km2' if area_weighted else 'grid_points'
+
+
+# Function to get the file holding the matrix of one model
+def transitions_path(scenario, time_slice, region, model, unit, store_dir=STORE_DIR):
+    return os.path.join(store_dir, f'scenario={scenario}', f'time_slice={time_slice}', f'region={region}', f'{model}.{unit}.parquet')
+
+
+# Function to build the signature of the counts of a model (or of the historical map alone) over a
+# window; it changes when a raster is rewritten
+def transitions_signature(paths, window, source_classes=None):
+    from cache import cache_key
+    return cache_key(paths, window, kind='transitions', source_classes=None if source_classes is None else sorted(source_classes))
+
+
+# Function to store the non-zero entries of one transition matrix, replacing what the model had stored.
+# signature and source_classes describe what the matrix was counted from (see transitions_signature).
+def write_transitions(matrix, scenario, time_slice, model, region, unit='grid_points', store_dir=STORE_DIR, signature=None,
+                      source_classes=None):
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    src, dst = np.nonzero(matrix)
+    frame = pd.DataFrame({'model': model, 'src': src.astype(np.uint8), 'dst': dst.astype(np.uint8),
+                          'count': np.asarray(matrix, dtype=np.float64)[src, dst], 'unit': unit},
+                         columns=['model', 'src', 'dst', 'count', 'unit'])
+    path = transitions_path(scenario, time_slice, region, model, unit, store_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Dot files are not read by the queries, so a partly written file is never seen
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.{os.getpid()}.tmp')
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    provenance = {'signature': signature, 'source_classes': None if source_classes is None else sorted(int(cat) for cat in source_classes)}
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), METADATA_KEY: json.dumps(provenance).encode()})
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Function to read the signature and source classes recorded with a stored file ({} for files without them)
+def read_provenance(path):
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata[METADATA_KEY]) if METADATA_KEY in metadata else {}
+
+
+# Function to store the class counts of the historical map as the diagonal of a matrix
+def write_class_counts(counts, region, unit='grid_points', store_dir=STORE_DIR, signature=None):
+    write_transitions(np.diag(counts), HISTORICAL_SCENARIO, HISTORICAL_SLICE, 'historical', region, unit, store_dir, signature)
+
+
+# Function to read the class counts of the historical map stored by write_class_counts
+def read_class_counts(region, unit='grid_points', store_dir=STORE_DIR):
+    return np.diag(read_transitions(HISTORICAL_SCENARIO, HISTORICAL_SLICE, region, 'historical', unit, store_dir)).copy()
+
+
+# Function to store matrices as they are produced and pass them on (matrices can be a generator);
+# signatures holds the signature of every model
+def write_each(matrices, scenario, time_slice, models, region, unit='grid_points', store_dir=STORE_DIR, signatures=None,
+               source_classes=None):
+    signatures = signatures or [None] * len(models)
+    for model, signature, matrix in zip(models, signatures, matrices):
+        write_transitions(matrix, scenario, time_slice, model, region, unit, store_dir, signature, source_classes)
+        yield matrix
+
+
+# Function to check whether the matrix of a model is stored and was counted from the inputs with the given signature
+def has_transitions(scenario, time_slice, region, model, unit='grid_points', store_dir=STORE_DIR, signature=None):
+    path = transitions_path(scenario, time_slice, region, model, unit, store_dir)
+    if not os.path.exists(path):
+        return False
+    return signature is None or read_provenance(path).get('signature') == signature
+
+
+# Function to list the models with a stored matrix for a scenario, time slice, region and unit
+def stored_models(scenario, time_slice, region, unit='grid_points', store_dir=STORE_DIR):
+    directory = os.path.dirname(transitions_path(scenario, time_slice, region, '', unit, store_dir))
+    suffix = f'.{unit}.parquet'
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len(suffix)] for name in os.listdir(directory) if name.endswith(suffix) and not name.startswith('.'))
+
+
+# Function to read the stored matrix of one model
+def read_transitions(scenario, time_slice, region, model, unit='grid_points', store_dir=STORE_DIR):
+    import pandas as pd
+    frame = pd.read_parquet(transitions_path(scenario, time_slice, region, model, unit, store_dir))
+    matrix = np.zeros((N_CLASSES, N_CLASSES))
+    matrix[frame['src'].to_numpy(np.intp), frame['dst'].to_numpy(np.intp)] = frame['count'].to_numpy()
+    return matrix
+
+
+# Function to turn a class given as a code (30) or a name ('ET') into its code
+def class_id(cat):
+    return CLASS_IDS[cat] if isinstance(cat, str) else int(cat)
+
+
+# Function to list the stored files of a selection of partitions, models and units (None: all)
+def stored_files(scenario=None, time_slice=None, region=None, model=None, unit=None, store_dir=STORE_DIR):
+    choices = [['*'] if values is None else values for values in (scenario, time_slice, region, model, unit)]
+    paths = set()
+    for values in itertools.product(*choices):
+        paths.update(glob.glob(transitions_path(*values, store_dir=store_dir)))
+    return sorted(paths)
+
+
+# Function to select stored counts. Every argument is a value or a list of values (None: all);
+# src and dst take class codes or names. Returns a DataFrame with COLUMNS. Asking for a source class
+# that a selected file did not count raises a ValueError instead of returning no rows.
+def query(scenario=None, time_slice=None, model=None, region=None, src=None, dst=None, unit=None, store_dir=STORE_DIR):
+    import pandas as pd
+    if not os.path.isdir(store_dir):
+        return pd.DataFrame(columns=COLUMNS)
+    as_list = lambda value: value if isinstance(value, (list, tuple)) else [value]
+    selection = {'scenario': scenario, 'time_slice': time_slice, 'region': region, 'model': model, 'unit': unit,
+                 'src': None if src is None else [class_id(cat) for cat in as_list(src)],
+                 'dst': None if dst is None else [class_id(cat) for cat in as_list(dst)]}
+    if selection['src'] is not None:
+        partitions = [None if selection[name] is None else as_list(selection[name])
+                      for name in ('scenario', 'time_slice', 'region', 'model', 'unit')]
+        for path in stored_files(*partitions, store_dir=store_dir):
+            counted = read_provenance(path).get('source_classes')
+            missing = [] if counted is None else sorted(set(selection['src']) - set(counted))
+            if missing:
+                names = lambda cats: ', '.join(koppen_mapping_short[cat].strip() for cat in cats)
+                raise ValueError(f"{path} only counted transitions out of {names(counted)}, not out of {names(missing)}")
+    filters = [(column, 'in', as_list(values)) for column, values in selection.items() if values is not None]
+    frame = pd.read_parquet(store_dir, filters=filters or None)
+    # The partition columns come back as categories
+    for column in ['scenario', 'time_slice', 'region']:
+        frame[column] = frame[column].astype(str)
+    return frame[COLUMNS].sort_values(COLUMNS[:6], ignore_index=True)
+
+
+# Function to rebuild the matrices of the rows of a query: {(scenario, time_slice, region, model): matrix}
+def query_matrices(frame):
+    matrices = {}
+    for key, rows in frame.groupby(['scenario', 'time_slice', 'region', 'model'], sort=True):
+        matrix = np.zeros((N_CLASSES, N_CLASSES))
+        matrix[rows['src'].to_numpy(np.intp), rows['dst'].to_numpy(np.intp)] = rows['count'].to_numpy()
+        matrices[key] = matrix
+    return matrices
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the stored transition counts, e.g. --scenario ssp585 --src ET --dst Dfc.')
+    parser.add_argument('--store', type=str, help='Directory of the results store', default=STORE_DIR)
+    parser.add_argument('--scenario', type=str, nargs='+', help='Scenarios (default: all)', default=None)
+    parser.add_argument('--time_slice', type=str, nargs='+', help='Time slices (default: all)', default=None)
+    parser.add_argument('--model', type=str, nargs='+', help='Models (default: all)', default=None)
+    parser.add_argument('--region', type=str, nargs='+', help='Regions, e.g. bbox_45_34_90_56 (default: all)', default=None)
+    parser.add_argument('--src', type=str, nargs='+', help='Source classes, by name or code (default: all)', default=None)
+    parser.add_argument('--dst', type=str, nargs='+', help='Destination classes, by name or code (default: all)', default=None)
+    parser.add_argument('--unit', type=str, choices=['grid_points', 'km2'], help='Unit of the counts (default: all)', default=None)
+    parser.add_argument('--out', type=str, help='Write the rows to this .csv or .parquet file instead of printing them', default=None)
+    args = parser.parse_args()
+
+    classes = lambda values: None if values is None else [int(value) if value.isdigit() else value for value in values]
+    frame = query(args.scenario, args.time_slice, args.model, args.region, classes(args.src), classes(args.dst), args.unit, args.store)
+    if args.out is None:
+        print(frame.assign(src=frame['src'].map(lambda cat: koppen_mapping_short[cat].strip()),
+                           dst=frame['dst'].map(lambda cat: koppen_mapping_short[cat].strip())).to_string(index=False))
+    else:
+        write_table(args.out, COLUMNS, frame.itertuples(index=False, name=None))
+        print(f"{len(frame)} rows written to {args.out}")
@@ -0,0 +1,233 @@
+import argparse
+import json
+import os
+import numpy as np
+from osgeo import gdal
+from cache import cache_key
+from utilities import (BASE_DIR, MODELS, SCENARIOS, TIME_SLICES, bbox_to_window, changes_dict, discover_models, ensemble_transition_stats,
+                       kg2_historical_path, kg2_model_path, pixel_area_rows, run_jobs, tiled_agreement, transition_job)
+
+# Incremental batch runner driven by a JSON run manifest (see manifest_example.json). The manifest
+# is expanded into a graph of stats nodes (transition matrices, agreement maps) and figure nodes
+# that depend on them. Every node gets a signature from its input files (path, mtime, size), its
+# parameters and the signatures of the nodes it depends on; the signature of every output is
+# recorded in STATE_FILE, and a node is only rebuilt when its output is missing or its signature
+# changed, so editing one input or one style parameter rebuilds only what depends on it.
+STATE_FILE = 'runner_state.json'
+DEFAULT_MANIFEST = {
+    'base_dir': BASE_DIR,
+    'output_dir': 'runs',
+    'scenarios': SCENARIOS,
+    'time_slices': TIME_SLICES,
+    'models': MODELS,
+    'bboxes': {'central_asia': [45, 34, 90, 56]},
+    'classes': [30],
+    'area_weighted': False,
+    'workers': 1,
+    'outputs': {'migrations': {'top_n': 20, 'x_max_lim': 400000}, 'agreement': {}},
+}
+
+
+# One step of the run: kind selects the builder, inputs are raster paths, deps are other nodes
+class Node:
+    def __init__(self, kind, name, output, inputs=(), deps=(), params=None):
+        self.kind = kind
+        self.name = name
+        self.output = output
+        self.inputs = list(inputs)
+        self.deps = list(deps)
+        self.params = params or {}
+        self.signature = None
+
+
+# Function to read a manifest and fill in the defaults
+def load_manifest(path):
+    with open(path) as f:
+        manifest = dict(DEFAULT_MANIFEST, **json.load(f))
+    manifest['outputs'] = {kind: dict(DEFAULT_MANIFEST['outputs'].get(kind, {}), **style)
+                           for kind, style in manifest['outputs'].items()}
+    return manifest
+
+
+# Function to expand the manifest into the list of nodes, dependencies before dependants.
+# Model rasters that do not exist are reported and left out of the ensemble; with "models": null
+# the models are discovered from the directory tree.
+def build_graph(manifest):
+    base_dir = manifest['base_dir']
+    stats_dir = os.path.join(manifest['output_dir'], 'stats')
+    figures_dir = os.path.join(manifest['output_dir'], 'figures')
+    historical_path = kg2_historical_path(base_dir)
+    geo_transform = gdal.Open(historical_path).GetGeoTransform()
+    classes = manifest['classes']
+    area_weighted = manifest['area_weighted']
+    outputs = manifest['outputs']
+    nodes = []
+    for bbox_name, bbox in manifest['bboxes'].items():
+        window = bbox_to_window(geo_transform, bbox)
+        for scenario in manifest['scenarios']:
+            for time_slice in manifest['time_slices']:
+                model_names, model_paths = [], []
+                # "models": null takes every model found in the directory tree
+                if manifest['models'] is None:
+                    candidates = discover_models(time_slice, scenario, base_dir)
+                else:
+                    candidates = [(model, kg2_model_path(time_slice, model, scenario, base_dir)) for model in manifest['models']]
+                for model, model_path in candidates:
+                    if os.path.exists(model_path):
+                        model_names.append(model)
+                        model_paths.append(model_path)
+                    else:
+                        print(f"File does not exist: {model_path}")
+                if not model_paths:
+                    continue
+                tag = f'{bbox_name}_{time_slice}_{scenario}'
+                params = {'bbox': bbox, 'window': list(window), 'area_weighted': area_weighted}
+                transitions = [Node('transitions', f'transitions {model} {tag}', os.path.join(stats_dir, f'transitions_{tag}_{model}.npy'),
+                                    inputs=[historical_path, model_path], params=dict(params, source_classes=classes))
+                               for model, model_path in zip(model_names, model_paths)]
+                if 'migrations' in outputs:
+                    nodes += transitions
+                for cat in classes:
+                    if 'migrations' in outputs:
+                        nodes.append(Node('migrations', f'migrations {cat} {tag}', os.path.join(figures_dir, f'migrations_{cat}_{tag}.png'),
+                                          deps=transitions, params=dict(outputs['migrations'], source_class=cat, area_weighted=area_weighted)))
+                    if 'agreement' in outputs:
+                        agreement = Node('agreement_stats', f'agreement {cat} {tag}', os.path.join(stats_dir, f'agreement_{cat}_{tag}.npz'),
+                                         inputs=[historical_path] + model_paths, params=dict(params, target_cat=cat))
+                        nodes.append(agreement)
+                        nodes.append(Node('agreement', f'agreement figure {cat} {tag}', os.path.join(figures_dir, f'agreement_{cat}_{tag}.png'),
+                                          deps=[agreement], params=dict(outputs['agreement'], target_cat=cat, bbox=bbox,
+                                                                        area_weighted=area_weighted,
+                                                                        model_names=['historical'] + model_names)))
+    return nodes
+
+
+# Function to compute the signature of every node; dependencies come first in the list
+def sign(nodes):
+    for node in nodes:
+        params = dict(node.params)
+        window = params.pop('window', ())
+        node.signature = cache_key(node.inputs, window, kind=node.kind, deps=[dep.signature for dep in node.deps], **params)
+
+
+# Function to load the recorded output signatures of a previous run
+def load_state(output_dir):
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# Function to record the output signatures, replacing the file atomically
+def save_state(state, output_dir):
+    path = os.path.join(output_dir, STATE_FILE)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# Function to pick the nodes whose output is missing or was built from different inputs
+def stale_nodes(nodes, state, force=False):
+    return [node for node in nodes
+            if force or not os.path.exists(node.output) or state.get(node.output) != node.signature]
+
+
+# Function to compute the row areas of a node's window when it is area weighted
+def _row_area(node, geo_transform):
+    window = node.params['window']
+    return pixel_area_rows(geo_transform, window[1], window[3] - window[1]) if node.params['area_weighted'] else None
+
+
+# Function to build all stale transition matrices, spread over the worker processes
+def build_transitions(nodes, workers=1):
+    jobs = []
+    for node in nodes:
+        historical_path, model_path = node.inputs
+        row_area = _row_area(node, gdal.Open(historical_path).GetGeoTransform())
+        jobs.append((historical_path, model_path, tuple(node.params['window']), node.params['source_classes'], gdal.Open, row_area))
+    for node, matrix in zip(nodes, run_jobs(transition_job, jobs, workers)):
+        np.save(node.output, matrix)
+        yield node
+
+
+# Function to build the agreement map of one class over the models of a node
+def build_agreement_stats(node, workers=1):
+    historical_path, model_paths = node.inputs[0], node.inputs[1:]
+    row_area = _row_area(node, gdal.Open(historical_path).GetGeoTransform())
+    agreement, historical_mask, counts = tiled_agreement(historical_path, model_paths, tuple(node.params['window']),
+                                                         node.params['target_cat'], workers=workers, row_area=row_area)
+    np.savez_compressed(node.output, agreement=agreement, historical_mask=historical_mask, counts=counts)
+
+
+# Function to render the ensemble migration bar chart from the transition matrices of a node
+def render_migrations(node):
+    from charts import plot_migrations_bar
+    mean_matrix, std_matrix = ensemble_transition_stats([np.load(dep.output) for dep in node.deps])
+    means = changes_dict(mean_matrix)
+    std_devs = {change: std_matrix[change] for change in means}
+    plot_migrations_bar(means, std_devs, node.output, source_class=node.params['source_class'], top_n=node.params['top_n'],
+                        x_max_lim=node.params['x_max_lim'], area_weighted=node.params['area_weighted'])
+
+
+# Function to render the agreement map of a node from its agreement stats
+def render_agreement(node):
+    from plots import plot_agreement
+    with np.load(node.deps[0].output) as stats:
+        plot_agreement(stats['agreement'], stats['historical_mask'], stats['counts'], node.params['model_names'],
+                       node.params['target_cat'], node.params['bbox'], node.output, area_weighted=node.params['area_weighted'])
+
+
+# Function to draw the figure of a migrations or agreement node (run in a worker process)
+def render_node(node):
+    if node.kind == 'migrations':
+        render_migrations(node)
+    else:
+        render_agreement(node)
+
+
+# Function to rebuild the stale nodes in dependency order, recording each output as it is written
+def run(nodes, output_dir, workers=1, force=False, dry_run=False):
+    sign(nodes)
+    state = load_state(output_dir)
+    stale = stale_nodes(nodes, state, force=force)
+    print(f"{len(stale)} of {len(nodes)} outputs to rebuild")
+    if dry_run:
+        for node in stale:
+            print(f"  {node.name} -> {node.output}")
+        return stale
+    for sub_dir in {os.path.dirname(node.output) for node in stale}:
+        os.makedirs(sub_dir, exist_ok=True)
+
+    def done(node):
+        state[node.output] = node.signature
+        save_state(state, output_dir)
+        print(f"Built {node.output}")
+
+    # The transition matrices share one pool; everything after them depends on stats already written
+    for node in build_transitions([node for node in stale if node.kind == 'transitions'], workers):
+        done(node)
+    for node in stale:
+        if node.kind == 'agreement_stats':
+            build_agreement_stats(node, workers)
+            done(node)
+    # The figures only read stats written above, so they are drawn in parallel
+    figures = [node for node in stale if node.kind in ('migrations', 'agreement')]
+    for node, _ in zip(figures, run_jobs(render_node, figures, workers)):
+        done(node)
+    return stale
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the stats and figures of a run manifest that are out of date.')
+    parser.add_argument('manifest', type=str, help='JSON run manifest')
+    parser.add_argument('--workers', type=int, help='Number of worker processes (overrides the manifest)', default=None)
+    parser.add_argument('--force', action='store_true', help='Rebuild every output')
+    parser.add_argument('--dry_run', action='store_true', help='Only list the outputs that would be rebuilt')
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.manifest)
+    nodes = build_graph(manifest)
+    workers = manifest['workers'] if args.workers is None else args.workers
+    run(nodes, manifest['output_dir'], workers=workers, force=args.force, dry_run=args.dry_run)
@@ -0,0 +1,87 @@
+import types
+import numpy as np
+import pytest
+import bbox_index
+from cache import WindowRaster
+from utilities import N_CLASSES
+
+# 200 x 150 pixels of 1/8 degree from (0, 20); 16-pixel tiles leave partial tiles on the right and bottom edges
+GEO_TRANSFORM = (0.0, 0.125, 0, 20.0, 0, -0.125)
+HEIGHT, WIDTH = 150, 200
+TILE_SIZE = 16
+
+
+# Stand-in for a GDAL dataset holding a whole raster
+class ArrayRaster(WindowRaster):
+    def __init__(self, array, path):
+        super().__init__(array, (0, 0, array.shape[1], array.shape[0]), path)
+        self.RasterYSize, self.RasterXSize = array.shape
+
+    def GetGeoTransform(self):
+        return GEO_TRANSFORM
+
+
+@pytest.fixture
+def rasters(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    arrays = {}
+    for name in ['historical', 'model']:
+        path = str(tmp_path / f'{name}.tif')
+        # The cache keys stat the files, the contents are read through ArrayRaster
+        open(path, 'w').close()
+        arrays[path] = rng.integers(0, N_CLASSES, size=(HEIGHT, WIDTH)).astype(np.uint8)
+    monkeypatch.setattr(bbox_index, 'gdal', types.SimpleNamespace(Open=lambda path: ArrayRaster(arrays[path], path)))
+    historical_path, model_path = arrays
+    index_dir = str(tmp_path / 'index')
+    bbox_index.build_index(historical_path, tile_size=TILE_SIZE, index_dir=index_dir)
+    bbox_index.build_index(model_path, historical_path, tile_size=TILE_SIZE, index_dir=index_dir)
+    return arrays, historical_path, model_path, index_dir
+
+
+# Function to get the bbox of a pixel range
+def pixel_bbox(x0, y0, x1, y1):
+    return (x0 * GEO_TRANSFORM[1], GEO_TRANSFORM[3] + y1 * GEO_TRANSFORM[5],
+            x1 * GEO_TRANSFORM[1], GEO_TRANSFORM[3] + y0 * GEO_TRANSFORM[5])
+
+
+BOXES = [(0, 0, WIDTH, HEIGHT), (32, 16, 112, 96), (48, 64, WIDTH, HEIGHT), (16, 0, 32, 16), (64, 64, 64, 96)]
+
+
+@pytest.mark.parametrize('box', BOXES)
+def test_class_counts(rasters, box):
+    arrays, historical_path, _, index_dir = rasters
+    x0, y0, x1, y1 = box
+    counts, snapped_bbox = bbox_index.query_class_counts(historical_path, pixel_bbox(*box), tile_size=TILE_SIZE, index_dir=index_dir)
+    window = arrays[historical_path][y0:y1, x0:x1]
+    expected = np.bincount(window.ravel(), minlength=N_CLASSES)
+    expected[0] = 0
+    np.testing.assert_array_equal(counts, expected)
+    assert snapped_bbox == pytest.approx(pixel_bbox(*box))
+
+
+@pytest.mark.parametrize('box', BOXES)
+def test_transitions(rasters, box):
+    arrays, historical_path, model_path, index_dir = rasters
+    x0, y0, x1, y1 = box
+    matrix, _ = bbox_index.query_transitions(model_path, historical_path, pixel_bbox(*box), tile_size=TILE_SIZE, index_dir=index_dir)
+    historical = arrays[historical_path][y0:y1, x0:x1].astype(np.intp)
+    future = arrays[model_path][y0:y1, x0:x1].astype(np.intp)
+    valid = (historical > 0) & (future > 0)
+    expected = np.zeros((N_CLASSES, N_CLASSES), dtype=np.int64)
+    np.add.at(expected, (historical[valid], future[valid]), 1)
+    np.testing.assert_array_equal(matrix, expected)
+
+
+def test_bbox_snaps_to_the_tile_grid(rasters):
+    arrays, historical_path, _, index_dir = rasters
+    # 3 pixels off the tile edges on every side snap back to tiles 2..6 x 1..5
+    counts, snapped_bbox = bbox_index.query_class_counts(historical_path, pixel_bbox(35, 13, 109, 83), tile_size=TILE_SIZE,
+                                                         index_dir=index_dir)
+    assert snapped_bbox == pytest.approx(pixel_bbox(32, 16, 112, 80))
+    assert counts.sum() == np.count_nonzero(arrays[historical_path][16:80, 32:112])
+
+
+def test_missing_index(rasters):
+    _, historical_path, _, index_dir = rasters
+    with pytest.raises(FileNotFoundError, match='No bbox index'):
+        bbox_index.load_index(historical_path, tile_size=2 * TILE_SIZE, index_dir=index_dir)
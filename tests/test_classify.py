@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from classify import classify
+from koppen_mappings import koppen_mapping_short
+
+# Monthly climate normals (Jan-Dec; tas in degC, pr in mm/month) of reference stations and their class
+STATIONS = {
+    'Singapore': ([26.5, 27.1, 27.5, 28.0, 28.3, 28.3, 27.9, 27.9, 27.6, 27.6, 27.0, 26.5],
+                  [243, 160, 185, 179, 171, 162, 158, 176, 169, 193, 256, 288], 'Af'),
+    'Cairo': ([14.0, 15.0, 18.0, 21.5, 25.0, 27.5, 28.0, 28.0, 26.0, 23.0, 19.0, 15.5],
+              [5, 4, 4, 1, 0.5, 0, 0, 0, 0, 1, 3, 6], 'BWh'),
+    'Rome': ([7.5, 8.5, 10.8, 13.5, 17.8, 21.8, 24.6, 24.6, 21.1, 16.8, 11.8, 8.6],
+             [67, 73, 58, 62, 33, 17, 19, 37, 73, 113, 115, 81], 'Csa'),
+    'London': ([5.2, 5.3, 7.6, 9.9, 13.3, 16.5, 18.7, 18.5, 15.7, 12.0, 8.0, 5.5],
+               [55, 41, 42, 44, 49, 45, 45, 50, 49, 69, 59, 55], 'Cfb'),
+    'Moscow': ([-6.5, -6.7, -1.0, 6.7, 13.2, 17.0, 19.2, 17.0, 11.3, 5.6, -0.5, -4.6],
+               [53, 44, 39, 36, 51, 79, 84, 78, 66, 71, 55, 52], 'Dfb'),
+    'Yakutsk': ([-38.6, -33.8, -20.1, -4.8, 7.5, 16.4, 19.5, 15.2, 6.1, -7.8, -27.0, -37.6],
+                [9, 8, 7, 10, 19, 35, 41, 40, 25, 18, 14, 10], 'Dfd'),
+    'Utqiagvik': ([-25.6, -27.6, -26.0, -17.6, -5.5, 2.5, 5.4, 3.8, -0.5, -8.9, -18.2, -22.8],
+                  [4, 4, 3, 3, 4, 8, 22, 25, 16, 10, 5, 4], 'ET'),
+    'Vostok': ([-31, -43, -57, -61, -61, -60, -62, -62, -61, -54, -41, -30], [1] * 12, 'EF'),
+}
+CLASS_IDS = {name.strip(): cat for cat, name in koppen_mapping_short.items()}
+
+
+@pytest.mark.parametrize('station', STATIONS)
+def test_reference_station(station):
+    tas, pr, expected = STATIONS[station]
+    assert classify(np.array(tas)[:, None], np.array(pr)[:, None])[0] == CLASS_IDS[expected]
+
+
+def test_stations_as_one_raster():
+    tas = np.array([STATIONS[station][0] for station in STATIONS]).T.reshape(12, 2, 4)
+    pr = np.array([STATIONS[station][1] for station in STATIONS]).T.reshape(12, 2, 4)
+    expected = np.array([CLASS_IDS[STATIONS[station][2]] for station in STATIONS]).reshape(2, 4)
+    classes = classify(tas, pr)
+    assert classes.dtype == np.uint8
+    np.testing.assert_array_equal(classes, expected)
+
+
+def test_missing_month_is_nodata():
+    tas, pr, _ = STATIONS['London']
+    tas = np.array(tas)[:, None]
+    tas[5] = np.nan
+    assert classify(tas, np.array(pr)[:, None])[0] == 0
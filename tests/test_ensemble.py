@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from ensemble import RunningStats, stream_stats
+from utilities import ensemble_transition_stats
+
+
+# Function to draw a stack of members (e.g. per-model transition matrices)
+def members(seed, n=7, shape=(4, 5)):
+    return np.random.default_rng(seed).gamma(2.0, 50.0, size=(n,) + shape)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_running_stats_match_numpy(seed):
+    stack = members(seed)
+    stats = stream_stats(iter(stack))
+    assert stats.count == len(stack)
+    np.testing.assert_allclose(stats.mean, stack.mean(axis=0))
+    np.testing.assert_allclose(stats.std(), stack.std(axis=0))
+    np.testing.assert_allclose(stats.std(ddof=1), stack.std(axis=0, ddof=1))
+    np.testing.assert_array_equal(stats.min, stack.min(axis=0))
+    np.testing.assert_array_equal(stats.max, stack.max(axis=0))
+
+
+@pytest.mark.parametrize('split', [0, 1, 3, 7])
+def test_merge_matches_one_pass(split):
+    stack = members(0)
+    merged = stream_stats(stack[:split]).merge(stream_stats(stack[split:]))
+    assert merged.count == len(stack)
+    np.testing.assert_allclose(merged.mean, stack.mean(axis=0))
+    np.testing.assert_allclose(merged.variance(), stack.var(axis=0))
+    np.testing.assert_array_equal(merged.min, stack.min(axis=0))
+    np.testing.assert_array_equal(merged.max, stack.max(axis=0))
+
+
+def test_merge_of_many_parts():
+    stack = members(1, n=12)
+    merged = RunningStats()
+    for part in np.array_split(stack, 4):
+        merged.merge(stream_stats(part))
+    np.testing.assert_allclose(merged.mean, stack.mean(axis=0))
+    np.testing.assert_allclose(merged.std(), stack.std(axis=0))
+
+
+def test_quantiles_within_sketch_accuracy():
+    stack = members(2, n=9)
+    stats = stream_stats(stack, quantiles=True)
+    np.testing.assert_allclose(stats.quantile(0.5), np.median(stack, axis=0), rtol=0.02)
+    with pytest.raises(ValueError):
+        RunningStats().add(stack[0]).quantile(0.5)
+
+
+def test_ensemble_transition_stats_without_models():
+    with pytest.raises(ValueError, match='No transition matrices'):
+        ensemble_transition_stats(iter([]))
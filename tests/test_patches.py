@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from patches import PatchAccumulator
+
+CLASSES = [20, 30]
+
+
+# Function to cut a window (minx, miny, maxx, maxy) into a random grid of tiles (xoff, yoff, xsize, ysize)
+def random_tiling(rng, window, max_cuts=5):
+    minx, miny, maxx, maxy = window
+    xs = [minx] + sorted(rng.choice(np.arange(minx + 1, maxx), rng.integers(0, max_cuts), replace=False).tolist()) + [maxx]
+    ys = [miny] + sorted(rng.choice(np.arange(miny + 1, maxy), rng.integers(0, max_cuts), replace=False).tolist()) + [maxy]
+    return [(x0, y0, x1 - x0, y1 - y0) for y0, y1 in zip(ys[:-1], ys[1:]) for x0, x1 in zip(xs[:-1], xs[1:])]
+
+
+# Function to get the patch sizes of every class from labelling the whole raster at once
+def whole_raster_sizes(classes, connectivity, weights=None):
+    structure = np.ones((3, 3), dtype=bool) if connectivity == 8 else None
+    sizes = {}
+    for cat in CLASSES:
+        labels, n = ndimage.label(classes == cat, structure=structure)
+        if n:
+            area = np.bincount(labels.ravel(), weights=None if weights is None else weights.ravel(), minlength=n + 1)[1:]
+            sizes[cat] = np.sort(area)[::-1]
+    return sizes
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('seed', range(10))
+def test_tiled_patches_match_whole_raster(connectivity, seed):
+    rng = np.random.default_rng(seed)
+    window = (7, 3, 7 + 41, 3 + 29)
+    classes = rng.choice([0, 20, 30], size=(29, 41), p=[0.4, 0.3, 0.3]).astype(np.uint8)
+    patches = PatchAccumulator(window, classes=CLASSES, connectivity=connectivity)
+    for xoff, yoff, xsize, ysize in random_tiling(rng, window):
+        block = classes[yoff - 3:yoff - 3 + ysize, xoff - 7:xoff - 7 + xsize]
+        patches.add((xoff, yoff, xsize, ysize), block)
+    stats = patches.patch_stats()
+
+    expected = whole_raster_sizes(classes, connectivity)
+    assert sorted(stats) == sorted(expected)
+    for cat, sizes in expected.items():
+        assert stats[cat]['patches'] == len(sizes)
+        np.testing.assert_array_equal(stats[cat]['sizes'], sizes)
+        assert stats[cat]['largest_share'] == pytest.approx(sizes[0] / sizes.sum())
+
+
+def test_row_area_weights_the_patches():
+    rng = np.random.default_rng(0)
+    window = (0, 0, 30, 20)
+    classes = rng.choice([0, 30], size=(20, 30), p=[0.5, 0.5]).astype(np.uint8)
+    row_area = np.linspace(1.0, 2.0, 20)
+    patches = PatchAccumulator(window, classes=[30])
+    for xoff, yoff, xsize, ysize in random_tiling(rng, window):
+        patches.add((xoff, yoff, xsize, ysize), classes[yoff:yoff + ysize, xoff:xoff + xsize], row_area=row_area[yoff:yoff + ysize])
+    sizes = whole_raster_sizes(classes, 8, weights=np.broadcast_to(row_area[:, None], classes.shape))[30]
+    np.testing.assert_allclose(patches.patch_stats()[30]['sizes'], sizes)
+
+
+def test_classes_outside_the_selection_are_ignored():
+    classes = np.array([[30, 30, 0, 20], [0, 30, 0, 20]], dtype=np.uint8)
+    patches = PatchAccumulator((0, 0, 4, 2), classes=[30])
+    patches.add((0, 0, 2, 2), classes[:, :2])
+    patches.add((2, 0, 2, 2), classes[:, 2:])
+    stats = patches.patch_stats()
+    assert list(stats) == [30]
+    assert stats[30]['patches'] == 1 and stats[30]['area'] == 3
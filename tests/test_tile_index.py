@@ -0,0 +1,112 @@
+import types
+import numpy as np
+import pytest
+import tile_index
+import utilities
+from cache import WindowRaster
+from utilities import (N_CLASSES, READ_STATS, tiled_agreement, tiled_agreement_cube, tiled_class_histogram,
+                       tiled_transition_matrix)
+
+HEIGHT, WIDTH = 100, 150
+TILE_SIZE = 32
+# Classes a tile is drawn from: ocean, ocean and ET, only Dfc, a mix
+TILE_CLASSES = [[0], [0, 30], [20], [0, 5, 20, 30]]
+
+
+# Stand-in for a GDAL dataset holding a whole raster, read in TILE_SIZE x TILE_SIZE blocks
+class ArrayRaster(WindowRaster):
+    def __init__(self, array, path):
+        super().__init__(array, (0, 0, array.shape[1], array.shape[0]), path)
+        self.RasterYSize, self.RasterXSize = array.shape
+
+    def GetBlockSize(self):
+        return (TILE_SIZE, TILE_SIZE)
+
+
+# Function to draw a class map whose tiles each hold a random choice of TILE_CLASSES
+def tiled_map(rng):
+    classes = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    for y in range(0, HEIGHT, TILE_SIZE):
+        for x in range(0, WIDTH, TILE_SIZE):
+            choices = TILE_CLASSES[rng.integers(len(TILE_CLASSES))]
+            classes[y:y + TILE_SIZE, x:x + TILE_SIZE] = rng.choice(choices, size=classes[y:y + TILE_SIZE, x:x + TILE_SIZE].shape)
+    return classes
+
+
+@pytest.fixture
+def rasters(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    arrays = {str(tmp_path / f'{name}.tif'): tiled_map(rng) for name in ['historical', 'model_a', 'model_b', 'model_c']}
+    for path in arrays:
+        open(path, 'w').close()
+    monkeypatch.setattr(tile_index, 'gdal', types.SimpleNamespace(Open=lambda path: ArrayRaster(arrays[path], path)))
+    monkeypatch.setattr(tile_index, '_loaded', {})
+    # One block per index tile instead of the production tile size
+    monkeypatch.setattr(utilities.block_windows, '__defaults__', (TILE_SIZE * TILE_SIZE,))
+    return arrays
+
+
+# Function to run every tiled count over a window with the given open function
+def tiled_counts(arrays, window, row_area):
+    open_dataset = lambda path: ArrayRaster(arrays[path], path)
+    historical_path, *model_paths = arrays
+    historical, future = open_dataset(historical_path), open_dataset(model_paths[0])
+    agreement = tiled_agreement(historical_path, model_paths, window, 30, open_dataset=open_dataset, row_area=row_area)
+    cube = tiled_agreement_cube(historical_path, model_paths, window, open_dataset=open_dataset, row_area=row_area)
+    return {'histogram': tiled_class_histogram(historical, window, row_area=row_area),
+            'transitions': tiled_transition_matrix(historical, future, window, row_area=row_area),
+            'transitions_from_ET': tiled_transition_matrix(historical, future, window, source_classes=[30], row_area=row_area),
+            'transitions_from_Cfb': tiled_transition_matrix(historical, future, window, source_classes=[10], row_area=row_area),
+            'agreement': agreement[0], 'historical_mask': agreement[1], 'agreement_counts': agreement[2],
+            'cube': cube['cube'], 'modal_class': cube['modal_class'], 'cube_counts': cube['counts']}
+
+
+@pytest.mark.parametrize('window', [(0, 0, WIDTH, HEIGHT), (10, 20, 140, 90)])
+@pytest.mark.parametrize('area_weighted', [False, True])
+def test_counts_with_index_match_counts_without(rasters, window, area_weighted):
+    row_area = np.linspace(1.0, 2.0, window[3] - window[1]) if area_weighted else None
+    without_index = tiled_counts(rasters, window, row_area)
+    for path in rasters:
+        tile_index.build_tile_index(path, tile_size=TILE_SIZE)
+    skipped = READ_STATS['skipped_pixels']
+    with_index = tiled_counts(rasters, window, row_area)
+    # The index has to skip something for the comparison to mean anything
+    assert READ_STATS['skipped_pixels'] > skipped
+    for name, expected in without_index.items():
+        np.testing.assert_array_equal(with_index[name], expected, err_msg=name)
+
+
+def test_class_specific_skips(rasters):
+    historical_path = next(iter(rasters))
+    tile_index.build_tile_index(historical_path, tile_size=TILE_SIZE)
+    classes, _ = tile_index.load_tile_index(historical_path)
+    historical = rasters[historical_path]
+    for ty in range(classes.shape[0]):
+        for tx in range(classes.shape[1]):
+            tile = historical[ty * TILE_SIZE:(ty + 1) * TILE_SIZE, tx * TILE_SIZE:(tx + 1) * TILE_SIZE]
+            present = [cat for cat in np.unique(tile) if 0 < cat < N_CLASSES]
+            assert classes[ty, tx] == tile_index.class_bits(present)
+            block = (tx * TILE_SIZE, ty * TILE_SIZE, tile.shape[1], tile.shape[0])
+            assert bool(tile_index.block_classes(historical_path, block) & tile_index.class_bits([30])) == (30 in present)
+
+
+def test_stale_index_is_ignored(rasters):
+    historical_path = next(iter(rasters))
+    tile_index.build_tile_index(historical_path, tile_size=TILE_SIZE)
+    with open(historical_path, 'w') as f:
+        f.write('rewritten')
+    tile_index._loaded.clear()
+    assert tile_index.load_tile_index(historical_path) is None
+    assert tile_index.block_classes(historical_path, (0, 0, TILE_SIZE, TILE_SIZE)) == tile_index.ALL_CLASSES
+
+
+def test_raster_is_checked_once_per_run(rasters, monkeypatch):
+    historical_path = next(iter(rasters))
+    tile_index.build_tile_index(historical_path, tile_size=TILE_SIZE)
+    stat_calls = []
+    stat = tile_index.os.stat
+    monkeypatch.setattr(tile_index.os, 'stat', lambda path, **kwargs: stat_calls.append(path) or stat(path, **kwargs))
+    for y in range(0, HEIGHT, TILE_SIZE):
+        for x in range(0, WIDTH, TILE_SIZE):
+            tile_index.block_classes(historical_path, (x, y, TILE_SIZE, TILE_SIZE))
+    assert stat_calls.count(historical_path) == 1
@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+import utilities
+from cache import WindowRaster
+from utilities import (N_CLASSES, block_windows, changes_dict, class_histogram, ensemble_transition_stats, run_jobs,
+                       tiled_class_histogram, tiled_transition_matrix, transition_job, transition_matrix)
+
+HEIGHT, WIDTH = 90, 130
+BLOCK_SIZE = 16
+
+
+# Stand-in for a GDAL dataset holding a whole raster, read in BLOCK_SIZE x BLOCK_SIZE blocks
+class ArrayRaster(WindowRaster):
+    def __init__(self, array, path=None):
+        super().__init__(array, (0, 0, array.shape[1], array.shape[0]), path)
+        self.RasterYSize, self.RasterXSize = array.shape
+
+    def GetBlockSize(self):
+        return (BLOCK_SIZE, BLOCK_SIZE)
+
+
+# Function to open a saved class map (module level, so jobs can be pickled to worker processes)
+def open_npy(path):
+    return ArrayRaster(np.load(path), path)
+
+
+# The per-pixel loop the transition-matrix engine replaced, weighted by the area of the row
+def loop_changes(historical_array, future_array, row_area=None):
+    changes = {}
+    for i in range(historical_array.shape[0]):
+        for j in range(historical_array.shape[1]):
+            historical_class = historical_array[i, j]
+            future_class = future_array[i, j]
+            if historical_class != future_class:
+                change_pair = (int(historical_class), int(future_class))
+                changes[change_pair] = changes.get(change_pair, 0) + (1 if row_area is None else row_area[i])
+    return changes
+
+
+# Function to draw a class map with nodata (0) and out-of-range values (255)
+def class_map(rng, shape=(HEIGHT, WIDTH)):
+    classes = rng.integers(1, N_CLASSES, size=shape).astype(np.uint8)
+    classes[rng.random(shape) < 0.2] = 0
+    classes[rng.random(shape) < 0.05] = 255
+    # Large areas that stay the same class, like real maps
+    classes[:shape[0] // 3] = 30
+    return classes
+
+
+# Function to tell whether a class code is a valid class (not nodata)
+def valid(cat):
+    return 0 < cat < N_CLASSES
+
+
+@pytest.fixture
+def maps(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    paths = []
+    for name in ['historical', 'model_a', 'model_b', 'model_c']:
+        paths.append(str(tmp_path / f'{name}.npy'))
+        np.save(paths[-1], class_map(rng))
+    # Small tiles, so the windows span many of them
+    monkeypatch.setattr(utilities.block_windows, '__defaults__', (2 * BLOCK_SIZE * BLOCK_SIZE,))
+    return paths
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_changes_match_the_loop(seed):
+    rng = np.random.default_rng(seed)
+    historical, future = class_map(rng, (40, 50)), class_map(rng, (40, 50))
+    expected = {pair: count for pair, count in loop_changes(historical, future).items() if valid(pair[0]) and valid(pair[1])}
+    assert changes_dict(transition_matrix(historical, future)) == expected
+
+
+def test_nodata_destinations_are_dropped():
+    # The per-pixel loop counted e.g. ET -> nodata as a change; the engine drops nodata on either side
+    historical = np.array([[30, 30, 30, 0]], dtype=np.uint8)
+    future = np.array([[0, 255, 20, 20]], dtype=np.uint8)
+    assert loop_changes(historical, future) == {(30, 0): 1, (30, 255): 1, (30, 20): 1, (0, 20): 1}
+    assert changes_dict(transition_matrix(historical, future)) == {(30, 20): 1}
+
+
+def test_source_classes_and_area_weights():
+    rng = np.random.default_rng(3)
+    historical, future = class_map(rng, (40, 50)), class_map(rng, (40, 50))
+    row_area = np.linspace(10.0, 20.0, 40)
+    expected = {pair: area for pair, area in loop_changes(historical, future, row_area).items() if pair[0] == 30 and valid(pair[1])}
+    changes = changes_dict(transition_matrix(historical, future, source_classes=[30], row_area=row_area))
+    assert changes.keys() == expected.keys()
+    for pair, area in expected.items():
+        assert changes[pair] == pytest.approx(area)
+    # The diagonal holds the pixels that keep their class
+    matrix = transition_matrix(historical, future)
+    assert np.trace(matrix) == np.count_nonzero((historical == future) & (historical > 0) & (historical < N_CLASSES))
+
+
+@pytest.mark.parametrize('window', [(0, 0, WIDTH, HEIGHT), (7, 5, 120, 83), (40, 40, 41, 41)])
+def test_blocks_cover_the_window_once(maps, window):
+    minx, miny, maxx, maxy = window
+    covered = np.zeros((HEIGHT, WIDTH), dtype=int)
+    for xoff, yoff, xsize, ysize in block_windows(open_npy(maps[0]), window):
+        covered[yoff:yoff + ysize, xoff:xoff + xsize] += 1
+    expected = np.zeros((HEIGHT, WIDTH), dtype=int)
+    expected[miny:maxy, minx:maxx] = 1
+    np.testing.assert_array_equal(covered, expected)
+
+
+@pytest.mark.parametrize('window', [(0, 0, WIDTH, HEIGHT), (7, 5, 120, 83)])
+@pytest.mark.parametrize('source_classes', [None, [30], [5, 30]])
+def test_tiled_counts_match_whole_array(maps, window, source_classes):
+    minx, miny, maxx, maxy = window
+    historical, future = open_npy(maps[0]), open_npy(maps[1])
+    whole_historical, whole_future = historical.array[miny:maxy, minx:maxx], future.array[miny:maxy, minx:maxx]
+    row_area = np.linspace(1.0, 2.0, maxy - miny)
+    np.testing.assert_array_equal(tiled_transition_matrix(historical, future, window, source_classes=source_classes),
+                                  transition_matrix(whole_historical, whole_future, source_classes=source_classes))
+    np.testing.assert_allclose(tiled_transition_matrix(historical, future, window, source_classes=source_classes, row_area=row_area),
+                               transition_matrix(whole_historical, whole_future, source_classes=source_classes, row_area=row_area))
+    np.testing.assert_array_equal(tiled_class_histogram(historical, window), class_histogram(whole_historical))
+
+
+@pytest.mark.parametrize('area_weighted', [False, True])
+def test_workers_give_identical_results(maps, area_weighted):
+    window = (7, 5, 120, 83)
+    row_area = np.linspace(1.0, 2.0, window[3] - window[1]) if area_weighted else None
+    historical_path, *model_paths = maps
+    jobs = [(historical_path, model_path, window, [30], open_npy, row_area) for model_path in model_paths]
+    serial = list(run_jobs(transition_job, jobs))
+    parallel = list(run_jobs(transition_job, jobs, workers=2))
+    for serial_matrix, parallel_matrix in zip(serial, parallel):
+        assert serial_matrix.dtype == parallel_matrix.dtype
+        np.testing.assert_array_equal(serial_matrix, parallel_matrix)
+    for serial_stats, parallel_stats in zip(ensemble_transition_stats(serial), ensemble_transition_stats(iter(parallel))):
+        np.testing.assert_array_equal(serial_stats, parallel_stats)
+
+
+def test_worker_reads_are_counted(maps):
+    window = (7, 5, 120, 83)
+    historical_path, *model_paths = maps
+    jobs = [(historical_path, model_path, window, [30], open_npy, None) for model_path in model_paths]
+    counts = {}
+    for workers in [1, 2]:
+        utilities.READ_STATS.update(bytes=0, pixels=0)
+        utilities.PATH_READ_STATS.clear()
+        list(run_jobs(transition_job, jobs, workers))
+        counts[workers] = (utilities.READ_STATS['pixels'],
+                           {path: stats['pixels'] for path, stats in utilities.PATH_READ_STATS.items()})
+    pixels = (window[2] - window[0]) * (window[3] - window[1])
+    assert counts[2] == counts[1]
+    assert counts[2][1] == {path: pixels * (len(model_paths) if path == historical_path else 1) for path in maps}
@@ -0,0 +1,115 @@
+import argparse
+import os
+import numpy as np
+from osgeo import gdal
+
+# Tile-validity index of a kg2 raster: for every TILE_INDEX_SIZE x TILE_INDEX_SIZE tile a uint32
+# bitmask of the classes it contains (bit c set if class c occurs, 0 for ocean/nodata-only tiles).
+# It is written once next to the raster as <raster>.tiles.npz (or under TILE_INDEX_DIR when the
+# data directory is read-only), so the tiled readers in utilities can skip tiles without land or
+# without the classes a query is about. An index is ignored once its raster changes (checked when a
+# process first loads it).
+TILE_INDEX_SIZE = 256
+TILE_INDEX_DIR = os.path.join(os.environ.get('KOPPEN_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'koppen')), 'tiles')
+# Bitmask of every valid class (1 to 31), used when a raster has no index so nothing is skipped
+ALL_CLASSES = (1 << 32) - 2
+_loaded = {}
+
+
+# Function to build the bitmask of a list of classes
+def class_bits(classes):
+    bits = 0
+    for cat in classes:
+        bits |= 1 << int(cat)
+    return bits & ALL_CLASSES
+
+
+# Function to list the places the index of a raster may live: next to it, then in TILE_INDEX_DIR
+def index_paths(path, index_dir=TILE_INDEX_DIR):
+    path = os.path.abspath(path)
+    return [f'{path}.tiles.npz', os.path.join(index_dir, path.strip(os.sep).replace(os.sep, '__') + '.tiles.npz')]
+
+
+# Function to scan a raster once, tile_size rows at a time, and write its tile-validity index
+def build_tile_index(path, tile_size=TILE_INDEX_SIZE, index_dir=TILE_INDEX_DIR):
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    n_tiles_x = -(-width // tile_size)
+    n_tiles_y = -(-height // tile_size)
+    tile_column = np.arange(width) // tile_size
+    bit_values = (1 << np.arange(32, dtype=np.uint64)).astype(np.uint32)
+    classes = np.zeros((n_tiles_y, n_tiles_x), dtype=np.uint32)
+    for tile_row in range(n_tiles_y):
+        yoff = tile_row * tile_size
+        strip = band.ReadAsArray(0, yoff, width, min(tile_size, height - yoff)).astype(np.intp)
+        valid = (strip > 0) & (strip < 32)
+        codes = np.broadcast_to(tile_column, strip.shape)[valid] * 32 + strip[valid]
+        present = np.bincount(codes, minlength=n_tiles_x * 32).reshape(n_tiles_x, 32) > 0
+        classes[tile_row] = np.bitwise_or.reduce(np.where(present, bit_values, 0), axis=1)
+    stat = os.stat(path)
+    for index_path in index_paths(path, index_dir):
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            tmp_path = f'{index_path}.{os.getpid()}.tmp.npz'
+            np.savez_compressed(tmp_path, classes=classes, tile_size=tile_size, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            os.replace(tmp_path, index_path)
+            _loaded.pop(path, None)
+            return index_path
+        except OSError:
+            continue
+    raise OSError(f"Cannot write the tile index of {path}")
+
+
+# Function to load the index of a raster as (classes, tile_size), or None if there is no
+# up-to-date index. The raster is checked against the index on the first load only; the result is
+# kept in memory per process for the rest of the run, so tile queries do not stat the raster.
+def load_tile_index(path, index_dir=TILE_INDEX_DIR):
+    if path in _loaded:
+        return _loaded[path]
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    fingerprint = (stat.st_mtime_ns, stat.st_size)
+    index = None
+    for index_path in index_paths(path, index_dir):
+        if os.path.exists(index_path):
+            with np.load(index_path) as stored:
+                if (int(stored['mtime_ns']), int(stored['size'])) == fingerprint:
+                    index = (stored['classes'], int(stored['tile_size']))
+                    break
+    _loaded[path] = index
+    return index
+
+
+# Function to get the bitmask of the classes present in a tile (xoff, yoff, xsize, ysize) of a
+# raster; without an index every class is assumed present
+def block_classes(path, block):
+    index = load_tile_index(path)
+    if index is None:
+        return ALL_CLASSES
+    classes, tile_size = index
+    xoff, yoff, xsize, ysize = block
+    tiles = classes[yoff // tile_size:-(-(yoff + ysize) // tile_size), xoff // tile_size:-(-(xoff + xsize) // tile_size)]
+    return int(np.bitwise_or.reduce(tiles, axis=None)) if tiles.size else 0
+
+
+# Function to build the index of one path in a worker process
+def build_job(path):
+    return build_tile_index(path)
+
+
+if __name__ == '__main__':
+    from utilities import MODELS, SCENARIOS, TIME_SLICES, kg2_historical_path, kg2_model_path, run_jobs
+    parser = argparse.ArgumentParser(description='Write the tile-validity index of kg2 rasters.')
+    parser.add_argument('paths', nargs='*', help='kg2 rasters to index (default: the historical map and every model map that exists)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args()
+
+    paths = args.paths or [kg2_historical_path()] + [kg2_model_path(time_slice, model, scenario) for scenario in SCENARIOS
+                                                     for time_slice in TIME_SLICES for model in MODELS]
+    paths = [path for path in paths if os.path.exists(path)]
+    for path, index_path in zip(paths, run_jobs(build_job, paths, args.workers)):
+        classes, _ = load_tile_index(path)
+        print(f"{path}: {np.count_nonzero(classes)} of {classes.size} tiles hold data, index written to {index_path}")
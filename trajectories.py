@@ -0,0 +1,208 @@
+import argparse
+import csv
+import sys
+import numpy as np
+from osgeo import gdal
+from koeppen_colors import koppen_colors
+from koppen_mappings import koppen_mapping_short
+from utilities import (N_CLASSES, TIME_SLICES, block_row_area, block_windows, bbox_to_window, discover_models, kg2_historical_path,
+                       kg2_model_path, pixel_area_rows, prefetch, read_block, run_jobs, skip_blocks)
+from tile_index import block_classes
+
+# Per-pixel trajectories hist -> 2011-2040 -> 2041-2070 -> 2071-2100. The four classes of a pixel
+# are packed into one integer ((hist * 32 + c1) * 32 + c2) * 32 + c3, so all trajectories of a tile
+# are counted with one sparse bincount instead of comparing the slices pair by pair.
+N_STEPS = len(TIME_SLICES) + 1
+N_TRAJECTORIES = N_CLASSES ** N_STEPS
+
+
+# Function to encode a stack of class maps (historical first) into trajectory codes; -1 marks nodata
+def encode_trajectories(class_maps):
+    codes = np.zeros(np.shape(class_maps[0]), dtype=np.int64)
+    valid = np.ones(codes.shape, dtype=bool)
+    for classes in class_maps:
+        classes = np.asarray(classes).astype(np.int64)
+        valid &= (classes > 0) & (classes < N_CLASSES)
+        codes = codes * N_CLASSES + classes
+    return np.where(valid, codes, -1)
+
+
+# Function to decode trajectory codes into an (n, N_STEPS) array of classes
+def decode_trajectories(codes):
+    codes = np.asarray(codes, dtype=np.int64)
+    steps = [(codes // N_CLASSES ** (N_STEPS - 1 - k)) % N_CLASSES for k in range(N_STEPS)]
+    return np.stack(steps, axis=-1)
+
+
+# Function to count the trajectories of one tile as sparse (codes, counts); counts are km^2 with row_area
+def trajectory_counts(class_maps, row_area=None):
+    codes = encode_trajectories(class_maps)
+    valid = codes >= 0
+    unique, inverse = np.unique(codes[valid], return_inverse=True)
+    if row_area is None:
+        return unique, np.bincount(inverse, minlength=len(unique))
+    weights = np.broadcast_to(np.asarray(row_area)[:, None], codes.shape)[valid]
+    return unique, np.bincount(inverse, weights=weights, minlength=len(unique))
+
+
+# Function to accumulate the trajectories of one model over a window tile by tile.
+# Returns a dense vector of length N_TRAJECTORIES indexed by trajectory code.
+def tiled_trajectory_counts(historical_path, slice_paths, window, open_dataset=gdal.Open, row_area=None):
+    historical_dataset = open_dataset(historical_path)
+    slice_datasets = [open_dataset(path) for path in slice_paths]
+    totals = np.zeros(N_TRAJECTORIES, dtype=np.int64 if row_area is None else np.float64)
+    # Pixels only count where every time slice holds data
+    blocks = skip_blocks(block_windows(historical_dataset, window),
+                         lambda block: all(block_classes(path, block) for path in [historical_path] + slice_paths))
+    fetch = lambda block: [read_block(dataset, block) for dataset in [historical_dataset] + slice_datasets]
+    for block, class_maps in zip(blocks, prefetch(fetch, blocks)):
+        codes, counts = trajectory_counts(class_maps, row_area=block_row_area(row_area, block, window))
+        totals[codes] += counts
+    return totals
+
+
+# Function to run one (historical_path, slice_paths, window, open_dataset, row_area) job in a worker process
+def trajectory_job(job):
+    historical_path, slice_paths, window, open_dataset, row_area = job
+    return tiled_trajectory_counts(historical_path, slice_paths, window, open_dataset=open_dataset, row_area=row_area)
+
+
+# Function to summarise the trajectories that start in source_class
+def trajectory_summary(totals, source_class=30):
+    codes = np.flatnonzero(totals)
+    steps = decode_trajectories(codes)
+    counts = totals[codes]
+    start = steps[:, 0] == source_class
+    left = np.any(steps[:, 1:] != source_class, axis=1)
+    end_in_source = steps[:, -1] == source_class
+    return {
+        'total': counts[start].sum(),
+        'never_leave': counts[start & ~left].sum(),
+        'leave_and_return': counts[start & left & end_in_source].sum(),
+        'leave_for_good': counts[start & ~end_in_source].sum(),
+    }
+
+
+# Function to write the non-zero trajectories that start in source_class to a CSV file
+def write_trajectories_csv(totals, out_path, source_class=None):
+    codes = np.flatnonzero(totals)
+    steps = decode_trajectories(codes)
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['1981-2010'] + TIME_SLICES + ['count'])
+        for step, count in sorted(zip(steps.tolist(), totals[codes].tolist()), key=lambda x: -x[1]):
+            if source_class is None or step[0] == source_class:
+                writer.writerow([koppen_mapping_short[cat].strip() for cat in step] + [count])
+
+
+# Function to draw an alluvial diagram of the trajectories that start in source_class
+def plot_alluvial(totals, out_path, source_class=30, title=None, min_share=0.001):
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import PathPatch, Rectangle
+    from matplotlib.path import Path
+
+    codes = np.flatnonzero(totals)
+    steps = decode_trajectories(codes)
+    counts = totals[codes].astype(float)
+    keep = steps[:, 0] == source_class
+    steps, counts = steps[keep], counts[keep]
+    total = counts.sum()
+    if total == 0:
+        return
+    # Drop very small flows so the diagram stays readable
+    keep = counts >= min_share * total
+    steps, counts = steps[keep], counts[keep]
+    total = counts.sum()
+
+    node_width = 0.08
+    gap = 0.02 * total
+    columns = ['1981-2010'] + TIME_SLICES
+    fig, ax = plt.subplots(figsize=(12, 8))
+
+    # Stack the classes of every column and remember where each node starts
+    node_top = []
+    height = 0.0
+    for k in range(N_STEPS):
+        sizes = np.bincount(steps[:, k], weights=counts, minlength=N_CLASSES)
+        tops = {}
+        y = 0.0
+        for cat in np.flatnonzero(sizes):
+            tops[cat] = y
+            ax.add_patch(Rectangle((k - node_width / 2, y), node_width, sizes[cat], color=koppen_colors[cat]))
+            if sizes[cat] > 0.02 * total:
+                ax.text(k + node_width / 2 + 0.01, y + sizes[cat] / 2, koppen_mapping_short[cat].strip(), va='center', fontsize=10)
+            y += sizes[cat] + gap
+        node_top.append(tops)
+        height = max(height, y)
+
+    # Draw one band per (class at k, class at k + 1) pair
+    for k in range(N_STEPS - 1):
+        pair_codes = steps[:, k] * N_CLASSES + steps[:, k + 1]
+        flows = np.bincount(pair_codes, weights=counts, minlength=N_CLASSES * N_CLASSES)
+        out_offset = dict(node_top[k])
+        in_offset = dict(node_top[k + 1])
+        for pair in np.flatnonzero(flows):
+            src, dst = divmod(pair, N_CLASSES)
+            size = flows[pair]
+            x0, x1 = k + node_width / 2, k + 1 - node_width / 2
+            y0, y1 = out_offset[src], in_offset[dst]
+            xm = (x0 + x1) / 2
+            vertices = [(x0, y0), (xm, y0), (xm, y1), (x1, y1), (x1, y1 + size), (xm, y1 + size), (xm, y0 + size),
+                        (x0, y0 + size), (x0, y0)]
+            path_codes = [Path.MOVETO, Path.CURVE4, Path.CURVE4, Path.CURVE4, Path.LINETO, Path.CURVE4, Path.CURVE4,
+                          Path.CURVE4, Path.CLOSEPOLY]
+            ax.add_patch(PathPatch(Path(vertices, path_codes), facecolor=koppen_colors[dst], edgecolor='none', alpha=0.5))
+            out_offset[src] += size
+            in_offset[dst] += size
+
+    ax.set_xlim(-0.5, N_STEPS - 0.5)
+    ax.set_ylim(0, height)
+    ax.invert_yaxis()
+    ax.set_xticks(range(N_STEPS))
+    ax.set_xticklabels(columns, fontsize=12)
+    ax.set_yticks([])
+    for side in ['top', 'right', 'left']:
+        ax.spines[side].set_visible(False)
+    if title:
+        ax.set_title(title, fontsize=15)
+    plt.savefig(out_path, bbox_inches='tight', dpi=300)
+    plt.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trajectories of Köppen classes across the three future time slices.')
+    parser.add_argument('--scenario', type=str, help='Climate scenario', default='ssp585')
+    parser.add_argument('--models', type=str, nargs='+', help='Models to include (default: every model found in all time slices)', default=None)
+    parser.add_argument('--source_class', type=int, help='Class the trajectories start from', default=30)
+    parser.add_argument('--bbox', type=float, nargs=4, help='Bounding box (min_lon, min_lat, max_lon, max_lat)', default=[45, 34, 90, 56])
+    parser.add_argument('--workers', type=int, help='Number of worker processes for the models', default=1)
+    parser.add_argument('--area_weighted', action='store_true', help='Weight the trajectories by pixel area (km^2)')
+    args = parser.parse_args()
+
+    historical_path = kg2_historical_path()
+    geo_transform = gdal.Open(historical_path).GetGeoTransform()
+    window = bbox_to_window(geo_transform, args.bbox)
+    row_area = pixel_area_rows(geo_transform, window[1], window[3] - window[1]) if args.area_weighted else None
+    # A trajectory needs the model in every time slice, so only the models found in all of them are kept
+    if args.models is None:
+        found = [dict(discover_models(time_slice, args.scenario)) for time_slice in TIME_SLICES]
+        models = sorted(set(found[0]).intersection(*found[1:]))
+        model_paths = [[paths[model] for paths in found] for model in models]
+    else:
+        models = args.models
+        model_paths = [[kg2_model_path(time_slice, model, args.scenario) for time_slice in TIME_SLICES] for model in models]
+    if not models:
+        sys.exit(f"No models found in all of {', '.join(TIME_SLICES)} for {args.scenario}")
+    jobs = [(historical_path, paths, window, gdal.Open, row_area) for paths in model_paths]
+
+    ensemble_totals = None
+    for model, totals in zip(models, run_jobs(trajectory_job, jobs, args.workers)):
+        summary = trajectory_summary(totals, args.source_class)
+        print(f"{model} {args.scenario}: {summary}")
+        write_trajectories_csv(totals, f'trajectories_{args.source_class}_{model}_{args.scenario}.csv', args.source_class)
+        ensemble_totals = totals if ensemble_totals is None else ensemble_totals + totals
+    ensemble_totals = ensemble_totals / len(models)
+    print(f"Ensemble mean {args.scenario}: {trajectory_summary(ensemble_totals, args.source_class)}")
+    write_trajectories_csv(ensemble_totals, f'trajectories_{args.source_class}_ensemble_{args.scenario}.csv', args.source_class)
+    plot_alluvial(ensemble_totals, f'trajectories_{args.source_class}_{args.scenario}.png', args.source_class,
+                  title=f'{koppen_mapping_short[args.source_class].strip()} trajectories, {args.scenario}, ensemble mean')
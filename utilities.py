@@ -1,3 +1,45 @@
+import csv
+import glob
+import itertools
+import math
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from osgeo import gdal
+from tile_index import block_classes, class_bits
+from ensemble import stream_stats
+
+# kg2 class codes run from 1 (Af) to 31 (EF); 0 and anything outside the range is nodata
+N_CLASSES = 32
+# Mean Earth radius used for the pixel areas
+EARTH_RADIUS_KM = 6371.0088
+
+# Location of the CHELSA V2.1 climatologies and the standard scenarios, time slices and models
+BASE_DIR = '/p/projects/gvca/data/chelsa_cmip6/envicloud/chelsa/chelsa_V2/GLOBAL/climatologies'
+SCENARIOS = ['ssp126', 'ssp370', 'ssp585']
+TIME_SLICES = ['2011-2040', '2041-2070', '2071-2100']
+MODELS = ['GFDL-ESM4', 'IPSL-CM6A-LR', 'MPI-ESM1-2-HR', 'MRI-ESM2-0', 'UKESM1-0-LL']
+
+
+# Function to build the path of the historical kg2 map
+def kg2_historical_path(base_dir=BASE_DIR):
+    return f'{base_dir}/1981-2010/bio/CHELSA_kg2_1981-2010_V.2.1.tif'
+
+
+# Function to build the path of the kg2 map of one model, scenario and time slice
+def kg2_model_path(time_slice, model, scenario, base_dir=BASE_DIR):
+    return f'{base_dir}/{time_slice}/{model}/{scenario}/bio/CHELSA_kg2_{time_slice}_{model.lower()}_{scenario}_V.2.1.tif'
+
+
+# Function to find every model with a kg2 map for one scenario and time slice in the directory tree
+# (base_dir/time_slice/<model>/scenario/bio/*_kg2_*.tif). Returns sorted (model, path) pairs.
+def discover_models(time_slice, scenario, base_dir=BASE_DIR):
+    paths = glob.glob(f'{base_dir}/{time_slice}/*/{scenario}/bio/*_kg2_*.tif')
+    return sorted((path.split('/')[-4], path) for path in paths)
+
+
 # Function to transform latitude/longitude to pixel coordinates
 def world_to_pixel(geo_matrix, x, y):
     ulX = geo_matrix[0]
@@ -11,20 +53,475 @@ def world_to_pixel(geo_matrix, x, y):
     return (pixel, line)
 
 
-# Function to process each model and calculate changes
-def process_model(model_path):
-    future_dataset = gdal.Open(model_path)
-    future_array = future_dataset.ReadAsArray(minx, miny, maxx - minx, maxy - miny)
-
-    changes_dict_model = {}
-    for i in range(historical_array.shape[0]):
-        for j in range(historical_array.shape[1]):
-            historical_class = historical_array[i, j]
-            future_class = future_array[i, j]
-            if historical_class != future_class:
-                change_pair = (historical_class, future_class)
-                if change_pair not in changes_dict_model:
-                    changes_dict_model[change_pair] = 1
-                else:
-                    changes_dict_model[change_pair] += 1
-    return changes_dict_model
+# Function to compute the area in km^2 of a pixel in each of nrows rows starting at row yoff.
+# Compute it once per window and pass it as row_area to get area-weighted statistics.
+def pixel_area_rows(geo_transform, yoff, nrows):
+    lat_top = np.radians(geo_transform[3] + (yoff + np.arange(nrows)) * geo_transform[5])
+    lat_bottom = lat_top + np.radians(geo_transform[5])
+    return EARTH_RADIUS_KM ** 2 * np.radians(abs(geo_transform[1])) * np.abs(np.sin(lat_top) - np.sin(lat_bottom))
+
+
+# Function to expand a per-row area vector into one weight per pixel of a 2-D array
+def _pixel_weights(array, row_area):
+    return np.broadcast_to(np.asarray(row_area)[:, None], np.shape(array)).ravel()
+
+
+# Function to count every (historical_class, future_class) pair in a single NumPy pass.
+# Returns an n_classes x n_classes matrix where matrix[src, dst] is the number of pixels
+# going from src to dst; nodata pixels are dropped. Unlike the per-pixel loops this replaced,
+# that includes pixels whose future class is nodata (0 or >= n_classes): ET -> 0 is not a change.
+# If source_classes is given only pixels whose historical class is in that list are counted
+# (e.g. [30] for ET).
+# With row_area (see pixel_area_rows) the matrix holds areas in km^2 instead of pixel counts.
+def transition_matrix(historical_array, future_array, source_classes=None, n_classes=N_CLASSES, row_area=None):
+    weights = None if row_area is None else _pixel_weights(historical_array, row_area)
+    historical = np.asarray(historical_array).ravel().astype(np.intp)
+    future = np.asarray(future_array).ravel().astype(np.intp)
+    valid = (historical > 0) & (historical < n_classes) & (future > 0) & (future < n_classes)
+    if source_classes is not None:
+        valid &= np.isin(historical, source_classes)
+    # Invalid pixels all land in one extra bin that is dropped afterwards
+    codes = np.where(valid, historical * n_classes + future, n_classes * n_classes)
+    counts = np.bincount(codes, weights=weights, minlength=n_classes * n_classes + 1)
+    return counts[:-1].reshape(n_classes, n_classes)
+
+
+# Function to turn a transition matrix into the {(src, dst): count} dict used by the plots.
+# Only real changes (src != dst) with a non-zero count are kept.
+def changes_dict(matrix):
+    off_diagonal = np.array(matrix, copy=True)
+    np.fill_diagonal(off_diagonal, 0)
+    src, dst = np.nonzero(off_diagonal)
+    return {(int(s), int(d)): off_diagonal[s, d].item() for s, d in zip(src, dst)}
+
+
+# Function to reduce per-model transition matrices to the ensemble mean and standard deviation.
+# matrices can be a generator; they are folded in one at a time (see ensemble.py).
+def ensemble_transition_stats(matrices):
+    stats = stream_stats(matrices)
+    if stats.count == 0:
+        raise ValueError("No transition matrices to aggregate (no models found?)")
+    return stats.mean, stats.std()
+
+
+# Function to process each model and calculate the transition matrix against the historical map
+def process_model(model_path, historical_dataset, window, source_classes=None, open_dataset=gdal.Open, row_area=None):
+    future_dataset = open_dataset(model_path)
+    return tiled_transition_matrix(historical_dataset, future_dataset, window, source_classes=source_classes,
+                                   row_area=row_area)
+
+
+# Function to run one (historical_path, model_path, window, source_classes, open_dataset, row_area) job in a worker process
+def transition_job(job):
+    historical_path, model_path, window, source_classes, open_dataset, row_area = job
+    return process_model(model_path, open_dataset(historical_path), window, source_classes=source_classes,
+                         open_dataset=open_dataset, row_area=row_area)
+
+
+# Function to write rows to a CSV file, or to a Parquet file (needs pandas) when the path ends in .parquet
+def write_table(path, columns, rows):
+    if path.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(list(rows), columns=columns).to_parquet(path, index=False)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+# Function to read a table written by write_table as a list of {column: value} dicts.
+# CSV values come back as strings.
+def read_table(path):
+    if path.endswith('.parquet'):
+        import pandas as pd
+        return pd.read_parquet(path).to_dict('records')
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+# Function to pick the start method for worker pools. The scripts run their analysis at module
+# level, so workers are forked where possible instead of re-importing the calling script.
+def pool_context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+# Function to copy the read statistics of this process (see read_block)
+def _read_stats_snapshot():
+    return dict(READ_STATS), {path: dict(stats) for path, stats in PATH_READ_STATS.items()}
+
+
+# Function to run one (func, job) pair in a worker process and return the result with the read
+# statistics the job added in that process
+def _counted_job(job):
+    func, job = job
+    totals, paths = _read_stats_snapshot()
+    result = func(job)
+    read_totals = {name: READ_STATS[name] - totals[name] for name in READ_STATS}
+    read_paths = {path: {name: stats[name] - paths.get(path, {}).get(name, 0) for name in stats}
+                  for path, stats in PATH_READ_STATS.items()}
+    return result, (read_totals, read_paths)
+
+
+# Function to add the read statistics of a worker job to those of this process
+def _merge_read_stats(read_stats):
+    read_totals, read_paths = read_stats
+    for name, value in read_totals.items():
+        READ_STATS[name] += value
+    for path, stats in read_paths.items():
+        totals = PATH_READ_STATS.setdefault(path, {'bytes': 0, 'pixels': 0, 'read_time': 0.0})
+        for name, value in stats.items():
+            totals[name] += value
+
+
+# Function to run jobs serially or on a pool of worker processes.
+# Results are yielded in job order, so reducing them gives the same answer as the serial path.
+# The reads of the workers are added to the read statistics of this process as their results arrive.
+def run_jobs(func, jobs, workers=1):
+    if workers <= 1:
+        for job in jobs:
+            yield func(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as executor:
+        for result, read_stats in executor.map(_counted_job, ((func, job) for job in jobs)):
+            _merge_read_stats(read_stats)
+            yield result
+
+
+# Target number of pixels per tile when streaming a raster block by block
+TILE_PIXELS = 2 ** 22
+# Number of tiles read ahead by the background reader (0 reads in the calling thread)
+PREFETCH_DEPTH = 2
+# Seconds spent fetching, waiting for fetched tiles and computing, summed over all prefetch loops
+PREFETCH_TIMINGS = {'fetch': 0.0, 'wait': 0.0, 'compute': 0.0}
+
+
+# Function to yield fetch(item) for every item in order while a background thread reads ahead.
+# A single reader thread keeps up to depth results in flight, so GDAL handles are never used by
+# two threads at once while the caller computes on the previous tile.
+def prefetch(fetch, items, depth=None):
+    depth = PREFETCH_DEPTH if depth is None else depth
+
+    def timed_fetch(item):
+        start = time.perf_counter()
+        result = fetch(item)
+        PREFETCH_TIMINGS['fetch'] += time.perf_counter() - start
+        return result
+
+    if depth <= 0:
+        for item in items:
+            start = time.perf_counter()
+            result = timed_fetch(item)
+            PREFETCH_TIMINGS['wait'] += time.perf_counter() - start
+            start = time.perf_counter()
+            yield result
+            PREFETCH_TIMINGS['compute'] += time.perf_counter() - start
+        return
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque(executor.submit(timed_fetch, item) for item in itertools.islice(items, depth))
+        while pending:
+            start = time.perf_counter()
+            result = pending.popleft().result()
+            PREFETCH_TIMINGS['wait'] += time.perf_counter() - start
+            for item in itertools.islice(items, 1):
+                pending.append(executor.submit(timed_fetch, item))
+            start = time.perf_counter()
+            yield result
+            PREFETCH_TIMINGS['compute'] += time.perf_counter() - start
+
+
+# Function to summarise and reset the prefetch timings. The overlap is the share of the fetch
+# time that was hidden behind computation instead of being waited for.
+def prefetch_report():
+    fetch, wait, compute = PREFETCH_TIMINGS['fetch'], PREFETCH_TIMINGS['wait'], PREFETCH_TIMINGS['compute']
+    overlap = max(0.0, 1 - wait / fetch) if fetch > 0 else 0.0
+    for stage in PREFETCH_TIMINGS:
+        PREFETCH_TIMINGS[stage] = 0.0
+    return f"fetch {fetch:.2f} s, wait {wait:.2f} s, compute {compute:.2f} s, overlap {overlap:.0%}"
+
+
+# Function to convert a (min_lon, min_lat, max_lon, max_lat) box into a pixel window (minx, miny, maxx, maxy)
+def bbox_to_window(geo_transform, bbox):
+    minx, maxy = world_to_pixel(geo_transform, bbox[0], bbox[1])
+    maxx, miny = world_to_pixel(geo_transform, bbox[2], bbox[3])
+    return (minx, miny, maxx, maxy)
+
+
+# Function to get the geotransform of a pixel window (minx, miny, maxx, maxy) cut out of a raster
+def window_geo_transform(geo_transform, window):
+    minx, miny = window[0], window[1]
+    return (geo_transform[0] + minx * geo_transform[1] + miny * geo_transform[2], geo_transform[1], geo_transform[2],
+            geo_transform[3] + minx * geo_transform[4] + miny * geo_transform[5], geo_transform[4], geo_transform[5])
+
+
+# Function to split a pixel window into tiles aligned to the native block size of the dataset.
+# Small blocks (or one-row strips) are grouped so each tile holds roughly tile_pixels pixels.
+# Yields (xoff, yoff, xsize, ysize) in absolute pixel coordinates of the file.
+def block_windows(dataset, window, tile_pixels=TILE_PIXELS):
+    minx, miny, maxx, maxy = window
+    block_x, block_y = dataset.GetRasterBand(1).GetBlockSize()
+    step_x = block_x * max(1, math.isqrt(tile_pixels) // block_x)
+    step_y = block_y * max(1, tile_pixels // (max(1, min(step_x, maxx - minx)) * block_y))
+    xs = [minx] + list(range((minx // step_x + 1) * step_x, maxx, step_x)) + [maxx]
+    ys = [miny] + list(range((miny // step_y + 1) * step_y, maxy, step_y)) + [maxy]
+    for y0, y1 in zip(ys[:-1], ys[1:]):
+        for x0, x1 in zip(xs[:-1], xs[1:]):
+            yield (x0, y0, x1 - x0, y1 - y0)
+
+
+# Bytes and pixels read through read_block in this process and its finished worker jobs (see
+# run_jobs), and pixels of the tiles skipped through the tile-validity index (see profiling.py and
+# tile_index.py). PATH_READ_STATS splits the reads by raster: {path: {'bytes', 'pixels', 'read_time'}}.
+READ_STATS = {'bytes': 0, 'pixels': 0, 'skipped_pixels': 0}
+PATH_READ_STATS = {}
+
+
+# Function to get the file a dataset was opened from, to look up its tile-validity index
+def dataset_path(dataset):
+    return dataset.GetDescription()
+
+
+# Function to keep only the tiles for which keep(block) is true, e.g. tiles that hold land or a
+# given class according to the tile-validity index; the skipped tiles are never read
+def skip_blocks(blocks, keep):
+    kept = []
+    for block in blocks:
+        if keep(block):
+            kept.append(block)
+        else:
+            READ_STATS['skipped_pixels'] += block[2] * block[3]
+    return kept
+
+
+# Function to read one tile of the first band of a dataset
+def read_block(dataset, block):
+    xoff, yoff, xsize, ysize = block
+    start = time.perf_counter()
+    array = dataset.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+    READ_STATS['bytes'] += array.nbytes
+    READ_STATS['pixels'] += array.size
+    stats = PATH_READ_STATS.setdefault(dataset_path(dataset), {'bytes': 0, 'pixels': 0, 'read_time': 0.0})
+    stats['bytes'] += array.nbytes
+    stats['pixels'] += array.size
+    stats['read_time'] += time.perf_counter() - start
+    return array
+
+
+# Function to cut the rows of a tile out of the per-row area vector of a window (None stays None)
+def block_row_area(row_area, block, window):
+    if row_area is None:
+        return None
+    yoff, ysize = block[1], block[3]
+    return row_area[yoff - window[1]:yoff - window[1] + ysize]
+
+
+# Function to flag where the class changed between two maps: 0 nodata, 1 unchanged, 2 changed
+def changed_layer(historical, future, n_classes=N_CLASSES):
+    historical = np.asarray(historical)
+    future = np.asarray(future)
+    valid = (historical > 0) & (historical < n_classes) & (future > 0) & (future < n_classes)
+    return np.where(valid, np.where(historical == future, 1, 2), 0).astype(np.uint8)
+
+
+# Function to count the pixels (or km^2 with row_area) of a boolean mask
+def mask_total(mask, row_area=None):
+    if row_area is None:
+        return np.count_nonzero(mask)
+    return np.count_nonzero(mask, axis=1) @ np.asarray(row_area)
+
+
+# Function to count the pixels of each class in an array, ignoring nodata.
+# With row_area the histogram holds areas in km^2 instead of pixel counts.
+def class_histogram(array, n_classes=N_CLASSES, row_area=None):
+    weights = None if row_area is None else _pixel_weights(array, row_area)
+    values = np.asarray(array).ravel().astype(np.intp)
+    valid = (values > 0) & (values < n_classes)
+    return np.bincount(values[valid], weights=None if weights is None else weights[valid], minlength=n_classes)
+
+
+# Function to accumulate a class histogram over a window tile by tile
+def tiled_class_histogram(dataset, window, row_area=None):
+    histogram = np.zeros(N_CLASSES, dtype=np.int64 if row_area is None else np.float64)
+    path = dataset_path(dataset)
+    blocks = skip_blocks(block_windows(dataset, window), lambda block: block_classes(path, block))
+    for block, array in zip(blocks, prefetch(lambda block: read_block(dataset, block), blocks)):
+        histogram += class_histogram(array, row_area=block_row_area(row_area, block, window))
+    return histogram
+
+
+# Function to accumulate the transition matrix between two datasets over a window tile by tile
+def tiled_transition_matrix(historical_dataset, future_dataset, window, source_classes=None, row_area=None):
+    matrix = np.zeros((N_CLASSES, N_CLASSES), dtype=np.int64 if row_area is None else np.float64)
+    # Only tiles where the historical map holds a source class and the future map holds land count
+    historical_path, future_path = dataset_path(historical_dataset), dataset_path(future_dataset)
+    source_bits = class_bits(range(1, N_CLASSES) if source_classes is None else source_classes)
+    blocks = skip_blocks(block_windows(historical_dataset, window),
+                         lambda block: block_classes(historical_path, block) & source_bits and block_classes(future_path, block))
+    fetch = lambda block: (read_block(historical_dataset, block), read_block(future_dataset, block))
+    for block, (historical, future) in zip(blocks, prefetch(fetch, blocks)):
+        matrix += transition_matrix(historical, future, source_classes=source_classes,
+                                    row_area=block_row_area(row_area, block, window))
+    return matrix
+
+
+# Function to count the agreement on target_cat for a single tile from the historical classes and
+# the model classes (any iterable of tiles, folded into the agreement one at a time)
+def _tile_agreement(historical, model_tiles, target_cat, row_area=None):
+    is_historical = historical == target_cat
+    agreement = np.zeros(is_historical.shape, dtype=np.uint8)
+    counts = [mask_total(is_historical, row_area)]
+    for classes in model_tiles:
+        is_cat = classes == target_cat
+        agreement += is_cat
+        counts.append(mask_total(is_cat, row_area))
+    return is_historical, agreement, counts
+
+
+# Function to count the agreement on target_cat for a single tile. The models are read one after
+# the other and folded into the agreement, so only one model tile is held at a time.
+def _block_agreement(historical_dataset, model_datasets, block, target_cat, row_area=None):
+    return _tile_agreement(read_block(historical_dataset, block), (read_block(dataset, block) for dataset in model_datasets),
+                           target_cat, row_area=row_area)
+
+
+# Function to read the tile of the historical map and of every model (the prefetch fetch of the serial paths)
+def _read_tiles(historical_dataset, model_datasets, block):
+    return read_block(historical_dataset, block), [read_block(dataset, block) for dataset in model_datasets]
+
+
+# Function to run one (historical_path, model_paths, block, target_cat, open_dataset, row_area) tile in a worker process
+def agreement_job(job):
+    historical_path, model_paths, block, target_cat, open_dataset, row_area = job
+    model_datasets = [open_dataset(model_path) for model_path in model_paths]
+    return _block_agreement(open_dataset(historical_path), model_datasets, block, target_cat, row_area=row_area)
+
+
+# Function to build the model agreement map for one category tile by tile.
+# Returns the uint8 agreement map (number of models in target_cat), the historical mask
+# and the pixel counts [historical, model_1, ..., model_n]. With workers > 1 the tiles
+# are spread over a process pool and merged back in tile order. open_dataset replaces
+# gdal.Open, e.g. to read through the window cache. With row_area the counts are in km^2.
+# historical_mask can be given when the mask is already loaded (e.g. the shared baseline of
+# cache.shared_baseline); it is returned as is instead of being rebuilt.
+def tiled_agreement(historical_path, model_paths, window, target_cat, workers=1, open_dataset=gdal.Open, row_area=None,
+                    historical_mask=None):
+    minx, miny, maxx, maxy = window
+    agreement_array = np.zeros((maxy - miny, maxx - minx), dtype=np.uint8)
+    fill_mask = historical_mask is None
+    if fill_mask:
+        historical_mask = np.zeros((maxy - miny, maxx - minx), dtype=bool)
+    counts = np.zeros(len(model_paths) + 1, dtype=np.int64 if row_area is None else np.float64)
+    historical_dataset = open_dataset(historical_path)
+    # Tiles where neither the historical map nor any model holds target_cat stay zero
+    target_bits = class_bits([target_cat])
+    blocks = skip_blocks(block_windows(historical_dataset, window),
+                         lambda block: any(block_classes(path, block) & target_bits for path in [historical_path] + model_paths))
+    if workers <= 1:
+        # The reader thread only reads the tiles; the comparisons run here while it reads ahead
+        model_datasets = [open_dataset(model_path) for model_path in model_paths]
+        tiles = prefetch(lambda block: _read_tiles(historical_dataset, model_datasets, block), blocks)
+        results = (_tile_agreement(historical, model_tiles, target_cat, row_area=block_row_area(row_area, block, window))
+                   for block, (historical, model_tiles) in zip(blocks, tiles))
+    else:
+        jobs = [(historical_path, model_paths, block, target_cat, open_dataset, block_row_area(row_area, block, window))
+                for block in blocks]
+        results = run_jobs(agreement_job, jobs, workers)
+    for block, (is_historical, agreement, block_counts) in zip(blocks, results):
+        xoff, yoff, xsize, ysize = block
+        rows = slice(yoff - miny, yoff - miny + ysize)
+        cols = slice(xoff - minx, xoff - minx + xsize)
+        if fill_mask:
+            historical_mask[rows, cols] = is_historical
+        agreement_array[rows, cols] = agreement
+        counts += block_counts
+    return agreement_array, historical_mask, counts
+
+
+# Function to add the classes of one model tile to the agreement cube of that tile
+# (cube_tile[c] += 1 where the model is in class c; nodata lands in cube_tile[0], which is cleared)
+def _add_classes(cube_tile, classes):
+    ysize, xsize = classes.shape
+    classes = np.where((classes > 0) & (classes < N_CLASSES), classes, 0)
+    cube_tile[classes, np.arange(ysize)[:, None], np.arange(xsize)] += 1
+
+
+# Function to count the classes of the historical map and of the model tiles (any iterable of
+# tiles, added one at a time) into cube_tile. Returns the historical classes and the per-class counts.
+def _tile_cube(historical, model_tiles, cube_tile, row_area=None):
+    counts = [class_histogram(historical, row_area=row_area)]
+    for classes in model_tiles:
+        _add_classes(cube_tile, classes)
+        counts.append(class_histogram(classes, row_area=row_area))
+    cube_tile[0] = 0
+    return historical, np.array(counts)
+
+
+# Function to count the classes of the historical map and every model for a single tile into
+# cube_tile, reading one model at a time
+def _block_cube(historical_dataset, model_datasets, block, cube_tile, row_area=None):
+    return _tile_cube(read_block(historical_dataset, block), (read_block(dataset, block) for dataset in model_datasets),
+                      cube_tile, row_area=row_area)
+
+
+# Function to run one (historical_path, model_paths, block, open_dataset, row_area) tile in a worker process
+def classes_job(job):
+    historical_path, model_paths, block, open_dataset, row_area = job
+    model_datasets = [open_dataset(model_path) for model_path in model_paths]
+    xoff, yoff, xsize, ysize = block
+    cube_tile = np.zeros((N_CLASSES, ysize, xsize), dtype=np.uint8)
+    historical, counts = _block_cube(open_dataset(historical_path), model_datasets, block, cube_tile, row_area=row_area)
+    return historical, cube_tile, counts
+
+
+# Function to build the agreement for every class in one pass over the models.
+# Returns a dict with the uint8 'cube' (cube[c] = number of models in class c), the historical
+# map, the 'modal_class' (most common future class, 0 where no model has data), the
+# 'modal_agreement' (number of models in the modal class) and the per-class pixel 'counts'
+# with shape (1 + n_models, N_CLASSES), first row historical (in km^2 with row_area). cube
+# can be given to write into a preallocated (e.g. memory-mapped) array, and historical when the
+# historical window is already loaded (e.g. the shared baseline of cache.shared_baseline), which
+# is then returned as is. The models of a tile are added to the cube one at a time, so memory
+# does not grow with the size of the ensemble.
+def tiled_agreement_cube(historical_path, model_paths, window, workers=1, open_dataset=gdal.Open, cube=None, row_area=None,
+                         historical=None):
+    minx, miny, maxx, maxy = window
+    shape = (maxy - miny, maxx - minx)
+    if cube is None:
+        cube = np.zeros((N_CLASSES,) + shape, dtype=np.uint8)
+    fill_historical = historical is None
+    historical_array = np.zeros(shape, dtype=np.uint8) if fill_historical else historical
+    modal_class = np.zeros(shape, dtype=np.uint8)
+    modal_agreement = np.zeros(shape, dtype=np.uint8)
+    counts = np.zeros((len(model_paths) + 1, N_CLASSES), dtype=np.int64 if row_area is None else np.float64)
+    historical_dataset = open_dataset(historical_path)
+    # Tiles without land in the historical map or any model stay zero
+    blocks = skip_blocks(block_windows(historical_dataset, window),
+                         lambda block: any(block_classes(path, block) for path in [historical_path] + model_paths))
+    tile_slices = lambda block: (slice(block[1] - miny, block[1] - miny + block[3]), slice(block[0] - minx, block[0] - minx + block[2]))
+    if workers <= 1:
+        # The serial path counts straight into the cube; the reader thread only reads the tiles
+        model_datasets = [open_dataset(model_path) for model_path in model_paths]
+        tiles = prefetch(lambda block: _read_tiles(historical_dataset, model_datasets, block), blocks)
+        results = ((historical, None, _tile_cube(historical, model_tiles, cube[(slice(None),) + tile_slices(block)],
+                                                 row_area=block_row_area(row_area, block, window))[1])
+                   for block, (historical, model_tiles) in zip(blocks, tiles))
+    else:
+        jobs = [(historical_path, model_paths, block, open_dataset, block_row_area(row_area, block, window)) for block in blocks]
+        results = run_jobs(classes_job, jobs, workers)
+    for block, (block_historical, cube_tile, block_counts) in zip(blocks, results):
+        rows, cols = tile_slices(block)
+        if cube_tile is not None:
+            cube[:, rows, cols] = cube_tile
+        if fill_historical:
+            historical_array[rows, cols] = block_historical
+        counts += block_counts
+        # Ties go to the lower class; pixels where no model has data keep class 0
+        tile = cube[1:, rows, cols]
+        best_agreement = tile.max(axis=0)
+        modal_class[rows, cols] = np.where(best_agreement > 0, tile.argmax(axis=0) + 1, 0)
+        modal_agreement[rows, cols] = best_agreement
+    return {'cube': cube, 'historical': historical_array, 'modal_class': modal_class,
+            'modal_agreement': modal_agreement, 'counts': counts}
@@ -0,0 +1,213 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import numpy as np
+from osgeo import gdal, ogr
+from koppen_mappings import koppen_mapping_short
+from tile_index import block_classes, class_bits
+from utilities import (N_CLASSES, bbox_to_window, block_row_area, block_windows, discover_models, ensemble_transition_stats,
+                       kg2_historical_path, kg2_model_path, pixel_area_rows, prefetch, read_block, run_jobs, skip_blocks)
+from cache import CACHE_DIR, cache_key
+
+# Zonal statistics over a labelled zone raster rasterized from local polygon files (shapefile,
+# GeoJSON, ...). Zone 0 is everything outside the polygons; zones 1..n follow the features, or
+# the distinct values of an attribute (e.g. one zone per country name). The zone raster is cached
+# per grid as a tiled GeoTIFF, and all zones are counted with one bincount per tile over
+# (zone, historical, future) codes, so one pass per model gives the numbers for every zone.
+ZONES_DIR = os.path.join(CACHE_DIR, 'zones')
+
+
+# Function to rasterize a polygon file onto the grid of a raster, cached per grid.
+# Returns the path of the uint16 zone raster and the list of zone names (index = zone id).
+# Where polygons overlap the feature drawn last wins.
+def rasterize_zones(vector_path, grid_path, attribute=None, zones_dir=ZONES_DIR):
+    grid = gdal.Open(grid_path)
+    geo_transform = grid.GetGeoTransform()
+    key = cache_key([vector_path], (), kind='zones', attribute=attribute, geo_transform=list(geo_transform),
+                    shape=[grid.RasterYSize, grid.RasterXSize])
+    zones_path = os.path.join(zones_dir, f'{key}.tif')
+    names_path = os.path.join(zones_dir, f'{key}.json')
+    if os.path.exists(zones_path) and os.path.exists(names_path):
+        with open(names_path) as f:
+            return zones_path, json.load(f)
+    os.makedirs(zones_dir, exist_ok=True)
+
+    # Copy the polygons into a memory layer with one integer zone id per feature
+    source = ogr.Open(vector_path)
+    layer = source.GetLayer()
+    memory = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    zone_layer = memory.CreateLayer('zones', srs=layer.GetSpatialRef(), geom_type=ogr.wkbUnknown)
+    zone_layer.CreateField(ogr.FieldDefn('zone_id', ogr.OFTInteger))
+    names = ['outside']
+    zone_ids = {}
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        name = str(feature.GetField(attribute)) if attribute else str(feature.GetFID())
+        if name not in zone_ids:
+            zone_ids[name] = len(names)
+            names.append(name)
+        zone_feature = ogr.Feature(zone_layer.GetLayerDefn())
+        zone_feature.SetGeometry(geometry.Clone())
+        zone_feature.SetField('zone_id', zone_ids[name])
+        zone_layer.CreateFeature(zone_feature)
+    if len(names) > np.iinfo(np.uint16).max:
+        raise ValueError(f"{vector_path} has {len(names) - 1} zones, at most {np.iinfo(np.uint16).max - 1} are supported")
+
+    tmp_path = f'{zones_path}.{os.getpid()}.tmp.tif'
+    zones = gdal.GetDriverByName('GTiff').Create(tmp_path, grid.RasterXSize, grid.RasterYSize, 1, gdal.GDT_UInt16,
+                                                 options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    zones.SetGeoTransform(geo_transform)
+    zones.SetProjection(grid.GetProjection())
+    gdal.RasterizeLayer(zones, [1], zone_layer, options=['ATTRIBUTE=zone_id'])
+    zones.FlushCache()
+    zones = None
+    os.replace(tmp_path, zones_path)
+    with open(names_path, 'w') as f:
+        json.dump(names, f)
+    return zones_path, names
+
+
+# Function to convert the extent of a polygon file into a (min_lon, min_lat, max_lon, max_lat) box
+def vector_bbox(vector_path):
+    minx, maxx, miny, maxy = ogr.Open(vector_path).GetLayer().GetExtent()
+    return [minx, miny, maxx, maxy]
+
+
+# Function to count every (zone, historical_class, future_class) triple of one tile in a single bincount.
+# Returns an n_zones x N_CLASSES x N_CLASSES array (km^2 with row_area); nodata pixels are dropped.
+def zonal_transition_counts(zones, historical, future, n_zones, source_classes=None, row_area=None):
+    weights = None if row_area is None else np.broadcast_to(np.asarray(row_area)[:, None], np.shape(historical)).ravel()
+    zones = np.asarray(zones).ravel().astype(np.intp)
+    historical = np.asarray(historical).ravel().astype(np.intp)
+    future = np.asarray(future).ravel().astype(np.intp)
+    valid = (zones < n_zones) & (historical > 0) & (historical < N_CLASSES) & (future > 0) & (future < N_CLASSES)
+    if source_classes is not None:
+        valid &= np.isin(historical, source_classes)
+    # Invalid pixels all land in one extra bin that is dropped afterwards
+    n_codes = n_zones * N_CLASSES * N_CLASSES
+    codes = np.where(valid, (zones * N_CLASSES + historical) * N_CLASSES + future, n_codes)
+    counts = np.bincount(codes, weights=weights, minlength=n_codes + 1)
+    return counts[:-1].reshape(n_zones, N_CLASSES, N_CLASSES)
+
+
+# Function to accumulate the zonal transition matrices of one model over a window tile by tile
+def tiled_zonal_transitions(zones_path, historical_path, model_path, window, n_zones, source_classes=None,
+                            open_dataset=gdal.Open, row_area=None):
+    zones_dataset = gdal.Open(zones_path)
+    historical_dataset = open_dataset(historical_path)
+    future_dataset = open_dataset(model_path)
+    matrices = np.zeros((n_zones, N_CLASSES, N_CLASSES), dtype=np.int64 if row_area is None else np.float64)
+    source_bits = class_bits(range(1, N_CLASSES) if source_classes is None else source_classes)
+    blocks = skip_blocks(block_windows(historical_dataset, window),
+                         lambda block: block_classes(historical_path, block) & source_bits and block_classes(model_path, block))
+    fetch = lambda block: [read_block(dataset, block) for dataset in (zones_dataset, historical_dataset, future_dataset)]
+    for block, (zones, historical, future) in zip(blocks, prefetch(fetch, blocks)):
+        matrices += zonal_transition_counts(zones, historical, future, n_zones, source_classes=source_classes,
+                                            row_area=block_row_area(row_area, block, window))
+    return matrices
+
+
+# Function to run one (zones_path, historical_path, model_path, window, n_zones, source_classes, open_dataset, row_area)
+# job in a worker process
+def zonal_transition_job(job):
+    zones_path, historical_path, model_path, window, n_zones, source_classes, open_dataset, row_area = job
+    return tiled_zonal_transitions(zones_path, historical_path, model_path, window, n_zones, source_classes=source_classes,
+                                   open_dataset=open_dataset, row_area=row_area)
+
+
+# Function to count the model agreement on target_cat per zone over a window tile by tile.
+# Returns 'class_counts' (n_zones x (1 + n_models): pixels in target_cat, historical first) and
+# 'agreement' (n_zones x n_models: column k - 1 holds the pixels where exactly k models agree on
+# target_cat), both in km^2 with row_area. Each is one bincount per tile.
+def tiled_zonal_agreement(zones_path, historical_path, model_paths, window, n_zones, target_cat, open_dataset=gdal.Open,
+                          row_area=None):
+    n_models = len(model_paths)
+    dtype = np.int64 if row_area is None else np.float64
+    class_counts = np.zeros((n_zones, n_models + 1), dtype=dtype)
+    agreement_counts = np.zeros((n_zones, n_models), dtype=dtype)
+    zones_dataset = gdal.Open(zones_path)
+    datasets = [open_dataset(path) for path in [historical_path] + model_paths]
+    target_bits = class_bits([target_cat])
+    blocks = skip_blocks(block_windows(datasets[0], window),
+                         lambda block: any(block_classes(path, block) & target_bits for path in [historical_path] + model_paths))
+    fetch = lambda block: (read_block(zones_dataset, block), np.stack([read_block(dataset, block) for dataset in datasets]))
+    for block, (zones, classes) in zip(blocks, prefetch(fetch, blocks)):
+        area = block_row_area(row_area, block, window)
+        weights = None if area is None else np.broadcast_to(np.asarray(area)[:, None], zones.shape).ravel()
+        zones = zones.ravel().astype(np.intp)
+        in_zone = zones < n_zones
+        zones = np.where(in_zone, zones, n_zones)
+        is_target = classes.reshape(n_models + 1, -1) == target_cat
+        # (zone, raster) codes for the pixels in target_cat, one extra zone for pixels outside the table
+        codes = (zones * (n_models + 1))[None, :] + np.arange(n_models + 1)[:, None]
+        counts = np.bincount(codes[is_target], weights=None if weights is None else np.broadcast_to(weights, codes.shape)[is_target],
+                             minlength=(n_zones + 1) * (n_models + 1))
+        class_counts += counts.reshape(n_zones + 1, n_models + 1)[:-1]
+        agreement = np.count_nonzero(is_target[1:], axis=0)
+        agreeing = agreement > 0
+        counts = np.bincount((zones * n_models + agreement - 1)[agreeing], weights=None if weights is None else weights[agreeing],
+                             minlength=(n_zones + 1) * n_models)
+        agreement_counts += counts.reshape(n_zones + 1, n_models)[:-1]
+    return {'class_counts': class_counts, 'agreement': agreement_counts}
+
+
+# Function to write the ensemble mean and standard deviation of the zonal migrations to a CSV file
+def write_zonal_transitions_csv(mean_matrices, std_matrices, names, out_path):
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['zone', 'from', 'to', 'mean', 'std'])
+        for zone, src, dst in zip(*np.nonzero(mean_matrices)):
+            if src != dst:
+                writer.writerow([names[zone], koppen_mapping_short[src].strip(), koppen_mapping_short[dst].strip(),
+                                 mean_matrices[zone, src, dst], std_matrices[zone, src, dst]])
+
+
+# Function to write the zonal agreement counts to a CSV file
+def write_zonal_agreement_csv(result, names, model_names, out_path):
+    n_models = len(model_names)
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['zone', 'historical'] + model_names + [f'{k}_models_agree' for k in range(1, n_models + 1)])
+        for zone, name in enumerate(names):
+            writer.writerow([name] + result['class_counts'][zone].tolist() + result['agreement'][zone].tolist())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Zonal transition and agreement statistics over polygon zones.')
+    parser.add_argument('vector', type=str, help='Polygon file (shapefile, GeoJSON, ...)')
+    parser.add_argument('--attribute', type=str, help='Attribute naming the zones (default: one zone per feature)', default=None)
+    parser.add_argument('--scenario', type=str, help='Climate scenario', default='ssp585')
+    parser.add_argument('--time_slice', type=str, help='Time slice', default='2071-2100')
+    parser.add_argument('--models', type=str, nargs='+', help='Models to include (default: every model found)', default=None)
+    parser.add_argument('--target_cat', type=int, help='Category of the migrations and the agreement', default=30)
+    parser.add_argument('--bbox', type=float, nargs=4, help='Bounding box (default: extent of the polygons)', default=None)
+    parser.add_argument('--workers', type=int, help='Number of worker processes for the models', default=1)
+    parser.add_argument('--area_weighted', action='store_true', help='Report areas (km^2) instead of grid points')
+    args = parser.parse_args()
+
+    historical_path = kg2_historical_path()
+    if args.models is None:
+        models = discover_models(args.time_slice, args.scenario)
+    else:
+        models = [(model, kg2_model_path(args.time_slice, model, args.scenario)) for model in args.models]
+    if not models:
+        sys.exit(f"No models found for {args.scenario} {args.time_slice}")
+    model_paths = [path for _, path in models]
+    zones_path, names = rasterize_zones(args.vector, historical_path, attribute=args.attribute)
+    geo_transform = gdal.Open(historical_path).GetGeoTransform()
+    window = bbox_to_window(geo_transform, args.bbox or vector_bbox(args.vector))
+    row_area = pixel_area_rows(geo_transform, window[1], window[3] - window[1]) if args.area_weighted else None
+    n_zones = len(names)
+
+    jobs = [(zones_path, historical_path, model_path, window, n_zones, [args.target_cat], gdal.Open, row_area)
+            for model_path in model_paths]
+    mean_matrices, std_matrices = ensemble_transition_stats(list(run_jobs(zonal_transition_job, jobs, args.workers)))
+    tag = f'{args.target_cat}_{args.time_slice}_{args.scenario}'
+    write_zonal_transitions_csv(mean_matrices, std_matrices, names, f'zonal_migrations_{tag}.csv')
+    result = tiled_zonal_agreement(zones_path, historical_path, model_paths, window, n_zones, args.target_cat, row_area=row_area)
+    write_zonal_agreement_csv(result, names, [model for model, _ in models], f'zonal_agreement_{tag}.csv')
+    print(f"Zonal statistics for {n_zones - 1} zones written to zonal_migrations_{tag}.csv and zonal_agreement_{tag}.csv")